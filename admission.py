@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+"""
+Contrôle d'admission pour l'API Llama.cpp
+
+Chaque génération passe par le contrôleur avant d'entrer dans la file :
+    - max_tokens borné par SECURITY_CONFIG["max_tokens_per_request"] (400)
+    - file globale bornée en profondeur et en attente estimée (503)
+    - seau de jetons par client, débité du nombre de tokens estimé
+      (prompt + max_tokens) et recrédité des tokens non générés (429)
+
+Les refus sont immédiats et portent un Retry-After, ce qui garde une latence
+maîtrisée pour les requêtes admises.
+"""
+
+import math
+import threading
+import time
+from typing import Dict, List, Optional, Any
+
+from config import Config
+
+# Facteur de lissage de la durée moyenne de service
+_EWMA_ALPHA = 0.2
+
+
+class AdmissionRejected(Exception):
+    """Requête refusée par le contrôle d'admission"""
+
+    def __init__(self, status_code: int, detail: str, retry_after: Optional[int] = None, reason: str = ""):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.retry_after = retry_after
+        self.reason = reason
+
+    @property
+    def headers(self) -> Optional[Dict[str, str]]:
+        return {"Retry-After": str(self.retry_after)} if self.retry_after else None
+
+
+def estimate_prompt_tokens(messages: List[Dict[str, str]]) -> int:
+    """Estimation rapide du nombre de tokens du prompt (~4 caractères par token)"""
+    return sum(len(m.get("content", "")) for m in messages) // 4 + 8 * len(messages)
+
+
+class _TokenBucket:
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, tokens: float, now: float):
+        self.tokens = tokens
+        self.updated = now
+
+
+class AdmissionController:
+    """Seaux de jetons par client et limites globales de file d'attente"""
+
+    # Au-delà, les seaux pleins (clients inactifs) sont oubliés
+    MAX_TRACKED_CLIENTS = 10000
+
+    def __init__(self, rate_limit: int, tokens_per_request: int, max_tokens_per_request: int,
+                 max_queue_depth: int, max_estimated_wait: float):
+        self.capacity = float(rate_limit * tokens_per_request)  # Tokens par minute et par client
+        self.refill_rate = self.capacity / 60.0
+        self.max_tokens_per_request = max_tokens_per_request
+        self.max_queue_depth = max_queue_depth
+        self.max_estimated_wait = max_estimated_wait
+        self._buckets: Dict[str, _TokenBucket] = {}
+        self._lock = threading.Lock()
+
+        self.in_flight = 0
+        self.avg_service_time = 0.0
+
+        # Statistiques
+        self.admitted = 0
+        self.rejected_rate_limit = 0
+        self.rejected_overload = 0
+        self.rejected_too_large = 0
+        self.rejected_deadline = 0
+        self.tokens_refunded = 0
+
+    @property
+    def slots(self) -> int:
+        """Générations simultanées (séquences parallèles × workers d'inférence)"""
+        return max(1, Config.LLAMA_CONFIG["n_parallel"]) * max(1, Config.API_CONFIG["workers"])
+
+    def estimated_wait(self) -> float:
+        """Attente estimée d'une nouvelle requête avant son démarrage"""
+        queued = max(0, self.in_flight - self.slots + 1)
+        return queued * self.avg_service_time / self.slots
+
+    def admit(self, client: str, messages: List[Dict[str, str]], max_tokens: int,
+              deadline: Optional[float] = None) -> int:
+        """Admet une requête et retourne le nombre de tokens débités (AdmissionRejected sinon)"""
+        if max_tokens > self.max_tokens_per_request:
+            with self._lock:
+                self.rejected_too_large += 1
+            raise AdmissionRejected(
+                400, f"max_tokens limité à {self.max_tokens_per_request} par requête"
+            )
+
+        cost = min(estimate_prompt_tokens(messages) + max_tokens, self.capacity)
+        now = time.time()
+        with self._lock:
+            # Limites globales d'abord : un refus pour surcharge ne consomme pas le quota du client
+            queued = max(0, self.in_flight - self.slots + 1)
+            wait = self.estimated_wait()
+            if queued > self.max_queue_depth or wait > self.max_estimated_wait:
+                self.rejected_overload += 1
+                retry_after = max(1, math.ceil(self.avg_service_time or 1))
+                raise AdmissionRejected(
+                    503, f"Serveur saturé ({queued} requêtes en attente, ~{wait:.0f}s)", retry_after, "overload"
+                )
+
+            # Échéance intenable : la requête ne démarrerait pas à temps
+            if deadline is not None and now + wait >= deadline:
+                self.rejected_deadline += 1
+                raise AdmissionRejected(
+                    503, f"Échéance impossible à tenir (attente estimée ~{wait:.1f}s)", reason="deadline"
+                )
+
+            bucket = self._bucket(client, now)
+            if bucket.tokens < cost:
+                self.rejected_rate_limit += 1
+                retry_after = max(1, math.ceil((cost - bucket.tokens) / self.refill_rate))
+                raise AdmissionRejected(429, "Limite de débit atteinte pour ce client", retry_after, "rate_limit")
+
+            bucket.tokens -= cost
+            self.in_flight += 1
+            self.admitted += 1
+        return int(cost)
+
+    def _bucket(self, client: str, now: float) -> _TokenBucket:
+        bucket = self._buckets.get(client)
+        if bucket is None:
+            if len(self._buckets) >= self.MAX_TRACKED_CLIENTS:
+                self._forget_idle(now)
+            bucket = self._buckets[client] = _TokenBucket(self.capacity, now)
+        else:
+            bucket.tokens = min(self.capacity, bucket.tokens + (now - bucket.updated) * self.refill_rate)
+            bucket.updated = now
+        return bucket
+
+    def _forget_idle(self, now: float):
+        full_after = self.capacity / self.refill_rate
+        for client in [c for c, b in self._buckets.items() if now - b.updated >= full_after]:
+            del self._buckets[client]
+
+    def release(self, client: str, cost: int, max_tokens: int, job=None):
+        """Fin d'une requête admise : recrédite les tokens non générés, met à jour la durée de service"""
+        with self._lock:
+            self.in_flight = max(0, self.in_flight - 1)
+            if job is None:
+                # Jamais entrée dans la file : remboursement intégral
+                refund = cost
+            else:
+                refund = max(0, max_tokens - job.completion_tokens)
+                if job.started_at and job.finished_at:
+                    duration = job.finished_at - job.started_at
+                    if self.avg_service_time:
+                        self.avg_service_time += _EWMA_ALPHA * (duration - self.avg_service_time)
+                    else:
+                        self.avg_service_time = duration
+            bucket = self._buckets.get(client)
+            if bucket is not None and refund:
+                bucket.tokens = min(self.capacity, bucket.tokens + refund)
+                self.tokens_refunded += refund
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Statistiques d'admission"""
+        with self._lock:
+            return {
+                "enabled": Config.ADMISSION_CONFIG["enabled"],
+                "in_flight": self.in_flight,
+                "slots": self.slots,
+                "estimated_wait": round(self.estimated_wait(), 2),
+                "avg_service_time": round(self.avg_service_time, 3),
+                "client_tokens_per_minute": int(self.capacity),
+                "tracked_clients": len(self._buckets),
+                "admitted": self.admitted,
+                "rejected_rate_limit": self.rejected_rate_limit,
+                "rejected_overload": self.rejected_overload,
+                "rejected_too_large": self.rejected_too_large,
+                "rejected_deadline": self.rejected_deadline,
+                "tokens_refunded": self.tokens_refunded,
+            }
+
+
+# Instance globale
+admission_controller = AdmissionController(
+    rate_limit=Config.SECURITY_CONFIG["rate_limit"],
+    tokens_per_request=Config.ADMISSION_CONFIG["tokens_per_request"],
+    max_tokens_per_request=Config.SECURITY_CONFIG["max_tokens_per_request"],
+    max_queue_depth=Config.ADMISSION_CONFIG["max_queue_depth"],
+    max_estimated_wait=Config.ADMISSION_CONFIG["max_estimated_wait"],
+)
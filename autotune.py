@@ -0,0 +1,373 @@
+#!/usr/bin/env python3
+"""
+Réglage empirique des threads, du batch et du contexte pour l'API Llama.cpp
+
+Au lieu des règles RAM / nombre de cœurs, de courts micro-benchmarks sur le
+modèle et la machine réels mesurent séparément :
+    - l'évaluation du prompt (tokens/s), qui dépend de n_threads_batch et n_batch
+    - le décodage (tokens/s), qui ne dépend que de n_threads
+Les deux objectifs portent sur des réglages disjoints : le front de Pareto se
+réduit au meilleur de chaque courbe. Parmi les réglages à moins de
+`tolerance` du meilleur, le plus économe (moins de threads, batch plus
+petit) est retenu. n_ctx est borné par la mémoire à partir de la taille
+mesurée du cache KV par token.
+
+Le résultat est un profil JSON par machine et par modèle, chargé par le
+serveur au démarrage :
+
+    python autotune.py                  # mesure et enregistre le profil
+    python autotune.py --show           # affiche le profil actif
+"""
+
+import hashlib
+import json
+import logging
+import os
+import platform
+import statistics
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional, Any, Tuple
+
+import psutil
+
+from config import Config
+from cpu_affinity import cpu_affinity
+
+logger = logging.getLogger(__name__)
+
+_PROFILE_VERSION = 1
+
+# Texte répété pour construire un prompt de longueur fixe
+_BENCH_TEXT = (
+    "Le serveur évalue ce texte pour mesurer la vitesse du modèle sur cette machine. "
+    "The quick brown fox jumps over the lazy dog while the tokens are processed in batches. "
+)
+
+
+def _digest(*parts: Any) -> str:
+    return hashlib.blake2b("|".join(str(p) for p in parts).encode("utf-8"), digest_size=6).hexdigest()
+
+
+def _cpu_model() -> str:
+    try:
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                if line.startswith("model name"):
+                    return line.split(":", 1)[1].strip()
+    except OSError:
+        pass
+    return platform.processor() or platform.machine()
+
+
+def host_fingerprint() -> Dict[str, Any]:
+    """Caractéristiques de la machine qui identifient un profil"""
+    info = {
+        "hostname": platform.node(),
+        "cpu_model": _cpu_model(),
+        "physical_cores": psutil.cpu_count(logical=False) or 1,
+        "logical_cores": psutil.cpu_count(logical=True) or 1,
+        "ram_gb": round(psutil.virtual_memory().total / (1024**3)),
+    }
+    info["id"] = _digest(info["hostname"], info["cpu_model"], info["logical_cores"], info["ram_gb"])
+    return info
+
+
+def model_fingerprint(model_path: str) -> Dict[str, Any]:
+    """Identité du modèle (nom et taille du fichier GGUF)"""
+    try:
+        size = os.path.getsize(model_path)
+    except OSError:
+        size = 0
+    return {"path": model_path, "size_bytes": size, "id": _digest(os.path.basename(model_path), size)}
+
+
+def profile_path(model_path: Optional[str] = None) -> Path:
+    """Fichier de profil de cette machine pour ce modèle"""
+    model_path = model_path or Config.LLAMA_CONFIG["model_path"]
+    backend = Config.BACKEND_CONFIG["type"]
+    name = f"{host_fingerprint()['id']}-{model_fingerprint(model_path)['id']}"
+    if backend != "llama_cpp":
+        name += f"-{backend}"
+    return Path(Config.AUTOTUNE_CONFIG["profile_dir"]) / f"{name}.json"
+
+
+def load_profile(model_path: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    """Profil enregistré pour cette machine et ce modèle (None si absent ou illisible)"""
+    path = profile_path(model_path)
+    try:
+        profile = json.loads(path.read_text())
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logger.warning(f"Profil de réglage illisible {path}: {e}")
+        return None
+    if profile.get("version") != _PROFILE_VERSION:
+        return None
+    return profile
+
+
+def apply_profile(model_path: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    """Applique le profil mesuré à la configuration ; à défaut, les règles matérielles de Config"""
+    profile = load_profile(model_path)
+    if profile is None:
+        logger.info("⚙️ Aucun profil de réglage pour cette machine (python autotune.py), règles par défaut")
+        Config.optimize_for_hardware()
+        return None
+
+    settings = profile["settings"]
+    for key in ("n_threads", "n_threads_batch", "n_batch", "n_ctx"):
+        Config.LLAMA_CONFIG[key] = settings[key]
+    Config.HARDWARE_CONFIG["cpu_threads"] = settings["n_threads"]
+    Config.HARDWARE_CONFIG["batch_size"] = settings["n_batch"]
+    Config.HARDWARE_CONFIG["context_size"] = settings["n_ctx"]
+    logger.info(
+        f"⚙️ Profil de réglage appliqué ({profile['created']}): threads {settings['n_threads']}"
+        f"/{settings['n_threads_batch']}, batch {settings['n_batch']}, contexte {settings['n_ctx']}"
+    )
+    return profile
+
+
+class AutoTuner:
+    """Micro-benchmarks de prefill et de décodage sur le modèle réel"""
+
+    def __init__(self, model_path: str, prompt_tokens: int = 256, decode_tokens: int = 32, repeats: int = 2,
+                 batch_sizes: Tuple[int, ...] = (128, 256, 512, 1024), thread_counts: Optional[List[int]] = None,
+                 tolerance: float = 0.03, memory_fraction: float = 0.8):
+        self.model_path = model_path
+        self.batch_sizes = tuple(sorted(batch_sizes))
+        # Un prompt plus court que n_batch tient en un seul lot : tous les n_batch plus grands mesureraient
+        # le même travail et le plus petit serait toujours retenu
+        self.prompt_tokens = max(prompt_tokens, self.batch_sizes[-1])
+        self.decode_tokens = decode_tokens
+        self.repeats = repeats
+        self.thread_counts = thread_counts or self.default_thread_counts()
+        self.tolerance = tolerance
+        self.memory_fraction = memory_fraction
+        self.measurements: List[Dict[str, Any]] = []
+        self.kv_bytes_per_token = 0.0
+
+    @staticmethod
+    def default_thread_counts() -> List[int]:
+        """1, puissances de 2, cœurs physiques (±1) et logiques"""
+        physical = psutil.cpu_count(logical=False) or 1
+        logical = psutil.cpu_count(logical=True) or physical
+        if cpu_affinity.active:
+            # Mesures sur les seuls cœurs de calcul de la partition
+            physical = logical = len(cpu_affinity.inference_cpus)
+        counts = {1, physical, max(1, physical - 1), logical}
+        counts.update(2 ** i for i in range(1, 8) if 2 ** i < logical)
+        return sorted(counts)
+
+    # -- Modèle --------------------------------------------------------------
+
+    def _load(self, n_batch: int):
+        """Charge le modèle avec un n_batch donné (poids en mmap : seul le premier chargement lit le disque)"""
+        n_ctx = self.prompt_tokens + self.decode_tokens + 16
+        config = dict(Config.get_llama_args(), n_ctx=n_ctx, n_batch=n_batch)
+        if Config.BACKEND_CONFIG["type"] == "fake":
+            from fake_backend import load_fake_model
+
+            return load_fake_model(config, dict(Config.BACKEND_CONFIG["fake"], load_time=0.0))
+
+        from llama_cpp import Llama
+
+        return Llama(
+            model_path=self.model_path,
+            n_ctx=n_ctx,
+            n_batch=n_batch,
+            n_gpu_layers=config["n_gpu_layers"],
+            n_threads=max(self.thread_counts),
+            n_threads_batch=max(self.thread_counts),
+            use_mmap=True,
+            verbose=False,
+        )
+
+    @staticmethod
+    def _set_threads(model, n_threads: int, n_threads_batch: int):
+        if getattr(model, "ctx", None) is None:
+            return
+        import llama_cpp
+
+        llama_cpp.llama_set_n_threads(model.ctx, n_threads, n_threads_batch)
+
+    def _prompt(self, model) -> List[int]:
+        tokens: List[int] = []
+        while len(tokens) < self.prompt_tokens:
+            tokens.extend(model.tokenize(_BENCH_TEXT.encode("utf-8"), add_bos=not tokens))
+        return tokens[:self.prompt_tokens]
+
+    def _measure(self, model, prompt: List[int]) -> Tuple[float, float]:
+        """(prompt tokens/s, décodage tokens/s) : médiane des répétitions"""
+        prompt_rates, decode_rates = [], []
+        for _ in range(self.repeats):
+            model.reset()
+            start = time.perf_counter()
+            model.eval(prompt)
+            prompt_rates.append(len(prompt) / (time.perf_counter() - start))
+
+            start = time.perf_counter()
+            for _ in range(self.decode_tokens):
+                model.eval([prompt[-1]])
+            decode_rates.append(self.decode_tokens / (time.perf_counter() - start))
+        return statistics.median(prompt_rates), statistics.median(decode_rates)
+
+    def _measure_kv(self, model, prompt: List[int]):
+        """Taille de l'état KV par token (borne le contexte)"""
+        model.reset()
+        model.eval(prompt)
+        state = model.save_state()
+        self.kv_bytes_per_token = int(state.llama_state_size) / max(1, int(state.n_tokens))
+
+    # -- Balayage ------------------------------------------------------------
+
+    def run(self) -> Dict[str, Any]:
+        """Balaye n_batch × threads et retourne le profil"""
+        started = time.time()
+        for n_batch in self.batch_sizes:
+            model = self._load(n_batch)
+            prompt = self._prompt(model)
+            # Échauffement : pages du modèle en mémoire, caches CPU
+            self._measure(model, prompt[:min(32, len(prompt))])
+            if not self.kv_bytes_per_token:
+                self._measure_kv(model, prompt)
+            for threads in self.thread_counts:
+                self._set_threads(model, threads, threads)
+                prompt_rate, decode_rate = self._measure(model, prompt)
+                self.measurements.append({
+                    "n_batch": n_batch,
+                    "threads": threads,
+                    "prompt_tokens_per_second": round(prompt_rate, 1),
+                    "decode_tokens_per_second": round(decode_rate, 2),
+                })
+                print(f"   n_batch={n_batch:<5} threads={threads:<3} prefill {prompt_rate:8.1f} tok/s"
+                      f" - décodage {decode_rate:6.2f} tok/s")
+            del model
+
+        settings = self.select()
+        return {
+            "version": _PROFILE_VERSION,
+            "created": datetime.now().isoformat(timespec="seconds"),
+            "duration_s": round(time.time() - started, 1),
+            "backend": Config.BACKEND_CONFIG["type"],
+            "host": host_fingerprint(),
+            "model": model_fingerprint(self.model_path),
+            "settings": settings,
+            "kv_bytes_per_token": round(self.kv_bytes_per_token),
+            "measurements": self.measurements,
+        }
+
+    def _cheapest_within_tolerance(self, points: List[Dict[str, Any]], key: str, cost) -> Dict[str, Any]:
+        best = max(p[key] for p in points)
+        candidates = [p for p in points if p[key] >= best * (1 - self.tolerance)]
+        return min(candidates, key=cost)
+
+    def select(self) -> Dict[str, Any]:
+        """Meilleur décodage (n_threads) et meilleur prefill (n_threads_batch, n_batch), au moindre coût"""
+        # Le décodage (un token à la fois) ne dépend pas de n_batch : moyenne sur les batchs
+        by_threads: Dict[int, List[float]] = {}
+        for m in self.measurements:
+            by_threads.setdefault(m["threads"], []).append(m["decode_tokens_per_second"])
+        decode_points = [{"threads": t, "decode": statistics.mean(v)} for t, v in by_threads.items()]
+        decode = self._cheapest_within_tolerance(decode_points, "decode", lambda p: p["threads"])
+        prefill = self._cheapest_within_tolerance(
+            self.measurements, "prompt_tokens_per_second", lambda p: (p["threads"], p["n_batch"])
+        )
+        return {
+            "n_threads": decode["threads"],
+            "n_threads_batch": prefill["threads"],
+            "n_batch": prefill["n_batch"],
+            "n_ctx": self.select_context(),
+            "decode_tokens_per_second": round(decode["decode"], 2),
+            "prompt_tokens_per_second": prefill["prompt_tokens_per_second"],
+        }
+
+    def select_context(self) -> int:
+        """Plus grande puissance de 2 ≤ n_ctx configuré dont le cache KV tient en mémoire"""
+        target = Config.LLAMA_CONFIG["n_ctx"]
+        if not self.kv_bytes_per_token:
+            return target
+        model_bytes = model_fingerprint(self.model_path)["size_bytes"]
+        budget = psutil.virtual_memory().total * self.memory_fraction - model_bytes
+        sequences = max(1, Config.LLAMA_CONFIG["n_parallel"]) * max(1, Config.API_CONFIG["workers"])
+        max_ctx = int(budget / (self.kv_bytes_per_token * sequences)) if budget > 0 else 0
+        n_ctx = 512
+        while n_ctx * 2 <= min(target, max_ctx):
+            n_ctx *= 2
+        return n_ctx
+
+
+def save_profile(profile: Dict[str, Any], model_path: Optional[str] = None) -> Path:
+    path = profile_path(model_path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(".tmp")
+    tmp_path.write_text(json.dumps(profile, indent=2, ensure_ascii=False))
+    os.replace(tmp_path, path)
+    return path
+
+
+def run_autotune(model_path: Optional[str] = None, **overrides) -> Dict[str, Any]:
+    """Mesure, enregistre et retourne le profil de cette machine"""
+    model_path = model_path or Config.LLAMA_CONFIG["model_path"]
+    if Config.BACKEND_CONFIG["type"] == "llama_cpp" and not os.path.exists(model_path):
+        raise FileNotFoundError(f"Modèle non trouvé: {model_path}")
+    config = dict(Config.AUTOTUNE_CONFIG, **overrides)
+    # Même partition des cœurs qu'en service : les threads llama.cpp héritent de cette affinité
+    if cpu_affinity.plan():
+        cpu_affinity.pin_inference()
+    tuner = AutoTuner(
+        model_path,
+        prompt_tokens=config["prompt_tokens"],
+        decode_tokens=config["decode_tokens"],
+        repeats=config["repeats"],
+        batch_sizes=tuple(config["batch_sizes"]),
+        thread_counts=config.get("thread_counts"),
+        tolerance=config["tolerance"],
+        memory_fraction=config["memory_fraction"],
+    )
+    print(f"🔬 Réglage empirique de {model_path}: threads {tuner.thread_counts}, n_batch {list(tuner.batch_sizes)}")
+    profile = tuner.run()
+    path = save_profile(profile, model_path)
+    settings = profile["settings"]
+    print(f"✅ Profil enregistré: {path}")
+    print(f"   n_threads={settings['n_threads']} ({settings['decode_tokens_per_second']} tok/s en décodage)")
+    print(f"   n_threads_batch={settings['n_threads_batch']}, n_batch={settings['n_batch']}"
+          f" ({settings['prompt_tokens_per_second']} tok/s en prefill)")
+    print(f"   n_ctx={settings['n_ctx']} ({profile['kv_bytes_per_token'] / 1024:.0f} KB de cache KV par token)")
+    return profile
+
+
+def main():
+    """Fonction principale"""
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Réglage empirique threads / batch / contexte")
+    parser.add_argument("--model", default=None, help="Modèle GGUF (défaut: LLAMA_CONFIG['model_path'])")
+    parser.add_argument("--threads", type=int, nargs="+", default=None, help="Nombres de threads à mesurer")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=None, help="Valeurs de n_batch à mesurer")
+    parser.add_argument("--prompt-tokens", type=int, default=None, help="Longueur du prompt mesuré")
+    parser.add_argument("--decode-tokens", type=int, default=None, help="Tokens décodés par mesure")
+    parser.add_argument("--show", action="store_true", help="Affiche le profil enregistré sans mesurer")
+
+    args = parser.parse_args()
+
+    if args.show:
+        profile = load_profile(args.model)
+        print(json.dumps(profile, indent=2, ensure_ascii=False) if profile else f"Aucun profil ({profile_path(args.model)})")
+        return
+
+    overrides = {}
+    if args.threads:
+        overrides["thread_counts"] = args.threads
+    if args.batch_sizes:
+        overrides["batch_sizes"] = args.batch_sizes
+    if args.prompt_tokens:
+        overrides["prompt_tokens"] = args.prompt_tokens
+    if args.decode_tokens:
+        overrides["decode_tokens"] = args.decode_tokens
+    run_autotune(args.model, **overrides)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,360 @@
+#!/usr/bin/env python3
+"""
+Batching continu pour l'API Llama.cpp
+
+Plusieurs séquences vivent dans un même contexte llama.cpp (un seq_id par
+slot). À chaque pas de décodage, un seul batch regroupe le token suivant de
+chaque séquence active et des morceaux de prompt des requêtes entrantes ; les
+nouvelles requêtes entrent et les séquences terminées sortent entre deux pas.
+
+Ce contexte porte tout le cache KV (n_ctx réparti entre les slots) : le Llama
+est chargé avec un n_ctx minimal. Limites de ce mode : ni cache de préfixes
+ni instantanés KV de session (save_state) ; une session rejoue son historique
+à chaque tour, sauf la partie encore présente dans le slot qui l'a servie.
+"""
+
+import codecs
+import logging
+import time
+from typing import Dict, List, Optional, Any
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def _common_prefix_length(a: List[int], b: List[int]) -> int:
+    """Longueur du préfixe commun de deux séquences de tokens"""
+    n = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        n += 1
+    return n
+
+
+def _llama_model_pointer(model):
+    """Pointeur llama_model sous-jacent (selon la version de llama-cpp-python)"""
+    inner = getattr(model, "_model", None)
+    if inner is not None and hasattr(inner, "model"):
+        return inner.model
+    return model.model
+
+
+def _kv_seq_rm(llama_cpp, ctx, seq_id: int, p0: int, p1: int):
+    """Retire des positions du cache KV d'une séquence (API memory ou kv_cache)"""
+    if hasattr(llama_cpp, "llama_memory_seq_rm"):
+        llama_cpp.llama_memory_seq_rm(llama_cpp.llama_get_memory(ctx), seq_id, p0, p1)
+    else:
+        llama_cpp.llama_kv_cache_seq_rm(ctx, seq_id, p0, p1)
+
+
+class _Slot:
+    """Séquence du contexte partagé (un seq_id)"""
+
+    def __init__(self, seq_id: int):
+        self.seq_id = seq_id
+        self.job = None
+        self.tokens: List[int] = []  # Tokens présents dans le cache KV
+        self.pending: List[int] = []  # Prompt restant à évaluer
+        self.batch_index = -1  # Position dans le batch du token dont on lit les logits
+        self.last_token: Optional[int] = None
+        self.n_generated = 0
+        self.held_text = ""
+        self.decoder = None
+        self.rng = None
+
+    @property
+    def is_free(self) -> bool:
+        return self.job is None
+
+    @property
+    def n_past(self) -> int:
+        return len(self.tokens)
+
+
+class ContinuousBatchScheduler:
+    """Ordonnanceur de batching continu sur un contexte multi-séquences"""
+
+    def __init__(self, model, n_parallel: int, n_ctx: int, n_batch: int, n_threads: int, n_threads_batch: int):
+        import llama_cpp
+
+        self.llama_cpp = llama_cpp
+        self.model = model
+        self.n_parallel = n_parallel
+        self.n_batch = n_batch
+        self.slot_ctx = n_ctx // n_parallel
+        self.n_vocab = model.n_vocab()
+        self.eos_token = model.token_eos()
+
+        # Contexte dédié : n_seq_max doit couvrir tous les slots
+        params = llama_cpp.llama_context_default_params()
+        params.n_ctx = n_ctx
+        params.n_batch = n_batch
+        params.n_threads = n_threads
+        params.n_threads_batch = n_threads_batch
+        if hasattr(params, "n_seq_max"):
+            params.n_seq_max = n_parallel
+        self.ctx = llama_cpp.llama_new_context_with_model(_llama_model_pointer(model), params)
+        if not self.ctx:
+            raise RuntimeError("Impossible de créer le contexte de batching")
+
+        self.batch = llama_cpp.llama_batch_init(n_batch, 0, n_parallel)
+        self.slots = [_Slot(i) for i in range(n_parallel)]
+
+        # Statistiques
+        self.steps = 0
+        self.tokens_generated = 0
+        self.prompt_tokens_evaluated = 0
+        self.prompt_tokens_reused = 0
+        self.decode_time = 0.0
+        self.max_live_sequences = 0
+
+        logger.info(f"🔀 Batching continu: {n_parallel} séquences x {self.slot_ctx} tokens")
+        logger.info("ℹ️ Batching continu: pas de cache de préfixes ni d'instantanés KV de session (historique rejoué)")
+
+    def close(self):
+        """Libère le batch et le contexte"""
+        if self.batch is not None:
+            self.llama_cpp.llama_batch_free(self.batch)
+            self.batch = None
+        if self.ctx:
+            self.llama_cpp.llama_free(self.ctx)
+            self.ctx = None
+
+    # --- Boucle principale (thread de génération) ---
+
+    def run(self, executor):
+        """Boucle de l'ordonnanceur : admission, décodage, retrait"""
+        while executor.is_accepting:
+            live = [slot for slot in self.slots if not slot.is_free]
+            self._admit(executor, block=not live)
+            if any(not slot.is_free for slot in self.slots):
+                self._step(executor)
+
+        for slot in self.slots:
+            if slot.job is not None:
+                executor.finish_job(slot.job, error=RuntimeError("Serveur arrêté"))
+                slot.job = None
+
+    def _admit(self, executor, block: bool):
+        """Place les requêtes en attente dans les slots libres"""
+        while any(slot.is_free for slot in self.slots):
+            job = executor.next_job(block=block)
+            if job is None:
+                return
+            block = False
+
+            try:
+                executor.prepare_job(job)
+                if len(job.prompt_tokens) >= self.slot_ctx:
+                    raise ValueError(
+                        f"Prompt trop long ({len(job.prompt_tokens)} tokens, {self.slot_ctx} max par séquence)"
+                    )
+            except Exception as e:
+                executor.finish_job(job, error=e)
+                continue
+
+            self._assign(job)
+
+    def _assign(self, job):
+        """Associe un job au slot libre dont le cache KV partage le plus long préfixe"""
+        free_slots = [slot for slot in self.slots if slot.is_free]
+        slot = max(free_slots, key=lambda s: _common_prefix_length(s.tokens, job.prompt_tokens))
+
+        # Réutilisation du préfixe déjà présent (au moins un token à évaluer pour les logits)
+        n_keep = max(0, min(_common_prefix_length(slot.tokens, job.prompt_tokens), len(job.prompt_tokens) - 1))
+        _kv_seq_rm(self.llama_cpp, self.ctx, slot.seq_id, n_keep, -1)
+        slot.tokens = slot.tokens[:n_keep]
+        slot.pending = list(job.prompt_tokens[n_keep:])
+        self.prompt_tokens_reused += n_keep
+        job.prompt_tokens_cached = n_keep
+
+        slot.job = job
+        slot.last_token = None
+        slot.n_generated = 0
+        slot.held_text = ""
+        slot.decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+        seed = job.params.get("seed")
+        slot.rng = np.random.default_rng(seed if seed is not None and seed >= 0 else None)
+
+        live = sum(1 for s in self.slots if not s.is_free)
+        self.max_live_sequences = max(self.max_live_sequences, live)
+
+    def _step(self, executor):
+        """Un pas de décodage sur toutes les séquences actives"""
+        batch = self.batch
+        batch.n_tokens = 0
+
+        # Séquences interrompues (client déconnecté, échéance...) : slot libéré sans décoder
+        for slot in self.slots:
+            if slot.job is not None and (slot.job.interrupt_reason or slot.job.check_deadline()):
+                self._release(executor, slot, finish_reason=slot.job.interrupt_reason)
+
+        # Token suivant des séquences en génération
+        for slot in self.slots:
+            slot.batch_index = -1
+            if slot.job is not None and not slot.pending and slot.last_token is not None:
+                slot.batch_index = self._batch_add(slot.last_token, slot.n_past, slot.seq_id, True)
+                slot.tokens.append(slot.last_token)
+
+        # Morceaux de prompt des séquences en cours de préremplissage
+        for slot in self.slots:
+            budget = self.n_batch - batch.n_tokens
+            if slot.job is None or not slot.pending or budget <= 0:
+                continue
+            chunk = slot.pending[:budget]
+            slot.pending = slot.pending[budget:]
+            for i, token in enumerate(chunk):
+                is_last = not slot.pending and i == len(chunk) - 1
+                index = self._batch_add(token, slot.n_past, slot.seq_id, is_last)
+                slot.tokens.append(token)
+                if is_last:
+                    slot.batch_index = index
+            self.prompt_tokens_evaluated += len(chunk)
+
+        if batch.n_tokens == 0:
+            return
+
+        start = time.time()
+        rc = self.llama_cpp.llama_decode(self.ctx, batch)
+        self.decode_time += time.time() - start
+        self.steps += 1
+
+        if rc != 0:
+            error = RuntimeError(f"llama_decode a échoué (code {rc})")
+            for slot in self.slots:
+                if slot.job is not None:
+                    self._release(executor, slot, error=error)
+            return
+
+        # Échantillonnage et diffusion des tokens
+        for slot in self.slots:
+            if slot.job is None or slot.batch_index < 0:
+                continue
+            logits_ptr = self.llama_cpp.llama_get_logits_ith(self.ctx, slot.batch_index)
+            logits = np.ctypeslib.as_array(logits_ptr, shape=(self.n_vocab,))
+            token = self._sample(slot, logits)
+            self._accept(executor, slot, token)
+
+    def _batch_add(self, token: int, pos: int, seq_id: int, want_logits: bool) -> int:
+        """Ajoute un token au batch et retourne son index"""
+        batch = self.batch
+        i = batch.n_tokens
+        batch.token[i] = token
+        batch.pos[i] = pos
+        batch.n_seq_id[i] = 1
+        batch.seq_id[i][0] = seq_id
+        batch.logits[i] = want_logits
+        batch.n_tokens += 1
+        return i
+
+    def _sample(self, slot: _Slot, logits: np.ndarray) -> int:
+        """Échantillonnage (glouton si température nulle, sinon top-k/top-p)"""
+        params = slot.job.params
+        temperature = params.get("temperature", 0.8)
+
+        repeat_penalty = params.get("repeat_penalty", 1.0)
+        if repeat_penalty != 1.0 and slot.tokens:
+            logits = logits.copy()
+            recent = np.unique(np.asarray(slot.tokens[-params.get("repeat_last_n", 64):], dtype=np.int64))
+            values = logits[recent]
+            logits[recent] = np.where(values > 0, values / repeat_penalty, values * repeat_penalty)
+
+        if temperature <= 0:
+            return int(np.argmax(logits))
+
+        top_k = params.get("top_k", 40)
+        top_p = params.get("top_p", 0.95)
+        if 0 < top_k < len(logits):
+            candidates = np.argpartition(logits, -top_k)[-top_k:]
+        else:
+            candidates = np.arange(len(logits))
+
+        scaled = logits[candidates].astype(np.float64) / temperature
+        order = np.argsort(-scaled)
+        candidates = candidates[order]
+        probs = np.exp(scaled[order] - scaled[order[0]])
+        probs /= probs.sum()
+
+        if top_p < 1.0:
+            cutoff = int(np.searchsorted(np.cumsum(probs), top_p)) + 1
+            candidates = candidates[:cutoff]
+            probs = probs[:cutoff] / probs[:cutoff].sum()
+
+        return int(slot.rng.choice(candidates, p=probs))
+
+    def _accept(self, executor, slot: _Slot, token: int):
+        """Traite un token échantillonné : texte, arrêts, limites"""
+        job = slot.job
+        job.mark_token()
+        slot.n_generated += 1
+        job.completion_tokens = slot.n_generated
+        self.tokens_generated += 1
+
+        if token == self.eos_token:
+            self._release(executor, slot, finish_reason="stop")
+            return
+
+        slot.last_token = token
+        slot.held_text += slot.decoder.decode(self.model.detokenize([token]))
+
+        # Séquences d'arrêt : on retient le texte qui pourrait en être le début
+        stops = job.params.get("stop") or []
+        for stop in stops:
+            index = slot.held_text.find(stop)
+            if index >= 0:
+                if index > 0:
+                    job.emit_text(slot.held_text[:index])
+                slot.held_text = ""
+                self._release(executor, slot, finish_reason="stop")
+                return
+
+        hold = 0
+        for stop in stops:
+            for n in range(min(len(stop) - 1, len(slot.held_text)), 0, -1):
+                if slot.held_text.endswith(stop[:n]):
+                    hold = max(hold, n)
+                    break
+        emit = slot.held_text[:len(slot.held_text) - hold]
+        if emit:
+            job.emit_text(emit)
+            slot.held_text = slot.held_text[len(emit):]
+
+        stop_reason = job.stop_reason()
+        if stop_reason:
+            self._release(executor, slot, finish_reason=stop_reason)
+        elif slot.n_past + 1 >= self.slot_ctx:
+            self._release(executor, slot, finish_reason="length")
+
+    def _release(self, executor, slot: _Slot, finish_reason: Optional[str] = None, error: Optional[Exception] = None):
+        """Retire la séquence terminée ; son cache KV reste disponible pour un préfixe commun"""
+        job = slot.job
+        slot.job = None
+        slot.pending = []
+        slot.last_token = None
+
+        if error is not None:
+            # État KV incertain : on repart de zéro pour ce slot
+            _kv_seq_rm(self.llama_cpp, self.ctx, slot.seq_id, 0, -1)
+            slot.tokens = []
+            executor.finish_job(job, error=error)
+            return
+
+        if slot.held_text:
+            job.emit_text(slot.held_text)
+            slot.held_text = ""
+        executor.finish_job(job, finish_reason=finish_reason)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Statistiques du batching continu"""
+        return {
+            "n_parallel": self.n_parallel,
+            "live_sequences": sum(1 for slot in self.slots if not slot.is_free),
+            "max_live_sequences": self.max_live_sequences,
+            "steps": self.steps,
+            "tokens_generated": self.tokens_generated,
+            "prompt_tokens_evaluated": self.prompt_tokens_evaluated,
+            "prompt_tokens_reused": self.prompt_tokens_reused,
+            "aggregate_tokens_per_second": round(self.tokens_generated / self.decode_time, 2) if self.decode_time else 0,
+        }
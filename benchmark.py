@@ -0,0 +1,480 @@
+#!/usr/bin/env python3
+"""
+Banc de charge pour l'API Llama.cpp
+
+Rejoue un fichier de charge JSON lines contre le serveur et mesure ce que
+voit le client : temps jusqu'au premier token, latence inter-tokens, latence
+de bout en bout (p50/p95/p99), débit en tokens/s et taux d'erreurs, de 429
+et de 503. Deux modes :
+    - open : arrivées de Poisson à un débit fixé, indépendantes des réponses
+    - closed : N clients concurrents, chacun enchaîne ses requêtes
+Transports : http (/v1/chat/completions), sse (/v1/chat/completions/stream)
+et ws (/ws/chat). Le rapport JSON peut être enregistré comme référence et
+comparé aux exécutions suivantes pour détecter une régression avant un
+déploiement (code de sortie 1).
+
+Chaque ligne du fichier de charge est un objet JSON avec "messages", ou
+"prompt", ou "title"/"body" (format du backlog requests.jsonl) ; les champs
+max_tokens, temperature, seed, system_prompt et transport sont optionnels.
+
+Les réponses rejouées par le cache de réponses ("timings": null) comptent
+dans la latence et le TTFT mais pas dans les débits en tokens ni la latence
+inter-tokens : elles arrivent en une seule trame, sans décodage.
+"""
+
+import asyncio
+import json
+import random
+import sys
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Any
+
+import httpx
+import numpy as np
+import websockets
+
+TRANSPORTS = ("http", "sse", "ws")
+
+# Indicateurs comparés à la référence : (chemin dans le rapport, sens favorable)
+COMPARED_METRICS = {
+    "latency.p50": "lower",
+    "latency.p95": "lower",
+    "latency.p99": "lower",
+    "time_to_first_token.p50": "lower",
+    "time_to_first_token.p95": "lower",
+    "inter_token_latency.p50": "lower",
+    "inter_token_latency.p95": "lower",
+    "throughput.output_tokens_per_second": "higher",
+    "throughput.requests_per_second": "higher",
+    "error_rate": "lower",
+    "rate_limited_rate": "lower",
+}
+
+# Écart absolu toléré sur les taux (une requête en erreur sur cent n'est pas une régression)
+_RATE_TOLERANCE = 0.01
+
+
+def load_workload(path: str, max_tokens: Optional[int] = None) -> List[Dict[str, Any]]:
+    """Lit un fichier de charge JSON lines"""
+    items = []
+    with open(path, "r") as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            entry = json.loads(line)
+            if "messages" in entry:
+                messages = entry["messages"]
+            elif "prompt" in entry:
+                messages = [{"role": "user", "content": entry["prompt"]}]
+            elif "body" in entry:
+                title = entry.get("title")
+                messages = [{"role": "user", "content": f"{title}\n\n{entry['body']}" if title else entry["body"]}]
+            else:
+                raise ValueError(f"{path}:{line_number}: ni messages, ni prompt, ni body")
+            item = {"messages": messages, "max_tokens": max_tokens or entry.get("max_tokens", 256)}
+            for field in ("temperature", "seed", "system_prompt", "transport"):
+                if entry.get(field) is not None:
+                    item[field] = entry[field]
+            items.append(item)
+    if not items:
+        raise ValueError(f"Fichier de charge vide: {path}")
+    return items
+
+
+def _percentiles(values: List[float], scale: float = 1000.0) -> Dict[str, Any]:
+    """Nombre, moyenne et percentiles (en ms par défaut)"""
+    if not values:
+        return {"count": 0}
+    array = np.asarray(values, dtype=np.float64) * scale
+    p50, p95, p99 = np.percentile(array, (50, 95, 99))
+    return {
+        "count": len(values),
+        "avg": round(float(array.mean()), 2),
+        "min": round(float(array.min()), 2),
+        "max": round(float(array.max()), 2),
+        "p50": round(float(p50), 2),
+        "p95": round(float(p95), 2),
+        "p99": round(float(p99), 2),
+    }
+
+
+def _lookup(report: Dict[str, Any], path: str) -> Optional[float]:
+    value: Any = report
+    for key in path.split("."):
+        if not isinstance(value, dict) or key not in value:
+            return None
+        value = value[key]
+    return value if isinstance(value, (int, float)) else None
+
+
+def compare_reports(current: Dict[str, Any], baseline: Dict[str, Any], tolerance: float) -> Dict[str, Any]:
+    """Écart de chaque indicateur à la référence ; régression au-delà de la tolérance relative"""
+    comparison = {}
+    for path, direction in COMPARED_METRICS.items():
+        base, value = _lookup(baseline, path), _lookup(current, path)
+        if base is None or value is None:
+            continue
+        worse = value - base if direction == "lower" else base - value
+        if path.endswith("_rate"):
+            regression = worse > _RATE_TOLERANCE
+        else:
+            regression = base > 0 and worse / base > tolerance
+        comparison[path] = {
+            "baseline": base,
+            "current": value,
+            "change": round((value - base) / base, 4) if base else None,
+            "regression": regression,
+        }
+    return comparison
+
+
+class RequestResult:
+    """Mesures côté client d'une requête"""
+
+    __slots__ = ("transport", "status", "error", "started", "first_token", "last_token",
+                 "finished", "frames", "completion_tokens", "server_timings", "cached")
+
+    def __init__(self, transport: str):
+        self.transport = transport
+        self.status = 0
+        self.error: Optional[str] = None
+        self.started = time.perf_counter()
+        self.first_token: Optional[float] = None
+        self.last_token: Optional[float] = None
+        self.finished: Optional[float] = None
+        self.frames = 0
+        self.completion_tokens = 0
+        self.server_timings: Optional[Dict[str, Any]] = None
+        self.cached = False  # Réponse rejouée par le cache de réponses
+
+    def on_timings(self, message: Dict[str, Any]):
+        """Trame finale : timings serveur, ou null explicite pour une réponse rejouée du cache"""
+        if "timings" not in message:
+            return
+        self.server_timings = message["timings"]
+        if self.server_timings is None:
+            self.cached = True
+        else:
+            self.completion_tokens = self.server_timings.get("completion_tokens", self.completion_tokens)
+
+    def on_content(self):
+        now = time.perf_counter()
+        if self.first_token is None:
+            self.first_token = now
+        self.last_token = now
+        self.frames += 1
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None and self.status == 200
+
+    @property
+    def latency(self) -> Optional[float]:
+        return self.finished - self.started if self.finished is not None else None
+
+    @property
+    def ttft(self) -> Optional[float]:
+        return self.first_token - self.started if self.first_token is not None else None
+
+    @property
+    def inter_token_latency(self) -> Optional[float]:
+        """Latence inter-tokens moyenne vue du client (les trames regroupent plusieurs tokens)"""
+        if self.first_token is None or self.completion_tokens < 2:
+            return None
+        return (self.last_token - self.first_token) / (self.completion_tokens - 1)
+
+
+class LoadGenerator:
+    """Rejoue une charge en boucle ouverte ou fermée et agrège les mesures"""
+
+    def __init__(self, base_url: str, workload: List[Dict[str, Any]], transport: str = "sse",
+                 timeout: float = 300.0, seed: int = 0):
+        self.base_url = base_url.rstrip("/")
+        self.ws_url = "ws" + self.base_url[4:] + "/ws/chat" if self.base_url.startswith("http") else self.base_url
+        self.workload = workload
+        self.transport = transport
+        self.timeout = timeout
+        self.random = random.Random(seed)
+        self.results: List[RequestResult] = []
+        self._client: Optional[httpx.AsyncClient] = None
+
+    # -- Requêtes ------------------------------------------------------------
+
+    def _payload(self, item: Dict[str, Any]) -> Dict[str, Any]:
+        return {key: value for key, value in item.items() if key != "transport"}
+
+    async def _request(self, item: Dict[str, Any]) -> RequestResult:
+        transport = item.get("transport", self.transport)
+        result = RequestResult(transport)
+        try:
+            if transport == "http":
+                await self._http(item, result)
+            elif transport == "sse":
+                await self._sse(item, result)
+            else:
+                await self._ws(item, result)
+        except Exception as e:
+            result.error = result.error or f"{type(e).__name__}: {e}"
+        result.finished = time.perf_counter()
+        self.results.append(result)
+        return result
+
+    async def _http(self, item: Dict[str, Any], result: RequestResult):
+        payload = dict(self._payload(item), stream=False)
+        response = await self._client.post(f"{self.base_url}/v1/chat/completions", json=payload)
+        result.status = response.status_code
+        if response.status_code != 200:
+            result.error = response.text[:200]
+            return
+        body = response.json()
+        result.on_content()  # Pas de streaming : premier token = réponse complète
+        result.completion_tokens = body.get("usage", {}).get("completion_tokens", 0)
+        result.on_timings(body)
+
+    async def _sse(self, item: Dict[str, Any], result: RequestResult):
+        payload = dict(self._payload(item), stream=True)
+        async with self._client.stream("POST", f"{self.base_url}/v1/chat/completions/stream", json=payload) as response:
+            result.status = response.status_code
+            if response.status_code != 200:
+                result.error = (await response.aread()).decode("utf-8", errors="replace")[:200]
+                return
+            async for line in response.aiter_lines():
+                if not line.startswith("data: "):
+                    continue
+                data = line[6:]
+                if data == "[DONE]":
+                    break
+                self._on_chunk(json.loads(data), result)
+
+    async def _ws(self, item: Dict[str, Any], result: RequestResult):
+        async with websockets.connect(self.ws_url, max_size=None, open_timeout=self.timeout) as websocket:
+            await websocket.send(json.dumps(self._payload(item)))
+            result.status = 200
+            while True:
+                message = json.loads(await asyncio.wait_for(websocket.recv(), self.timeout))
+                if message.get("done"):
+                    result.on_timings(message)
+                    break
+                if "error" in message:
+                    result.status = message.get("status", 500)
+                    result.error = str(message["error"])[:200]
+                    break
+                self._on_chunk(message, result)
+
+    @staticmethod
+    def _on_chunk(chunk: Dict[str, Any], result: RequestResult):
+        if "error" in chunk:
+            result.error = str(chunk["error"])[:200]
+            return
+        delta = chunk.get("choices", [{}])[0].get("delta", {})
+        if delta.get("content"):
+            result.on_content()
+            # À défaut de timings serveur, une trame compte pour au moins un token
+            result.completion_tokens += 1
+        result.on_timings(chunk)
+
+    # -- Boucles de charge ---------------------------------------------------
+
+    def _next_item(self, index: int) -> Dict[str, Any]:
+        return self.workload[index % len(self.workload)]
+
+    async def run_open(self, rate: float, n_requests: int, duration: Optional[float] = None):
+        """Boucle ouverte : arrivées de Poisson à `rate` requêtes/s, sans attendre les réponses"""
+        tasks = []
+        start = time.perf_counter()
+        next_arrival = start
+        for index in range(n_requests):
+            next_arrival += self.random.expovariate(rate)
+            if duration is not None and next_arrival - start > duration:
+                break
+            delay = next_arrival - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(self._request(self._next_item(index))))
+        await asyncio.gather(*tasks)
+
+    async def run_closed(self, concurrency: int, n_requests: int, duration: Optional[float] = None):
+        """Boucle fermée : `concurrency` clients, chacun envoie sa requête suivante après la réponse"""
+        counter = iter(range(n_requests))
+        deadline = time.perf_counter() + duration if duration is not None else None
+
+        async def client():
+            for index in counter:
+                if deadline is not None and time.perf_counter() >= deadline:
+                    return
+                await self._request(self._next_item(index))
+
+        await asyncio.gather(*(client() for _ in range(concurrency)))
+
+    async def run(self, mode: str, n_requests: int, rate: float = 1.0, concurrency: int = 1,
+                  duration: Optional[float] = None, warmup: int = 0) -> Dict[str, Any]:
+        """Exécute la charge et retourne le rapport"""
+        limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+        async with httpx.AsyncClient(timeout=self.timeout, limits=limits) as client:
+            self._client = client
+            for index in range(warmup):
+                await self._request(self._next_item(index))
+            self.results.clear()
+
+            started = time.perf_counter()
+            if mode == "open":
+                await self.run_open(rate, n_requests, duration)
+            else:
+                await self.run_closed(concurrency, n_requests, duration)
+            elapsed = time.perf_counter() - started
+
+        return self.report(elapsed, {
+            "base_url": self.base_url,
+            "transport": self.transport,
+            "mode": mode,
+            "rate": rate if mode == "open" else None,
+            "concurrency": concurrency if mode == "closed" else None,
+            "requests": n_requests,
+            "duration": duration,
+            "warmup": warmup,
+            "workload_items": len(self.workload),
+        })
+
+    # -- Rapport -------------------------------------------------------------
+
+    def report(self, elapsed: float, config: Dict[str, Any]) -> Dict[str, Any]:
+        results = self.results
+        ok = [r for r in results if r.ok]
+        total = len(results)
+        statuses: Dict[str, int] = {}
+        for r in results:
+            key = str(r.status) if r.status else "transport_error"
+            statuses[key] = statuses.get(key, 0) + 1
+
+        # Débits et inter-tokens sur les seules réponses décodées (hors cache de réponses)
+        generated = [r for r in ok if not r.cached]
+        output_tokens = sum(r.completion_tokens for r in generated)
+        decode_rates = [
+            (r.completion_tokens - 1) / (r.last_token - r.first_token)
+            for r in generated if r.first_token is not None and r.completion_tokens > 1 and r.last_token > r.first_token
+        ]
+        server_ttft = [r.server_timings["time_to_first_token_ms"] / 1000 for r in ok
+                       if r.server_timings and r.server_timings.get("time_to_first_token_ms") is not None]
+        server_queue = [r.server_timings["queue_wait_ms"] / 1000 for r in ok
+                        if r.server_timings and r.server_timings.get("queue_wait_ms") is not None]
+
+        return {
+            "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "config": config,
+            "elapsed": round(elapsed, 3),
+            "total_requests": total,
+            "successful_requests": len(ok),
+            "cached_requests": len(ok) - len(generated),
+            "status_codes": statuses,
+            "error_rate": round((total - len(ok)) / total, 4) if total else 0.0,
+            "rate_limited_rate": round(statuses.get("429", 0) / total, 4) if total else 0.0,
+            "overloaded_rate": round(statuses.get("503", 0) / total, 4) if total else 0.0,
+            "latency": _percentiles([r.latency for r in ok]),
+            "time_to_first_token": _percentiles([r.ttft for r in ok if r.transport != "http"]),
+            "inter_token_latency": _percentiles([r.inter_token_latency for r in generated
+                                                 if r.transport != "http" and r.inter_token_latency is not None]),
+            "server_time_to_first_token": _percentiles(server_ttft),
+            "server_queue_wait": _percentiles(server_queue),
+            "throughput": {
+                "requests_per_second": round(len(ok) / elapsed, 3) if elapsed > 0 else 0.0,
+                "output_tokens_per_second": round(output_tokens / elapsed, 2) if elapsed > 0 else 0.0,
+                "output_tokens": output_tokens,
+                "per_request_tokens_per_second": _percentiles(decode_rates, scale=1.0),
+            },
+            "errors": sorted({r.error for r in results if r.error})[:10],
+        }
+
+
+def print_summary(report: Dict[str, Any], comparison: Optional[Dict[str, Any]] = None):
+    """Affiche le résumé du rapport (et l'écart à la référence)"""
+    print("\n" + "=" * 60)
+    print("📊 RÉSULTATS DU BANC DE CHARGE")
+    print("=" * 60)
+    config = report["config"]
+    load = f"{config['rate']} req/s (Poisson)" if config["mode"] == "open" else f"{config['concurrency']} clients"
+    print(f"🔧 {config['transport']} - boucle {config['mode']} - {load}")
+    print(f"📨 Requêtes: {report['successful_requests']}/{report['total_requests']} réussies en {report['elapsed']}s"
+          f" (erreurs {report['error_rate']:.1%}, 429 {report['rate_limited_rate']:.1%},"
+          f" 503 {report['overloaded_rate']:.1%})")
+    for title, key in (("Latence", "latency"), ("TTFT", "time_to_first_token"), ("Inter-tokens", "inter_token_latency")):
+        stats = report[key]
+        if stats["count"]:
+            print(f"⏱️ {title}: p50 {stats['p50']}ms - p95 {stats['p95']}ms - p99 {stats['p99']}ms")
+    if report["cached_requests"]:
+        print(f"♻️ {report['cached_requests']} réponse(s) du cache de réponses, hors débits et inter-tokens")
+    throughput = report["throughput"]
+    print(f"⚡ Débit: {throughput['output_tokens_per_second']} tokens/s - {throughput['requests_per_second']} req/s")
+
+    if comparison:
+        print("-" * 60)
+        regressions = [path for path, entry in comparison.items() if entry["regression"]]
+        for path, entry in comparison.items():
+            change = f"{entry['change']:+.1%}" if entry["change"] is not None else "n/a"
+            marker = "❌" if entry["regression"] else "✅"
+            print(f"{marker} {path}: {entry['baseline']} → {entry['current']} ({change})")
+        if regressions:
+            print(f"⚠️ {len(regressions)} régression(s) par rapport à la référence")
+    print("=" * 60)
+
+
+def main():
+    """Fonction principale"""
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Banc de charge de l'API Llama.cpp")
+    parser.add_argument("--url", default="http://127.0.0.1:8000", help="URL du serveur")
+    parser.add_argument("--workload", "-w", default="requests.jsonl", help="Fichier de charge JSON lines")
+    parser.add_argument("--transport", "-t", choices=TRANSPORTS, default="sse",
+                        help="Transport par défaut (une ligne peut le surcharger)")
+    parser.add_argument("--mode", "-m", choices=("open", "closed"), default="closed",
+                        help="Boucle ouverte (Poisson) ou fermée (concurrence fixe)")
+    parser.add_argument("--rate", "-r", type=float, default=1.0, help="Requêtes/s en boucle ouverte")
+    parser.add_argument("--concurrency", "-c", type=int, default=4, help="Clients simultanés en boucle fermée")
+    parser.add_argument("--requests", "-n", type=int, default=None,
+                        help="Nombre de requêtes (défaut: une passe sur le fichier de charge)")
+    parser.add_argument("--duration", "-d", type=float, default=None, help="Durée maximale en secondes")
+    parser.add_argument("--warmup", type=int, default=0, help="Requêtes d'échauffement non mesurées")
+    parser.add_argument("--max-tokens", type=int, default=None, help="Force max_tokens pour toutes les requêtes")
+    parser.add_argument("--timeout", type=float, default=300.0, help="Délai maximal par requête (s)")
+    parser.add_argument("--seed", type=int, default=0, help="Graine des arrivées de Poisson")
+    parser.add_argument("--output", "-o", default="benchmark_report.json", help="Rapport JSON")
+    parser.add_argument("--baseline", "-b", default=None, help="Rapport de référence à comparer")
+    parser.add_argument("--save-baseline", action="store_true", help="Enregistre ce rapport comme référence")
+    parser.add_argument("--tolerance", type=float, default=0.10,
+                        help="Dégradation relative tolérée avant de signaler une régression")
+
+    args = parser.parse_args()
+    # Porte de non-régression : une référence absente ne doit pas passer pour un succès
+    if args.baseline and not args.save_baseline and not Path(args.baseline).exists():
+        parser.error(f"référence introuvable: {args.baseline} (--save-baseline pour la créer)")
+
+    workload = load_workload(args.workload, args.max_tokens)
+    n_requests = args.requests or len(workload)
+    generator = LoadGenerator(args.url, workload, args.transport, args.timeout, args.seed)
+
+    print(f"🚀 Banc de charge: {n_requests} requêtes ({len(workload)} dans {args.workload}) → {args.url}")
+    report = asyncio.run(generator.run(args.mode, n_requests, args.rate, args.concurrency, args.duration, args.warmup))
+
+    comparison = None
+    if args.baseline and not args.save_baseline:
+        baseline = json.loads(Path(args.baseline).read_text())
+        comparison = compare_reports(report, baseline, args.tolerance)
+        report["comparison"] = {"baseline": args.baseline, "tolerance": args.tolerance, "metrics": comparison}
+
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print_summary(report, comparison)
+    print(f"📄 Rapport: {args.output}")
+
+    if args.save_baseline:
+        Path(args.baseline or "benchmark_baseline.json").write_text(json.dumps(report, indent=2, ensure_ascii=False))
+        print(f"📌 Référence enregistrée: {args.baseline or 'benchmark_baseline.json'}")
+
+    if comparison and any(entry["regression"] for entry in comparison.values()):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
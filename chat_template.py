@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+"""
+Rendu des templates de chat et tokenisation des prompts
+
+Le rendu et la tokenisation sont mémorisés : le prompt rendu est gardé par
+empreinte de la conversation, et les tokens par empreinte de chaque segment
+du prompt. Le prompt est découpé juste avant chaque token BOS ou EOS (les
+limites de tours) ; llama.cpp tokenise indépendamment les fragments séparés
+par un token spécial, donc la concaténation des segments est identique à la
+tokenisation du prompt entier et seul le dernier tour est tokenisé à chaque
+nouveau message. Les ids sont stockés en array('i') dans un LRU borné en
+octets, partagé par tous les templates du processus.
+"""
+
+import hashlib
+import json
+import logging
+import re
+import threading
+from array import array
+from collections import OrderedDict
+from typing import Dict, List, Optional, Any, Callable
+
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+# Surcoût mémoire approximatif d'une entrée (clé, objet, nœud LRU)
+_ENTRY_OVERHEAD = 128
+
+
+class _ByteLRU:
+    """LRU borné par la taille cumulée de ses valeurs"""
+
+    def __init__(self, max_bytes: int, sizeof: Callable[[Any], int]):
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.bytes = 0
+        self._entries: "OrderedDict[bytes, Any]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: bytes) -> Optional[Any]:
+        value = self._entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key: bytes, value: Any):
+        size = self.sizeof(value) + _ENTRY_OVERHEAD
+        if size > self.max_bytes:
+            return
+        previous = self._entries.pop(key, None)
+        if previous is not None:
+            self.bytes -= self.sizeof(previous) + _ENTRY_OVERHEAD
+        self._entries[key] = value
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.bytes -= self.sizeof(evicted) + _ENTRY_OVERHEAD
+
+    def clear(self):
+        self._entries.clear()
+        self.bytes = 0
+
+    def get_stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+        }
+
+
+def _digest(data: str) -> bytes:
+    return hashlib.blake2b(data.encode("utf-8"), digest_size=16).digest()
+
+
+class TokenizationCache:
+    """Mémorisation du rendu des conversations et des tokens des segments de prompt"""
+
+    def __init__(self, max_bytes: int, render_max_bytes: int):
+        self.tokens = _ByteLRU(max_bytes, lambda ids: ids.itemsize * len(ids))
+        self.renders = _ByteLRU(render_max_bytes, len)
+        self._lock = threading.Lock()
+
+    def get_render(self, key: bytes) -> Optional[str]:
+        with self._lock:
+            return self.renders.get(key)
+
+    def put_render(self, key: bytes, prompt: str):
+        with self._lock:
+            self.renders.put(key, prompt)
+
+    def get_tokens(self, key: bytes) -> Optional[array]:
+        with self._lock:
+            return self.tokens.get(key)
+
+    def put_tokens(self, key: bytes, ids: array):
+        with self._lock:
+            self.tokens.put(key, ids)
+
+    def clear(self):
+        with self._lock:
+            self.tokens.clear()
+            self.renders.clear()
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Statistiques des caches de tokens et de rendu"""
+        with self._lock:
+            return {
+                "enabled": Config.TOKENIZER_CACHE_CONFIG["enabled"],
+                "tokens": self.tokens.get_stats(),
+                "renders": self.renders.get_stats(),
+            }
+
+
+class ChatTemplate:
+    """Template de chat du modèle (métadonnées GGUF ou format Llama-2)"""
+
+    def __init__(self, model):
+        self.model = model
+        self.bos_token = self._token_text(model.token_bos())
+        self.eos_token = self._token_text(model.token_eos())
+        self._jinja_template = None
+        boundaries = [re.escape(token) for token in (self.bos_token, self.eos_token) if token]
+        self._segment_pattern = re.compile(f"(?=(?:{'|'.join(boundaries)}))") if boundaries else None
+
+        metadata = getattr(model, "metadata", None) or {}
+        template_source = metadata.get("tokenizer.chat_template")
+        if template_source:
+            try:
+                from jinja2.sandbox import ImmutableSandboxedEnvironment
+
+                env = ImmutableSandboxedEnvironment(trim_blocks=True, lstrip_blocks=True)
+                env.globals["raise_exception"] = self._raise_exception
+                self._jinja_template = env.from_string(template_source)
+                logger.info("💬 Template de chat chargé depuis les métadonnées GGUF")
+            except Exception as e:
+                logger.warning(f"Template de chat GGUF invalide, format Llama-2 utilisé: {e}")
+
+    def _token_text(self, token_id: int) -> str:
+        """Texte d'un token spécial (<s>, </s>...)"""
+        if token_id is None or token_id < 0:
+            return ""
+        try:
+            return self.model._model.token_get_text(token_id)
+        except AttributeError:
+            return self.model.detokenize([token_id]).decode("utf-8", errors="ignore")
+
+    @staticmethod
+    def _raise_exception(message: str):
+        raise ValueError(message)
+
+    def render(self, messages: List[Dict[str, str]]) -> str:
+        """Construit le prompt texte à partir des messages"""
+        if self._jinja_template is not None:
+            return self._jinja_template.render(
+                messages=messages,
+                bos_token=self.bos_token,
+                eos_token=self.eos_token,
+                add_generation_prompt=True,
+            )
+        return self._render_llama2(messages)
+
+    def _render_llama2(self, messages: List[Dict[str, str]]) -> str:
+        """Format [INST] de Llama-2 / Mistral"""
+        system_prompt: Optional[str] = None
+        prompt = ""
+        pending_user: Optional[str] = None
+
+        for message in messages:
+            role = message["role"]
+            content = message["content"].strip()
+            if role == "system":
+                system_prompt = content
+            elif role == "user":
+                if system_prompt is not None:
+                    content = f"<<SYS>>\n{system_prompt}\n<</SYS>>\n\n{content}"
+                    system_prompt = None
+                pending_user = content
+                prompt += f"{self.bos_token}[INST] {content} [/INST]"
+            elif role == "assistant" and pending_user is not None:
+                prompt += f" {content}{self.eos_token}"
+                pending_user = None
+
+        return prompt
+
+    def render_cached(self, messages: List[Dict[str, str]]) -> str:
+        """Rendu mémorisé par empreinte de la conversation"""
+        if not Config.TOKENIZER_CACHE_CONFIG["enabled"]:
+            return self.render(messages)
+        key = _digest(json.dumps([[m["role"], m["content"]] for m in messages], ensure_ascii=False))
+        prompt = tokenization_cache.get_render(key)
+        if prompt is None:
+            prompt = self.render(messages)
+            tokenization_cache.put_render(key, prompt)
+        return prompt
+
+    def _segments(self, prompt: str) -> List[str]:
+        """Découpe le prompt juste avant chaque token BOS ou EOS"""
+        if self._segment_pattern is None:
+            return [prompt]
+        return [segment for segment in self._segment_pattern.split(prompt) if segment]
+
+    def tokenize_text(self, prompt: str) -> List[int]:
+        """Tokenise un prompt rendu (tokens spéciaux inclus), segment par segment via le cache"""
+        if not Config.TOKENIZER_CACHE_CONFIG["enabled"]:
+            return self.model.tokenize(prompt.encode("utf-8"), add_bos=False, special=True)
+        tokens: List[int] = []
+        for segment in self._segments(prompt):
+            key = _digest(segment)
+            ids = tokenization_cache.get_tokens(key)
+            if ids is None:
+                ids = array("i", self.model.tokenize(segment.encode("utf-8"), add_bos=False, special=True))
+                tokenization_cache.put_tokens(key, ids)
+            tokens.extend(ids)
+        return tokens
+
+    def tokenize(self, messages: List[Dict[str, str]]) -> List[int]:
+        """Tokenise le prompt complet (tokens spéciaux inclus)"""
+        return self.tokenize_text(self.render_cached(messages))
+
+
+# Instance globale
+tokenization_cache = TokenizationCache(
+    max_bytes=Config.TOKENIZER_CACHE_CONFIG["max_bytes"],
+    render_max_bytes=Config.TOKENIZER_CACHE_CONFIG["render_max_bytes"],
+)
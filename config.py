@@ -98,13 +98,139 @@ class Config:
         "max_tokens_per_request": 4096,
     }
     
+    # Configuration du contrôle d'admission (devant l'exécuteur de génération)
+    ADMISSION_CONFIG = {
+        "enabled": True,
+        "tokens_per_request": 1024,  # Poids d'une requête : rate_limit × tokens_per_request tokens/min par client
+        "max_queue_depth": 32,  # Requêtes en attente, tous slots confondus, avant 503
+        "max_estimated_wait": 30.0,  # Attente estimée (secondes) au-delà de laquelle on refuse (503)
+    }
+    
     # Configuration des logs
     LOGGING_CONFIG = {
         "level": "INFO",
         "format": "%(asctime)s - %(name)s - %(levelname)s - %(message)s",
         "file": "logs/api.log",
-        "max_size": 10 * 1024 * 1024,  # 10MB
+        "max_size": 10 * 1024 * 1024,  # 10MB, rotation par fichier
         "backup_count": 5,
+        "json_lines": True,  # Un objet JSON par ligne dans les fichiers (console en texte)
+        "queue_size": 10000,  # Enregistrements en attente d'écriture avant perte
+        "sample_rate": 0.1,  # Part des logs INFO par requête conservés (1.0 = tous)
+    }
+    
+    # Configuration de l'échantillonnage système (thread de fond, lu par /health et les logs)
+    SYSTEM_SAMPLER_CONFIG = {
+        "interval": 1.0,  # Secondes entre deux relevés
+        "history": 600,  # Relevés gardés en mémoire (10 minutes à 1s)
+    }
+
+    # Partition des cœurs (topologie lue dans /sys) : calcul llama.cpp d'un côté, service HTTP et logs de l'autre
+    AFFINITY_CONFIG = {
+        "enabled": True,  # Sans effet s'il y a moins de 2 cœurs physiques
+        "serving_cores": 1,  # Cœurs physiques réservés à uvicorn, aux logs et à l'échantillonnage
+        "inference_cores": None,  # Cœurs physiques du calcul (None = tous ceux du nœud NUMA choisi)
+        "numa_node": None,  # Nœud NUMA du calcul (None = celui qui a le plus de cœurs)
+        "smt_for_inference": False,  # Utiliser aussi les frères hyperthreads pour le calcul
+    }
+    
+    # Configuration du stockage colonnaire des mesures de performance (une ligne binaire par génération)
+    PERF_STORE_CONFIG = {
+        "enabled": True,
+        "directory": "logs/perf",  # Segments journaliers perf-AAAAMMJJ.bin
+        "retention_days": 90,
+    }
+    
+    # Configuration de l'index incrémental des logs (diagnose_performance.py)
+    LOG_INDEX_CONFIG = {
+        "logs_dir": "logs",
+        "path": "logs/index/log_index.json",  # Positions lues et agrégats horaires
+        "retention_days": 90,  # Agrégats horaires conservés
+        "recent_errors": 50,  # Dernières erreurs gardées en détail
+    }
+
+    # Configuration du réglage empirique (autotune.py) : profil mesuré par machine et par modèle
+    AUTOTUNE_CONFIG = {
+        "profile_dir": "profiles",  # <machine>-<modèle>.json, chargé au démarrage
+        "prompt_tokens": 256,  # Longueur du prompt mesuré (prefill), portée au plus grand n_batch balayé
+        "decode_tokens": 32,  # Tokens décodés par mesure
+        "repeats": 2,  # Mesures par réglage (médiane)
+        "batch_sizes": (128, 256, 512, 1024),  # Valeurs de n_batch balayées
+        "tolerance": 0.03,  # Écart au meilleur débit toléré pour un réglage plus économe
+        "memory_fraction": 0.8,  # Part de la RAM utilisable par les poids et le cache KV
+    }
+    
+    # Backend d'inférence : "llama_cpp" (modèle GGUF) ou "fake" (synthétique, sans modèle, pour les bancs d'essai)
+    BACKEND_CONFIG = {
+        "type": os.environ.get("LLAMA_BACKEND", "llama_cpp"),
+        "fake": {
+            "prompt_tokens_per_second": 500.0,  # Durée simulée du prefill
+            "decode_tokens_per_second": 25.0,  # Durée simulée du décodage
+            "response_tokens": (32, 256),  # Longueur naturelle des réponses (bornes, tirage déterministe)
+            "n_vocab": 32000,
+            "state_bytes_per_token": 1024,  # Taille simulée des états KV (cache de préfixes, sessions)
+            "load_time": 0.0,  # Durée simulée du chargement
+            "seed": 0,
+        },
+    }
+    
+    # Configuration de l'exécuteur de génération
+    GENERATION_CONFIG = {
+        "max_queue_size": 64,  # Requêtes en attente avant refus (503)
+        "batching": True,  # Batching continu si n_parallel > 1
+        "coalesce_identical": True,  # Une seule génération pour les requêtes déterministes identiques en cours
+    }
+    
+    # Configuration de la fenêtre de contexte (historique ajusté à n_ctx avant le prefill)
+    CONTEXT_CONFIG = {
+        "policy": "pin_system",  # drop_oldest, pin_system ou keep_first_last
+        "keep_first": 1,  # Tours conservés en tête (keep_first_last)
+        "keep_last": 4,  # Tours conservés en fin, question en cours comprise (keep_first_last)
+        "token_count_cache_size": 4096,  # Comptes de tokens par message gardés en cache
+    }
+    
+    # Configuration du cache de tokenisation (rendu du template et tokens des segments de prompt)
+    TOKENIZER_CACHE_CONFIG = {
+        "enabled": True,
+        "max_bytes": 64 * 1024 * 1024,  # Ids de tokens en RAM (array('i'))
+        "render_max_bytes": 16 * 1024 * 1024,  # Prompts rendus en RAM
+    }
+    
+    # Configuration du pipeline de streaming (SSE / WebSocket)
+    STREAMING_CONFIG = {
+        "coalesce_window_ms": 20,  # Fenêtre de regroupement des tokens par trame
+        "coalesce_max_bytes": 512,  # Trame émise sans attendre au-delà de ce volume
+        "max_pending_bytes": 1024 * 1024,  # Texte en attente par connexion avant déconnexion
+    }
+    
+    # Configuration du cache de préfixes KV (arbre radix)
+    PREFIX_CACHE_CONFIG = {
+        "enabled": True,
+        "max_bytes": 1024 * 1024 * 1024,  # 1GB d'états KV en RAM
+    }
+    
+    # Configuration du stockage disque des états KV
+    KV_STORE_CONFIG = {
+        "enabled": True,
+        "directory": "kv_cache",
+        "max_bytes": 8 * 1024 * 1024 * 1024,  # 8GB sur disque (avec N workers : max_bytes / N chacun dans worker-<i>)
+        "session_spill_after": 300,  # Secondes d'inactivité avant écriture sur disque
+    }
+    
+    # Configuration du décodage spéculatif (génération séquentielle, n_parallel = 1)
+    SPECULATIVE_CONFIG = {
+        "enabled": False,
+        "draft_model_path": "models/tinyllama-1.1b-chat.gguf",  # Même vocabulaire que le modèle principal
+        "num_draft_tokens": 5,  # Tokens proposés par le brouillon à chaque étape (k)
+    }
+    
+    # Configuration du cache de réponses (requêtes déterministes : température 0 ou seed fixé)
+    RESPONSE_CACHE_CONFIG = {
+        "enabled": True,
+        "max_entries": 1024,  # Réponses gardées en RAM (LRU)
+        "ttl": 3600,  # Durée de validité en secondes
+        "disk_enabled": False,  # Second niveau sur disque
+        "directory": "response_cache",
+        "disk_max_entries": 100000,
     }
     
     # Configuration de la mémoire
@@ -114,6 +240,12 @@ class Config:
         "cleanup_interval": 3600,  # 1 heure
     }
     
+    # Configuration des sessions de chat côté serveur (sessions.py)
+    SESSION_CONFIG = {
+        "max_sessions": 64,  # Sessions ouvertes, tous clients confondus (au-delà : éviction LRU)
+        "idle_timeout": 1800,  # Secondes d'inactivité avant suppression d'une session
+    }
+    
     # Configuration du modèle
     DEFAULT_MODEL = "llama-2-7b-chat.gguf"
     MODELS_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -133,6 +265,11 @@ class Config:
     # Configuration du contexte (augmenté pour utiliser plus de capacité)
     CONTEXT_SIZE = 8192  # 8K tokens au lieu de 4K
     
+    @classmethod
+    def uses_continuous_batching(cls) -> bool:
+        """Batching continu actif : les séquences vivent dans le contexte de l'ordonnanceur (batching.py)"""
+        return cls.LLAMA_CONFIG["n_parallel"] > 1 and cls.GENERATION_CONFIG["batching"]
+    
     @classmethod
     def get_llama_args(cls) -> Dict[str, Any]:
         """Retourne les arguments optimisés pour llama.cpp"""
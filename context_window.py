@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""
+Gestion de la fenêtre de contexte pour l'API Llama.cpp
+
+Avant le prefill, l'historique est ajusté pour que prompt + max_tokens tienne
+dans le contexte d'une séquence. Le nombre de tokens de chaque message est
+mis en cache (empreinte du contenu), les tours complets (message utilisateur
+et réponses qui suivent) sont retirés selon la politique configurée :
+    - drop_oldest : les tours les plus anciens, prompt système compris
+    - pin_system : les tours les plus anciens, prompt système conservé
+    - keep_first_last : les N premiers et N derniers tours conservés,
+      le milieu retiré en commençant par le plus ancien
+Le dernier tour (la question en cours) n'est jamais retiré ; s'il ne laisse
+pas la place de max_tokens, max_tokens est réduit.
+"""
+
+import hashlib
+import logging
+from collections import OrderedDict
+from typing import Dict, List, Any, Tuple
+
+logger = logging.getLogger(__name__)
+
+POLICIES = ("drop_oldest", "pin_system", "keep_first_last")
+
+# Balises du template autour de chaque message ([INST], <<SYS>>, <s>...)
+_MESSAGE_OVERHEAD = 8
+
+
+class ContextWindowManager:
+    """Ajuste l'historique d'une requête à la fenêtre de contexte"""
+
+    def __init__(self, template, n_ctx: int, policy: str = "pin_system", keep_first: int = 1,
+                 keep_last: int = 4, cache_size: int = 4096):
+        if policy not in POLICIES:
+            raise ValueError(f"Politique de contexte inconnue: {policy} ({', '.join(POLICIES)})")
+        self.template = template
+        self.n_ctx = n_ctx
+        self.policy = policy
+        self.keep_first = keep_first
+        self.keep_last = keep_last
+        self.cache_size = cache_size
+        self._counts: "OrderedDict[bytes, int]" = OrderedDict()
+
+        # Statistiques
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.trimmed_requests = 0
+        self.dropped_messages = 0
+        self.clamped_requests = 0
+
+    def count(self, message: Dict[str, str]) -> int:
+        """Tokens d'un message (contenu tokenisé + balises du template), mis en cache"""
+        content = message["content"]
+        key = hashlib.blake2b(content.encode("utf-8"), digest_size=16).digest()
+        n_tokens = self._counts.get(key)
+        if n_tokens is not None:
+            self._counts.move_to_end(key)
+            self.cache_hits += 1
+        else:
+            self.cache_misses += 1
+            n_tokens = len(self.template.model.tokenize(content.encode("utf-8"), add_bos=False, special=False))
+            self._counts[key] = n_tokens
+            if len(self._counts) > self.cache_size:
+                self._counts.popitem(last=False)
+        return n_tokens + _MESSAGE_OVERHEAD
+
+    def _turns(self, messages: List[Dict[str, str]]) -> Tuple[List[int], List[List[int]]]:
+        """Indices des messages système et des tours (utilisateur + réponses suivantes)"""
+        system, turns = [], []
+        for index, message in enumerate(messages):
+            if message["role"] == "system":
+                system.append(index)
+            elif message["role"] == "user" or not turns:
+                turns.append([index])
+            else:
+                turns[-1].append(index)
+        return system, turns
+
+    def _drop_order(self, system: List[int], turns: List[List[int]]) -> List[List[int]]:
+        """Groupes de messages retirables, dans l'ordre où ils sont retirés"""
+        candidates = turns[:-1]
+        if self.policy == "keep_first_last":
+            keep_last = max(0, self.keep_last - 1)  # Le tour en cours compte parmi les derniers
+            end = max(self.keep_first, len(candidates) - keep_last)
+            return candidates[self.keep_first:end]
+        if self.policy == "drop_oldest" and system:
+            return [system] + candidates
+        return candidates
+
+    def fit(self, messages: List[Dict[str, str]], max_tokens: int) -> Tuple[List[Dict[str, str]], List[int], int, Dict[str, Any]]:
+        """Retourne (messages retenus, tokens du prompt, max_tokens effectif, décision)"""
+        budget = self.n_ctx - max_tokens
+        counts = [self.count(m) for m in messages]
+        system, turns = self._turns(messages)
+        drop_order = self._drop_order(system, turns)
+
+        # Estimation par message d'abord, puis vérification sur le prompt réellement tokenisé
+        dropped = set()
+        estimate = sum(counts)
+        while True:
+            while estimate > budget and drop_order:
+                group = drop_order.pop(0)
+                dropped.update(group)
+                estimate -= sum(counts[i] for i in group)
+            kept = [m for i, m in enumerate(messages) if i not in dropped]
+            prompt_tokens = self.template.tokenize(kept)
+            if len(prompt_tokens) <= budget or not drop_order:
+                break
+            estimate = budget + 1  # Estimation trop optimiste : un tour de plus
+
+        effective_max_tokens = max_tokens
+        if len(prompt_tokens) > budget:
+            available = self.n_ctx - len(prompt_tokens)
+            if available <= 0:
+                raise ValueError(f"Prompt trop long ({len(prompt_tokens)} tokens, contexte de {self.n_ctx})")
+            effective_max_tokens = available
+            self.clamped_requests += 1
+
+        if dropped:
+            self.trimmed_requests += 1
+            self.dropped_messages += len(dropped)
+            logger.info(f"✂️ Historique réduit: {len(dropped)} message(s) retiré(s) ({self.policy})")
+
+        decision = {
+            "policy": self.policy,
+            "n_ctx": self.n_ctx,
+            "trimmed": bool(dropped),
+            "dropped_messages": len(dropped),
+            "kept_messages": len(kept),
+            "prompt_tokens": len(prompt_tokens),
+            "max_tokens": effective_max_tokens,
+            "max_tokens_reduced": effective_max_tokens < max_tokens,
+        }
+        return kept, prompt_tokens, effective_max_tokens, decision
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Statistiques de la gestion du contexte"""
+        lookups = self.cache_hits + self.cache_misses
+        return {
+            "policy": self.policy,
+            "n_ctx": self.n_ctx,
+            "cached_counts": len(self._counts),
+            "count_cache_hit_rate": round(self.cache_hits / lookups, 3) if lookups else 0.0,
+            "trimmed_requests": self.trimmed_requests,
+            "dropped_messages": self.dropped_messages,
+            "clamped_requests": self.clamped_requests,
+        }
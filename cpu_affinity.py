@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+"""
+Partition des cœurs CPU pour l'API Llama.cpp
+
+La topologie (cœurs physiques, frères hyperthreads, nœuds NUMA) est lue dans
+/sys. Les threads de calcul llama.cpp sont épinglés sur des cœurs physiques
+d'un seul nœud NUMA, un thread par cœur. La boucle uvicorn, l'écriture des
+logs et l'échantillonnage système sont épinglés sur les autres cœurs. Les
+frères hyperthreads des cœurs de calcul restent libres : un thread de service
+y partagerait les unités d'exécution du décodage.
+
+Les threads héritent de l'affinité de celui qui les crée : il suffit
+d'épingler les threads existants au démarrage, puis le thread de génération
+(et les workers forkés) sur les cœurs de calcul.
+"""
+
+import logging
+import os
+import threading
+from pathlib import Path
+from typing import Dict, List, Optional, Any, Tuple
+
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+SYS_CPU_ROOT = "/sys/devices/system"
+
+
+def parse_cpu_list(text: str) -> List[int]:
+    """Liste de CPU au format du noyau ("0-3,8,10-11")"""
+    cpus: List[int] = []
+    for part in text.strip().split(","):
+        if not part:
+            continue
+        if "-" in part:
+            first, last = part.split("-", 1)
+            cpus.extend(range(int(first), int(last) + 1))
+        else:
+            cpus.append(int(part))
+    return cpus
+
+
+def format_cpu_list(cpus: List[int]) -> str:
+    """Inverse de parse_cpu_list (plages compactes)"""
+    ranges: List[str] = []
+    for cpu in sorted(cpus):
+        if ranges and cpu == last + 1:
+            first = ranges[-1].split("-")[0]
+            ranges[-1] = f"{first}-{cpu}"
+        else:
+            ranges.append(str(cpu))
+        last = cpu
+    return ",".join(ranges)
+
+
+class CpuTopology:
+    """CPU logiques utilisables, groupés par cœur physique et par nœud NUMA"""
+
+    def __init__(self, cores: List[List[int]], core_nodes: List[int]):
+        # cores[i] : CPU logiques du cœur physique i (frères SMT), core_nodes[i] : son nœud NUMA
+        self.cores = cores
+        self.core_nodes = core_nodes
+
+    @classmethod
+    def detect(cls, root: str = SYS_CPU_ROOT) -> "CpuTopology":
+        """Lit la topologie dans /sys, restreinte aux CPU autorisés pour ce processus (cpuset)"""
+        cpu_dir = Path(root) / "cpu"
+        try:
+            online = parse_cpu_list((cpu_dir / "online").read_text())
+        except (OSError, ValueError):
+            online = list(range(os.cpu_count() or 1))
+        allowed = os.sched_getaffinity(0) if hasattr(os, "sched_getaffinity") else set(online)
+        cpus = [cpu for cpu in online if cpu in allowed]
+
+        cpu_nodes: Dict[int, int] = {}
+        for node_dir in Path(root).glob("node/node[0-9]*"):
+            try:
+                for cpu in parse_cpu_list((node_dir / "cpulist").read_text()):
+                    cpu_nodes[cpu] = int(node_dir.name[4:])
+            except (OSError, ValueError):
+                continue
+
+        by_core: Dict[Tuple[int, int], List[int]] = {}
+        for cpu in cpus:
+            topology = cpu_dir / f"cpu{cpu}" / "topology"
+            try:
+                key = (int((topology / "physical_package_id").read_text()), int((topology / "core_id").read_text()))
+            except (OSError, ValueError):
+                key = (-1, cpu)  # Topologie inconnue : chaque CPU logique est un cœur
+            by_core.setdefault(key, []).append(cpu)
+
+        cores = sorted((sorted(siblings) for siblings in by_core.values()), key=lambda siblings: siblings[0])
+        return cls(cores, [cpu_nodes.get(siblings[0], 0) for siblings in cores])
+
+    @property
+    def cpus(self) -> List[int]:
+        return sorted(cpu for siblings in self.cores for cpu in siblings)
+
+    @property
+    def smt(self) -> bool:
+        return any(len(siblings) > 1 for siblings in self.cores)
+
+    def nodes(self) -> Dict[int, List[List[int]]]:
+        """Cœurs physiques par nœud NUMA"""
+        nodes: Dict[int, List[List[int]]] = {}
+        for siblings, node in zip(self.cores, self.core_nodes):
+            nodes.setdefault(node, []).append(siblings)
+        return nodes
+
+
+class CpuAffinity:
+    """Répartition des cœurs entre calcul et service, et épinglage des threads"""
+
+    def __init__(self, enabled: bool = True, serving_cores: int = 1, inference_cores: Optional[int] = None,
+                 numa_node: Optional[int] = None, smt_for_inference: bool = False, root: str = SYS_CPU_ROOT):
+        self.enabled = enabled
+        self.serving_cores = max(0, serving_cores)
+        self.inference_cores = inference_cores
+        self.numa_node = numa_node
+        self.smt_for_inference = smt_for_inference
+        self.root = root
+        self.topology: Optional[CpuTopology] = None
+        self.inference_node: Optional[int] = None
+        self.inference_cpus: List[int] = []
+        self.serving_cpus: List[int] = []
+        self.reason = "non planifié"
+        self.pinned_threads: List[str] = []
+        self.worker_index: Optional[int] = None
+
+    @property
+    def active(self) -> bool:
+        return bool(self.inference_cpus)
+
+    def plan(self) -> bool:
+        """Choisit les cœurs de calcul et de service à partir de la topologie"""
+        self.topology = CpuTopology.detect(self.root)
+        self.inference_node = None
+        self.inference_cpus, self.serving_cpus = [], []
+        if not self.enabled:
+            self.reason = "désactivé (AFFINITY_CONFIG)"
+            return False
+        if not hasattr(os, "sched_setaffinity"):
+            self.reason = "sched_setaffinity indisponible sur cette plateforme"
+            return False
+        if len(self.topology.cores) <= self.serving_cores:
+            self.reason = f"{len(self.topology.cores)} cœur(s) physique(s) : pas de partition"
+            return False
+
+        nodes = self.topology.nodes()
+        if self.numa_node in nodes:
+            node = self.numa_node
+        else:
+            if self.numa_node is not None:
+                logger.warning(f"⚠️ Nœud NUMA {self.numa_node} absent ou non autorisé, choix automatique")
+            node = max(nodes, key=lambda n: (len(nodes[n]), -n))
+        candidates = nodes[node]
+
+        # Les cœurs de service sont pris hors du nœud de calcul si possible, sinon à la fin de celui-ci
+        others = sum(len(cores) for n, cores in nodes.items() if n != node)
+        missing = max(0, self.serving_cores - others)
+        if missing >= len(candidates):
+            self.reason = f"nœud {node} trop petit pour réserver {self.serving_cores} cœur(s) de service"
+            return False
+        inference = candidates[:len(candidates) - missing]
+        if self.inference_cores:
+            inference = inference[:self.inference_cores]
+
+        reserved = {cpu for siblings in inference for cpu in siblings}
+        self.inference_node = node
+        self.inference_cpus = sorted(
+            cpu for siblings in inference for cpu in (siblings if self.smt_for_inference else siblings[:1])
+        )
+        self.serving_cpus = [cpu for cpu in self.topology.cpus if cpu not in reserved]
+        self.reason = "actif"
+        return True
+
+    def apply(self) -> bool:
+        """Planifie, borne les threads llama.cpp et épingle les threads existants sur les cœurs de service"""
+        if not self.plan():
+            logger.info(f"🧩 Partition des cœurs inactive: {self.reason}")
+            return False
+
+        n_cpus = len(self.inference_cpus)
+        for key in ("n_threads", "n_threads_batch"):
+            if Config.LLAMA_CONFIG[key] > n_cpus:
+                logger.info(f"🧩 {key} ramené de {Config.LLAMA_CONFIG[key]} à {n_cpus} (cœurs de calcul)")
+                Config.LLAMA_CONFIG[key] = n_cpus
+        Config.HARDWARE_CONFIG["cpu_threads"] = Config.LLAMA_CONFIG["n_threads"]
+
+        # Boucle uvicorn, écriture des logs... : les threads créés ensuite héritent de cette affinité
+        self.pinned_threads = []
+        if self.serving_cpus:
+            for thread in threading.enumerate():
+                if thread.native_id is not None and self._pin(thread.native_id, self.serving_cpus):
+                    self.pinned_threads.append(thread.name)
+
+        logger.info(
+            f"🧩 Partition des cœurs: calcul {format_cpu_list(self.inference_cpus)} (nœud {self.inference_node}),"
+            f" service {format_cpu_list(self.serving_cpus) or '-'}"
+        )
+        return True
+
+    def pin_inference(self):
+        """Épingle le thread courant (génération) et ceux qu'il créera sur les cœurs de calcul"""
+        if self.active:
+            self._pin(0, self.inference_cpus)
+
+    def pin_worker(self, index: int, n_workers: int):
+        """Worker forké : sa part des cœurs de calcul (appelé dans l'enfant avant de créer ses threads)"""
+        if not self.active:
+            return
+        share = len(self.inference_cpus) // n_workers
+        if share > 0:
+            self.inference_cpus = self.inference_cpus[index * share:(index + 1) * share]
+        self.worker_index = index
+        self.pin_inference()
+
+    def _pin(self, tid: int, cpus: List[int]) -> bool:
+        try:
+            os.sched_setaffinity(tid, cpus)
+            return True
+        except OSError as e:
+            # Thread terminé entre-temps, ou cpuset plus restrictif que prévu
+            logger.debug(f"Épinglage impossible (tid {tid}): {e}")
+            return False
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Topologie détectée et répartition choisie (/debug/hardware)"""
+        topology = self.topology
+        return {
+            "enabled": self.enabled,
+            "active": self.active,
+            "reason": self.reason,
+            "topology": {
+                "logical_cpus": len(topology.cpus),
+                "physical_cores": len(topology.cores),
+                "smt": topology.smt,
+                "numa_nodes": {
+                    str(node): format_cpu_list([cpu for siblings in cores for cpu in siblings])
+                    for node, cores in sorted(topology.nodes().items())
+                },
+            } if topology else None,
+            "inference": {
+                "numa_node": self.inference_node,
+                "cpus": format_cpu_list(self.inference_cpus),
+                "n_threads": Config.LLAMA_CONFIG["n_threads"],
+                "n_threads_batch": Config.LLAMA_CONFIG["n_threads_batch"],
+            },
+            "serving": {
+                "cpus": format_cpu_list(self.serving_cpus),
+                "pinned_threads": self.pinned_threads,
+            },
+        }
+
+
+# Instance globale
+cpu_affinity = CpuAffinity(
+    enabled=Config.AFFINITY_CONFIG["enabled"],
+    serving_cores=Config.AFFINITY_CONFIG["serving_cores"],
+    inference_cores=Config.AFFINITY_CONFIG["inference_cores"],
+    numa_node=Config.AFFINITY_CONFIG["numa_node"],
+    smt_for_inference=Config.AFFINITY_CONFIG["smt_for_inference"],
+)
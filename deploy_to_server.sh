@@ -28,7 +28,7 @@ fi
 
 # Création du dossier de logs sur le serveur
 echo "📁 Création des dossiers sur le serveur..."
-ssh $SERVER_USER@$SERVER_IP "mkdir -p $SERVER_PATH/logs"
+ssh $SERVER_USER@$SERVER_IP "mkdir -p $SERVER_PATH/logs $SERVER_PATH/kv_cache $SERVER_PATH/response_cache"
 
 # Copie des fichiers d'optimisation
 echo "📤 Copie des fichiers d'optimisation..."
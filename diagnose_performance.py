@@ -10,14 +10,21 @@ import json
 import psutil
 import subprocess
 from pathlib import Path
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Optional
+
+from log_index import log_index, bucket_share
+from perf_store import perf_store
+from metrics import BucketCounts
 
 class PerformanceDiagnostic:
     """Diagnostic de performance pour Mistral"""
     
-    def __init__(self):
+    def __init__(self, hours: Optional[float] = None):
         self.logs_dir = Path("logs")
         self.models_dir = Path("models")
+        self.hours = hours  # Fenêtre d'analyse des logs (None = tout l'index)
+        self.index = log_index
+        self._indexed = False
         
     def run_full_diagnostic(self) -> Dict[str, Any]:
         """Exécute un diagnostic complet"""
@@ -130,89 +137,69 @@ class PerformanceDiagnostic:
         }
     
     def analyze_performance(self) -> Dict[str, Any]:
-        """Analyse les performances depuis les logs"""
+        """Analyse les performances (stockage colonnaire, sinon index des logs texte)"""
         print("📈 Analyse des performances...")
         
         if not self.logs_dir.exists():
             return {"error": "Dossier logs non trouvé"}
         
-        perf_file = self.logs_dir / "performance.log"
-        if not perf_file.exists():
-            return {"error": "Fichier de performance non trouvé"}
-        
-        # Analyse des logs de performance
-        response_times = []
-        tokens_list = []
-        requests_per_hour = {}
+        stored = perf_store.analyze(self.hours)
+        if stored["total_requests"]:
+            print(f"🧮 {stored['total_requests']} enregistrements analysés en {stored['scan_ms']}ms")
+            return stored
         
-        try:
-            with open(perf_file, 'r') as f:
-                for line in f:
-                    if 'PERF' in line and 'ResponseTime:' in line and 'Tokens:' in line:
-                        try:
-                            # Extraction des données
-                            parts = line.split('ResponseTime:')[1].split(' - Tokens:')
-                            response_time = float(parts[0])
-                            tokens = int(parts[1])
-                            
-                            response_times.append(response_time)
-                            tokens_list.append(tokens)
-                            
-                            # Comptage par heure
-                            hour = line.split(' - ')[0][:13]  # YYYY-MM-DD HH
-                            requests_per_hour[hour] = requests_per_hour.get(hour, 0) + 1
-                            
-                        except:
-                            continue
-        except Exception as e:
-            return {"error": f"Erreur lors de l'analyse: {e}"}
-        
-        if not response_times:
+        window = self.indexed_window()
+        response_times = window["series"].get("response_time")
+        if response_times is None:
             return {"error": "Aucune donnée de performance trouvée"}
+        tokens = window["series"].get("tokens")
         
-        # Calculs statistiques
-        avg_response_time = sum(response_times) / len(response_times)
-        min_response_time = min(response_times)
-        max_response_time = max(response_times)
-        
-        avg_tokens = sum(tokens_list) / len(tokens_list) if tokens_list else 0
-        total_tokens = sum(tokens_list)
+        total_tokens = int(tokens.sum) if tokens else 0
+        tokens_per_second = total_tokens / response_times.sum if response_times.sum > 0 else 0
+        summary = response_times.summary(digits=3)
         
-        # Tokens par seconde
-        tokens_per_second = total_tokens / sum(response_times) if sum(response_times) > 0 else 0
-        
-        return {
-            "total_requests": len(response_times),
-            "avg_response_time": round(avg_response_time, 3),
-            "min_response_time": round(min_response_time, 3),
-            "max_response_time": round(max_response_time, 3),
-            "avg_tokens_per_request": round(avg_tokens, 1),
+        analysis = {
+            "window_hours": self.hours,
+            "total_requests": response_times.count,
+            "avg_response_time": summary["avg"],
+            "min_response_time": summary["min"],
+            "max_response_time": summary["max"],
+            "p50_response_time": summary["p50"],
+            "p95_response_time": summary["p95"],
+            "avg_tokens_per_request": round(total_tokens / tokens.count, 1) if tokens else 0,
             "total_tokens": total_tokens,
             "tokens_per_second": round(tokens_per_second, 1),
-            "requests_per_hour": requests_per_hour,
+            "requests_per_hour": window["requests_per_hour"],
             "performance_distribution": self.get_performance_distribution(response_times)
         }
+        
+        # Phases de génération (lignes PHASES)
+        for name, scale in (("queue_wait", 1000), ("time_to_first_token", 1000), ("decode_tokens_per_second", 1)):
+            series = window["series"].get(name)
+            if series is not None:
+                analysis[name] = series.summary(scale=scale)
+        
+        return analysis
     
-    def get_performance_distribution(self, response_times: List[float]) -> Dict[str, int]:
-        """Calcule la distribution des temps de réponse"""
-        distribution = {
-            "fast": 0,      # < 1s
-            "normal": 0,    # 1-3s
-            "slow": 0,      # 3-10s
-            "very_slow": 0  # > 10s
+    def indexed_window(self) -> Dict[str, Any]:
+        """Met l'index à jour (lignes nouvelles seulement) et retourne les agrégats de la fenêtre"""
+        if not self._indexed:
+            stats = self.index.update()
+            self._indexed = True
+            print(f"🗂️ Index des logs: {stats['lines_indexed']} lignes nouvelles ({stats['bytes_read'] / 1024:.0f} KB lus)")
+        return self.index.window(self.hours)
+    
+    def get_performance_distribution(self, response_times: BucketCounts) -> Dict[str, int]:
+        """Calcule la distribution des temps de réponse (depuis les buckets de l'index)"""
+        fast = bucket_share(response_times, 1.0)
+        normal = bucket_share(response_times, 3.0)
+        slow = bucket_share(response_times, 10.0)
+        return {
+            "fast": fast,                                # < 1s
+            "normal": normal - fast,                     # 1-3s
+            "slow": slow - normal,                       # 3-10s
+            "very_slow": response_times.count - slow     # > 10s
         }
-        
-        for time in response_times:
-            if time < 1:
-                distribution["fast"] += 1
-            elif time < 3:
-                distribution["normal"] += 1
-            elif time < 10:
-                distribution["slow"] += 1
-            else:
-                distribution["very_slow"] += 1
-        
-        return distribution
     
     def analyze_logs(self) -> Dict[str, Any]:
         """Analyse les logs d'erreurs et système"""
@@ -221,35 +208,28 @@ class PerformanceDiagnostic:
         if not self.logs_dir.exists():
             return {"error": "Dossier logs non trouvé"}
         
+        window = self.indexed_window()
+        counters = window["counters"]
+        
         analysis = {
-            "errors": [],
+            "error_count": counters.get("errors", 0),
+            "errors_by_context": {
+                name.split(":", 1)[1]: count for name, count in counters.items() if name.startswith("errors:")
+            },
+            "errors": self.index.recent_errors(),
             "system_issues": [],
             "model_issues": []
         }
         
-        # Analyse des erreurs
-        error_file = self.logs_dir / "errors.log"
-        if error_file.exists():
-            try:
-                with open(error_file, 'r') as f:
-                    for line in f:
-                        if 'ERROR' in line:
-                            analysis["errors"].append(line.strip())
-            except:
-                pass
-        
         # Analyse système
-        system_file = self.logs_dir / "system.log"
-        if system_file.exists():
-            try:
-                with open(system_file, 'r') as f:
-                    for line in f:
-                        if 'memory_percent' in line and '> 90' in line:
-                            analysis["system_issues"].append("Mémoire élevée détectée")
-                        elif 'cpu_percent' in line and '> 95' in line:
-                            analysis["system_issues"].append("CPU élevé détecté")
-            except:
-                pass
+        if counters.get("high_memory"):
+            analysis["system_issues"].append(f"Mémoire élevée détectée ({counters['high_memory']} relevés)")
+        if counters.get("high_cpu"):
+            analysis["system_issues"].append(f"CPU élevé détecté ({counters['high_cpu']} relevés)")
+        for name in ("cpu_percent", "memory_percent"):
+            series = window["series"].get(name)
+            if series is not None:
+                analysis[name] = series.summary()
         
         return analysis
     
@@ -457,10 +437,16 @@ def main():
                        help="Fichier de sortie pour le rapport")
     parser.add_argument("--quick", "-q", action="store_true", 
                        help="Diagnostic rapide (sans analyse des logs)")
+    parser.add_argument("--hours", type=float, default=None,
+                       help="Fenêtre d'analyse des logs en heures (défaut: tout l'historique indexé)")
+    parser.add_argument("--reindex", action="store_true",
+                       help="Reconstruit l'index des logs depuis le début des fichiers")
     
     args = parser.parse_args()
     
-    diagnostic = PerformanceDiagnostic()
+    diagnostic = PerformanceDiagnostic(hours=args.hours)
+    if args.reindex:
+        diagnostic.index.reset()
     
     if args.quick:
         print("🔍 Diagnostic rapide...")
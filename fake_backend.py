@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+"""
+Backend synthétique pour l'API Llama.cpp (sans modèle GGUF ni llama_cpp)
+
+FakeLlama reproduit la partie de l'interface Llama utilisée par le serveur :
+tokenize/detokenize, tokens spéciaux, create_completion (avec
+stopping_criteria et cache de préfixes), create_chat_completion,
+save_state/load_state. Le prefill et le décodage durent le temps fixé par
+les débits configurés, le texte est déterministe (graine de la requête ou
+empreinte du prompt) et les chunks ont la forme de ceux de
+llama-cpp-python. Les couches HTTP, streaming, file d'attente et logs
+peuvent ainsi être mesurées et testées en régression seules.
+
+Le batching continu (API bas niveau de llama.cpp) n'est pas simulé :
+l'exécuteur repasse en génération séquentielle avec ce backend.
+"""
+
+import hashlib
+import random
+import re
+import time
+import uuid
+from typing import Dict, List, Optional, Any, Iterator, Sequence, Union
+
+import numpy as np
+
+# Identifiants réservés (convention Llama)
+UNK_ID, BOS_ID, EOS_ID = 0, 1, 2
+_SPECIAL_TEXT = {BOS_ID: "<s>", EOS_ID: "</s>"}
+_SPECIAL_RE = re.compile(r"(<s>|</s>)")
+# Morceaux de mot d'au plus 4 caractères, espace initiale comprise (proche d'un tokenizer BPE)
+_PIECE_RE = re.compile(r" ?[^\W\d_]{1,4}| ?\d{1,3}| ?[^\w\s]|\s+")
+
+_WORDS = (
+    "le modèle génère une réponse cohérente en suivant le contexte de la conversation "
+    "chaque token est produit après l'évaluation du prompt puis le décodage continue "
+    "jusqu'à la limite demandée ou la fin naturelle de la phrase the server streams "
+    "tokens to the client while the scheduler keeps the queue short and latency low"
+).split()
+
+
+class FakeLlamaState:
+    """Instantané d'état (mêmes champs que llama_cpp.LlamaState)"""
+
+    def __init__(self, input_ids, scores, n_tokens: int, llama_state: bytes, llama_state_size: int, seed: int = 0):
+        self.input_ids = input_ids
+        self.scores = scores
+        self.n_tokens = n_tokens
+        self.llama_state = llama_state
+        self.llama_state_size = llama_state_size
+        self.seed = seed
+
+
+class FakeLlama:
+    """Modèle synthétique aux débits configurables et au texte déterministe"""
+
+    def __init__(self, model_path: str = "fake://llama", n_ctx: int = 4096, n_vocab: int = 32000,
+                 prompt_tokens_per_second: float = 500.0, decode_tokens_per_second: float = 25.0,
+                 response_tokens: Sequence[int] = (32, 256), state_bytes_per_token: int = 1024, seed: int = 0):
+        self.model_path = model_path
+        self.metadata: Dict[str, str] = {}
+        self._n_ctx = n_ctx
+        self._n_vocab = n_vocab
+        self.prompt_tokens_per_second = prompt_tokens_per_second
+        self.decode_tokens_per_second = decode_tokens_per_second
+        self.response_tokens = tuple(response_tokens)
+        self.state_bytes_per_token = state_bytes_per_token
+        self.seed = seed
+        self.cache = None
+        self.draft_model = None
+        self.ctx = None  # Pas de contexte llama.cpp
+
+        self.input_ids = np.zeros(n_ctx, dtype=np.intc)
+        self.n_tokens = 0
+
+        # Vocabulaire : identifiant stable par morceau, table inverse pour detokenize
+        self._pieces: Dict[int, str] = dict(_SPECIAL_TEXT)
+        self._ids: Dict[str, int] = {}
+
+    # -- Vocabulaire ---------------------------------------------------------
+
+    def n_ctx(self) -> int:
+        return self._n_ctx
+
+    def n_vocab(self) -> int:
+        return self._n_vocab
+
+    def token_bos(self) -> int:
+        return BOS_ID
+
+    def token_eos(self) -> int:
+        return EOS_ID
+
+    def _piece_id(self, piece: str) -> int:
+        token = self._ids.get(piece)
+        if token is None:
+            digest = hashlib.blake2b(piece.encode("utf-8"), digest_size=8).digest()
+            token = 3 + int.from_bytes(digest, "little") % (self._n_vocab - 3)
+            self._ids[piece] = token
+            self._pieces.setdefault(token, piece)
+        return token
+
+    def tokenize(self, text: bytes, add_bos: bool = True, special: bool = False) -> List[int]:
+        decoded = text.decode("utf-8", errors="ignore")
+        tokens = [BOS_ID] if add_bos else []
+        parts = _SPECIAL_RE.split(decoded) if special else [decoded]
+        for part in parts:
+            if special and part in ("<s>", "</s>"):
+                tokens.append(BOS_ID if part == "<s>" else EOS_ID)
+            elif part:
+                tokens.extend(self._piece_id(piece) for piece in _PIECE_RE.findall(part))
+        return tokens
+
+    def detokenize(self, tokens: Sequence[int], prev_tokens: Optional[Sequence[int]] = None, special: bool = False) -> bytes:
+        return "".join(self._pieces.get(int(t), "") for t in tokens).encode("utf-8")
+
+    # -- État ----------------------------------------------------------------
+
+    def set_cache(self, cache):
+        self.cache = cache
+
+    def save_state(self) -> FakeLlamaState:
+        size = self.n_tokens * self.state_bytes_per_token
+        return FakeLlamaState(
+            input_ids=self.input_ids.copy(),
+            scores=np.zeros((1, 0), dtype=np.float32),
+            n_tokens=self.n_tokens,
+            llama_state=bytes(size),
+            llama_state_size=size,
+            seed=self.seed,
+        )
+
+    def load_state(self, state):
+        n_tokens = int(state.n_tokens)
+        self.input_ids[:n_tokens] = state.input_ids[:n_tokens]
+        self.n_tokens = n_tokens
+
+    def reset(self):
+        self.n_tokens = 0
+
+    def eval(self, tokens: Sequence[int]):
+        """Évalue des tokens à la suite du contexte (prefill si plusieurs, pas de décodage sinon)"""
+        if self.n_tokens + len(tokens) > self._n_ctx:
+            raise ValueError("Contexte plein")
+        rate = self.prompt_tokens_per_second if len(tokens) > 1 else self.decode_tokens_per_second
+        if rate > 0:
+            time.sleep(len(tokens) / rate)
+        self.input_ids[self.n_tokens:self.n_tokens + len(tokens)] = tokens
+        self.n_tokens += len(tokens)
+
+    # -- Génération ----------------------------------------------------------
+
+    def _prefill(self, prompt: List[int]) -> int:
+        """Simule l'évaluation du prompt ; retourne le nombre de tokens évalués"""
+        def common(a, b) -> int:
+            n = 0
+            for x, y in zip(a, b):
+                if x != y:
+                    break
+                n += 1
+            return n
+
+        reused = common(self.input_ids[:self.n_tokens].tolist(), prompt)
+        if self.cache is not None and reused < len(prompt):
+            try:
+                state = self.cache[prompt]
+            except KeyError:
+                state = None
+            if state is not None:
+                cached = common(state.input_ids[:state.n_tokens].tolist(), prompt)
+                if cached > reused:
+                    self.load_state(state)
+                    reused = cached
+        # Le dernier token du prompt est toujours réévalué (logits de l'échantillonnage)
+        reused = min(reused, len(prompt) - 1)
+        evaluated = len(prompt) - reused
+        if self.prompt_tokens_per_second > 0:
+            time.sleep(evaluated / self.prompt_tokens_per_second)
+        self.input_ids[:len(prompt)] = prompt
+        self.n_tokens = len(prompt)
+        return evaluated
+
+    def _rng(self, prompt: List[int], seed: Optional[int]) -> random.Random:
+        if seed is None or seed < 0:
+            digest = hashlib.blake2b(np.asarray(prompt, dtype=np.int32).tobytes(), digest_size=8).digest()
+            seed = int.from_bytes(digest, "little") ^ self.seed
+        return random.Random(seed)
+
+    def _generate(self, prompt: List[int], max_tokens: int, seed: Optional[int], stop: Sequence[str],
+                  stopping_criteria) -> Iterator[Any]:
+        """Génère (texte, finish_reason) token par token ; finish_reason non nul au dernier"""
+        if len(prompt) >= self._n_ctx:
+            raise ValueError(f"Requested tokens ({len(prompt)}) exceed context window of {self._n_ctx}")
+        self._prefill(prompt)
+        rng = self._rng(prompt, seed)
+        limit = min(max_tokens if max_tokens and max_tokens > 0 else self._n_ctx, self._n_ctx - len(prompt))
+        natural_length = rng.randint(*self.response_tokens)
+        text = ""
+        pieces = [p for word in (rng.choice(_WORDS) for _ in range(natural_length)) for p in _PIECE_RE.findall(" " + word)]
+        delay = 1.0 / self.decode_tokens_per_second if self.decode_tokens_per_second > 0 else 0.0
+        next_at = time.perf_counter()
+
+        for i in range(limit):
+            if i >= len(pieces):
+                yield "", "stop"
+                return
+            next_at += delay
+            pause = next_at - time.perf_counter()
+            if pause > 0:
+                time.sleep(pause)
+            token = self._piece_id(pieces[i])
+            if stopping_criteria is not None and stopping_criteria(self.input_ids[:self.n_tokens], None):
+                yield "", "stop"
+                return
+            self.input_ids[self.n_tokens] = token
+            self.n_tokens += 1
+            text += pieces[i]
+            if any(s and s in text for s in stop):
+                yield "", "stop"
+                return
+            yield pieces[i], None
+        yield "", "length"
+
+    def create_completion(self, prompt: Union[str, List[int]], max_tokens: Optional[int] = 16,
+                          temperature: float = 0.8, stop: Optional[Union[str, List[str]]] = None,
+                          stream: bool = False, seed: Optional[int] = None, stopping_criteria=None,
+                          **kwargs) -> Union[Dict[str, Any], Iterator[Dict[str, Any]]]:
+        """Complétion au format text_completion de llama-cpp-python"""
+        tokens = self.tokenize(prompt.encode("utf-8")) if isinstance(prompt, str) else list(prompt)
+        stops = [stop] if isinstance(stop, str) else list(stop or [])
+        completion_id = f"cmpl-{uuid.uuid4()}"
+        created = int(time.time())
+        generator = self._generate(tokens, max_tokens, seed, stops, stopping_criteria)
+
+        def chunk(text: str, finish_reason: Optional[str]) -> Dict[str, Any]:
+            return {
+                "id": completion_id,
+                "object": "text_completion",
+                "created": created,
+                "model": self.model_path,
+                "choices": [{"text": text, "index": 0, "logprobs": None, "finish_reason": finish_reason}],
+            }
+
+        def stream_chunks():
+            for text, finish_reason in generator:
+                yield chunk(text, finish_reason)
+            self._save_to_cache()
+
+        if stream:
+            return stream_chunks()
+
+        parts, finish_reason = [], "stop"
+        for text, reason in generator:
+            parts.append(text)
+            finish_reason = reason or finish_reason
+        self._save_to_cache()
+        response = chunk("".join(parts), finish_reason)
+        completion_tokens = self.n_tokens - len(tokens)
+        response["usage"] = {
+            "prompt_tokens": len(tokens),
+            "completion_tokens": completion_tokens,
+            "total_tokens": len(tokens) + completion_tokens,
+        }
+        return response
+
+    def _save_to_cache(self):
+        if self.cache is not None and self.n_tokens:
+            self.cache[self.input_ids[:self.n_tokens].tolist()] = self.save_state()
+
+    def create_chat_completion(self, messages: List[Dict[str, str]], stream: bool = False,
+                               **kwargs) -> Union[Dict[str, Any], Iterator[Dict[str, Any]]]:
+        """Conversation au format chat.completion (template Llama-2 minimal)"""
+        prompt = ""
+        for message in messages:
+            if message["role"] == "user":
+                prompt += f"<s>[INST] {message['content']} [/INST]"
+            elif message["role"] == "assistant":
+                prompt += f" {message['content']} </s>"
+            else:
+                prompt += f"<s>[INST] <<SYS>>\n{message['content']}\n<</SYS>>\n\n [/INST]"
+        tokens = self.tokenize(prompt.encode("utf-8"), add_bos=False, special=True)
+        result = self.create_completion(tokens, stream=stream, **kwargs)
+
+        if not stream:
+            choice = result["choices"][0]
+            result["object"] = "chat.completion"
+            result["choices"] = [{
+                "index": 0,
+                "message": {"role": "assistant", "content": choice["text"]},
+                "logprobs": None,
+                "finish_reason": choice["finish_reason"],
+            }]
+            return result
+
+        def chat_chunks():
+            first = True
+            for chunk in result:
+                choice = chunk["choices"][0]
+                base = {"id": "chat" + chunk["id"], "object": "chat.completion.chunk",
+                        "created": chunk["created"], "model": chunk["model"]}
+                if first:
+                    first = False
+                    yield dict(base, choices=[{"index": 0, "delta": {"role": "assistant"}, "logprobs": None,
+                                               "finish_reason": None}])
+                delta = {"content": choice["text"]} if choice["text"] else {}
+                yield dict(base, choices=[{"index": 0, "delta": delta, "logprobs": None,
+                                           "finish_reason": choice["finish_reason"]}])
+
+        return chat_chunks()
+
+
+def load_fake_model(config: Dict[str, Any], fake_config: Dict[str, Any]) -> FakeLlama:
+    """Crée le backend synthétique à partir de la configuration llama et de BACKEND_CONFIG["fake"]"""
+    if fake_config.get("load_time"):
+        time.sleep(fake_config["load_time"])
+    return FakeLlama(
+        model_path=f"fake://{config['model_path']}",
+        n_ctx=config["n_ctx"],
+        n_vocab=fake_config["n_vocab"],
+        prompt_tokens_per_second=fake_config["prompt_tokens_per_second"],
+        decode_tokens_per_second=fake_config["decode_tokens_per_second"],
+        response_tokens=fake_config["response_tokens"],
+        state_bytes_per_token=fake_config["state_bytes_per_token"],
+        seed=fake_config["seed"],
+    )
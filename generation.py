@@ -0,0 +1,577 @@
+#!/usr/bin/env python3
+"""
+Exécuteur de génération pour l'API Llama.cpp
+
+Un thread dédié possède l'instance Llama et traite les générations ; les
+endpoints asynchrones soumettent des jobs et consomment les chunks via des
+itérateurs asynchrones, sans jamais bloquer la boucle d'événements.
+
+Avec n_parallel > 1, le thread délègue à l'ordonnanceur de batching continu
+(batching.py) qui fait vivre plusieurs séquences dans un même contexte.
+"""
+
+import asyncio
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+from typing import Dict, List, Optional, Any, AsyncIterator
+
+from config import Config
+from chat_template import ChatTemplate
+from context_window import ContextWindowManager
+from cpu_affinity import cpu_affinity
+from metrics import BucketCounts, INTER_TOKEN_BUCKETS
+from prefix_cache import prefix_cache
+from sessions import session_manager
+
+logger = logging.getLogger(__name__)
+
+# Marqueur de fin de flux
+_END_OF_STREAM = object()
+
+
+class QueueFullError(Exception):
+    """La file d'attente de génération est pleine"""
+
+
+def _common_prefix_length(a, b) -> int:
+    """Longueur du préfixe commun de deux séquences de tokens"""
+    n = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        n += 1
+    return n
+
+
+class GenerationJob:
+    """Requête de génération soumise à l'exécuteur"""
+
+    def __init__(self, request_id: str, messages: List[Dict[str, str]], params: Dict[str, Any],
+                 stream: bool, loop: asyncio.AbstractEventLoop, session=None, deadline: Optional[float] = None):
+        self.request_id = request_id
+        self.messages = messages
+        self.params = params
+        self.stream = stream
+        self.loop = loop
+        self.session = session
+        self.deadline = deadline
+        self.context_window: Optional[Dict[str, Any]] = None
+        self.session_state = None
+
+        self.status = "queued"
+        self.submitted_at = time.time()
+        self.started_at: Optional[float] = None
+        self.first_token_at: Optional[float] = None
+        self.last_token_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+
+        # Phases : prompt (dont tokens repris du cache KV) puis écarts entre tokens générés
+        self.prompt_token_count = 0
+        self.prompt_tokens_cached = 0
+        self.inter_token = BucketCounts(INTER_TOKEN_BUCKETS)
+
+        self.completion_id = f"chatcmpl-{uuid.uuid4()}"
+        self.created = int(self.submitted_at)
+        self.model_name = ""
+        self.prompt_tokens: List[int] = []
+        self.completion_tokens = 0
+        self.finish_reason: Optional[str] = None
+        self.interrupt_reason: Optional[str] = None
+        self.cancel_callback = None
+        self._text_parts: List[str] = []
+        self._role_sent = False
+
+        self._chunks: asyncio.Queue = asyncio.Queue()
+        self._result: asyncio.Future = loop.create_future()
+
+    # --- Côté thread de génération ---
+
+    def _call_in_loop(self, callback, *args):
+        """Planifie un appel dans la boucle d'événements du client"""
+        try:
+            self.loop.call_soon_threadsafe(callback, *args)
+        except RuntimeError:
+            # Boucle fermée (arrêt du serveur)
+            pass
+
+    def _make_chunk(self, delta: Dict[str, str], finish_reason: Optional[str] = None) -> Dict[str, Any]:
+        """Chunk au format chat.completion.chunk (OpenAI / llama-cpp-python)"""
+        return {
+            "id": self.completion_id,
+            "object": "chat.completion.chunk",
+            "created": self.created,
+            "model": self.model_name,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+        }
+
+    def emit_text(self, text: str):
+        """Transmet un morceau de texte généré"""
+        if not text:
+            return
+        self._text_parts.append(text)
+        if self.stream:
+            if not self._role_sent:
+                self._role_sent = True
+                self._call_in_loop(self._chunks.put_nowait, self._make_chunk({"role": "assistant"}))
+            self._call_in_loop(self._chunks.put_nowait, self._make_chunk({"content": text}))
+
+    def mark_token(self):
+        """Horodate un token échantillonné (fin du prefill au premier, écart inter-tokens ensuite)"""
+        now = time.time()
+        if self.first_token_at is None:
+            self.first_token_at = now
+        else:
+            self.inter_token.observe(now - self.last_token_at)
+        self.last_token_at = now
+
+    def check_deadline(self) -> bool:
+        """Interrompt le job si son échéance est dépassée"""
+        if self.deadline is not None and not self.interrupt_reason and time.time() >= self.deadline:
+            self.interrupt_reason = "deadline"
+        return self.interrupt_reason == "deadline"
+
+    def stop_reason(self) -> Optional[str]:
+        """Raison d'interrompre la génération au prochain token, s'il y en a une"""
+        if self.interrupt_reason or self.check_deadline():
+            return self.interrupt_reason
+        if self.completion_tokens >= self.params.get("max_tokens", 2048):
+            return "length"
+        return None
+
+    def on_token(self, input_ids, logits) -> bool:
+        """Critère d'arrêt llama-cpp-python, appelé après chaque token échantillonné"""
+        self.completion_tokens = max(self.completion_tokens, len(input_ids) - len(self.prompt_tokens) + 1)
+        self.mark_token()
+        self.check_deadline()
+        return self.interrupt_reason is not None
+
+    @property
+    def text(self) -> str:
+        return "".join(self._text_parts)
+
+    def build_response(self) -> Dict[str, Any]:
+        """Réponse complète au format chat.completion"""
+        prompt_tokens = len(self.prompt_tokens)
+        return {
+            "id": self.completion_id,
+            "object": "chat.completion",
+            "created": self.created,
+            "model": self.model_name,
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": self.text},
+                "finish_reason": self.finish_reason,
+            }],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": self.completion_tokens,
+                "total_tokens": prompt_tokens + self.completion_tokens,
+            },
+            "context_window": self.context_window,
+            "timings": self.timings(),
+        }
+
+    def timings(self) -> Dict[str, Any]:
+        """Durées et débits par phase : file d'attente, évaluation du prompt, décodage"""
+        timings = {
+            "queue_wait_ms": round(self.queue_wait * 1000, 1),
+            "prompt_tokens": self.prompt_token_count,
+            "prompt_tokens_cached": self.prompt_tokens_cached,
+            "completion_tokens": self.completion_tokens,
+        }
+        if self.started_at is None or self.first_token_at is None:
+            return timings
+
+        prefill = self.first_token_at - self.started_at
+        evaluated = max(0, self.prompt_token_count - self.prompt_tokens_cached)
+        timings["prompt_eval_ms"] = round(prefill * 1000, 1)
+        timings["prompt_tokens_per_second"] = round(evaluated / prefill, 1) if prefill > 0 else None
+        timings["time_to_first_token_ms"] = round((self.first_token_at - self.submitted_at) * 1000, 1)
+
+        decode = self.last_token_at - self.first_token_at
+        timings["decode_ms"] = round(decode * 1000, 1)
+        timings["decode_tokens_per_second"] = round(self.inter_token.count / decode, 1) if decode > 0 else None
+        timings["inter_token_latency_ms"] = self.inter_token.summary(scale=1000)
+        return timings
+
+    def phase_state(self) -> Dict[str, Any]:
+        """Mesures de phases transmises par un worker forké avec la réponse"""
+        return {
+            "first_token_at": self.first_token_at,
+            "last_token_at": self.last_token_at,
+            "prompt_token_count": self.prompt_token_count,
+            "prompt_tokens_cached": self.prompt_tokens_cached,
+            "inter_token": self.inter_token,
+        }
+
+    def complete(self, finish_reason: str):
+        """Termine le job avec succès"""
+        self.finish_reason = finish_reason
+        self.status = "done"
+        self.finished_at = time.time()
+        if self.stream:
+            # Le dernier chunk porte la décision d'ajustement du contexte
+            chunk = self._make_chunk({}, finish_reason)
+            chunk["context_window"] = self.context_window
+            chunk["timings"] = self.timings()
+            self._call_in_loop(self._chunks.put_nowait, chunk)
+        self._call_in_loop(self._resolve, self.build_response(), None)
+
+    def forward_chunk(self, chunk: Dict[str, Any], started_at: Optional[float] = None):
+        """Relaie un chunk produit par un worker forké (worker_pool.py)"""
+        self._mark_started(started_at)
+        self._call_in_loop(self._chunks.put_nowait, chunk)
+
+    def complete_remote(self, response: Dict[str, Any], started_at: Optional[float] = None,
+                        phases: Optional[Dict[str, Any]] = None):
+        """Termine le job avec la réponse complète produite par un worker forké"""
+        self._mark_started(started_at)
+        for name, value in (phases or {}).items():
+            setattr(self, name, value)
+        choice = response["choices"][0]
+        self._text_parts = [choice["message"]["content"]]
+        self.completion_tokens = response["usage"]["completion_tokens"]
+        self.finish_reason = choice["finish_reason"]
+        self.context_window = response.get("context_window")
+        self.status = "done"
+        self.finished_at = time.time()
+        self._call_in_loop(self._resolve, response, None)
+
+    def _mark_started(self, started_at: Optional[float]):
+        if self.started_at is None and started_at is not None:
+            self.started_at = started_at
+            self.status = "running"
+
+    def fail(self, error: Exception):
+        """Termine le job en erreur"""
+        self.status = "error"
+        self.finished_at = time.time()
+        self._call_in_loop(self._resolve, None, error)
+
+    def _resolve(self, result: Optional[Dict[str, Any]], error: Optional[Exception]):
+        if not self._result.done():
+            if error is not None:
+                self._result.set_exception(error)
+            else:
+                self._result.set_result(result)
+        self._chunks.put_nowait(_END_OF_STREAM)
+
+    # --- Côté asyncio ---
+
+    def cancel(self, reason: str = "cancelled"):
+        """Interrompt la génération au prochain token (client déconnecté...)"""
+        if self.finished_at is not None or self.interrupt_reason:
+            return
+        self.interrupt_reason = reason
+        if self.cancel_callback is not None:
+            self.cancel_callback()
+
+    def add_done_callback(self, callback):
+        """Appelle callback(réponse) lorsque le job se termine avec succès"""
+        def on_done(future: asyncio.Future):
+            if not future.cancelled() and future.exception() is None:
+                callback(future.result())
+        self._result.add_done_callback(on_done)
+
+    def add_finish_callback(self, callback):
+        """Appelle callback(job) à la fin du job, quelle qu'en soit l'issue"""
+        self._result.add_done_callback(lambda future: callback(self))
+
+    async def __aiter__(self) -> AsyncIterator[Dict[str, Any]]:
+        """Itère sur les chunks produits, puis relève l'erreur éventuelle"""
+        while True:
+            chunk = await self._chunks.get()
+            if chunk is _END_OF_STREAM:
+                break
+            yield chunk
+        await self._result
+
+    async def wait(self) -> Dict[str, Any]:
+        """Attend la fin du job et retourne la réponse complète"""
+        return await self._result
+
+    @property
+    def queue_wait(self) -> float:
+        """Temps passé dans la file d'attente"""
+        end = self.started_at or time.time()
+        return end - self.submitted_at
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Résumé du job pour les endpoints de supervision"""
+        return {
+            "request_id": self.request_id,
+            "status": self.status,
+            "stream": self.stream,
+            "queue_wait": round(self.queue_wait, 3),
+            "submitted_at": self.submitted_at,
+            "prompt_tokens": self.prompt_token_count,
+            "completion_tokens": self.completion_tokens,
+            "session_id": self.session.session_id if self.session else None,
+            "deadline": self.deadline,
+        }
+
+
+class GenerationExecutor:
+    """Thread de génération propriétaire du modèle et sa file de jobs"""
+
+    def __init__(self, max_queue_size: int = 64):
+        self.max_queue_size = max_queue_size
+        self.model = None
+        self.template: Optional[ChatTemplate] = None
+        self.context: Optional[ContextWindowManager] = None
+        self.scheduler = None
+        self._queue: "queue.Queue[Optional[GenerationJob]]" = queue.Queue()
+        self._pending: List[GenerationJob] = []
+        self._active: List[GenerationJob] = []
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._running = False
+        self.completed_jobs = 0
+        self.failed_jobs = 0
+        self.cancelled_jobs = 0
+        self.tokens_saved = 0
+
+    def start(self, model):
+        """Démarre le thread de génération avec le modèle chargé"""
+        self.model = model
+        self.template = ChatTemplate(model)
+        self.scheduler = self._create_scheduler(model)
+        config = Config.CONTEXT_CONFIG
+        self.context = ContextWindowManager(
+            self.template,
+            # Sans ordonnanceur, le contexte réel du modèle (réduit si le batching continu n'a pas démarré)
+            n_ctx=self.scheduler.slot_ctx if self.scheduler else model.n_ctx(),
+            policy=config["policy"],
+            keep_first=config["keep_first"],
+            keep_last=config["keep_last"],
+            cache_size=config["token_count_cache_size"],
+        )
+        if not self.scheduler and Config.PREFIX_CACHE_CONFIG["enabled"]:
+            # Reprise depuis le plus long préfixe en cache (séquence unique)
+            model.set_cache(prefix_cache)
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="llama-generation", daemon=True)
+        self._thread.start()
+        logger.info("🧵 Thread de génération démarré")
+
+    def _create_scheduler(self, model):
+        """Crée l'ordonnanceur de batching continu si n_parallel > 1"""
+        config = Config.get_llama_args()
+        if not Config.uses_continuous_batching():
+            return None
+        try:
+            from batching import ContinuousBatchScheduler
+
+            return ContinuousBatchScheduler(
+                model,
+                n_parallel=config["n_parallel"],
+                n_ctx=config["n_ctx"],
+                n_batch=config["n_batch"],
+                n_threads=config["n_threads"],
+                n_threads_batch=config["n_threads_batch"],
+            )
+        except Exception as e:
+            logger.warning(
+                f"⚠️ Batching continu indisponible, génération séquentielle sur {model.n_ctx()} tokens de contexte: {e}"
+            )
+            return None
+
+    def stop(self, timeout: float = 5.0):
+        """Arrête le thread de génération"""
+        if not self._thread:
+            return
+        self._running = False
+        self._queue.put(None)
+        self._thread.join(timeout)
+        self._thread = None
+        if self.scheduler:
+            self.scheduler.close()
+            self.scheduler = None
+        self.model = None
+        logger.info("🧵 Thread de génération arrêté")
+
+    @property
+    def is_running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    @property
+    def is_accepting(self) -> bool:
+        return self._running
+
+    def submit(self, request_id: str, messages: List[Dict[str, str]], params: Dict[str, Any],
+               stream: bool = True, session=None, deadline: Optional[float] = None) -> GenerationJob:
+        """Soumet un job depuis la boucle d'événements"""
+        if not self.is_running:
+            raise RuntimeError("Exécuteur de génération non démarré")
+
+        with self._lock:
+            if len(self._pending) >= self.max_queue_size:
+                raise QueueFullError(f"File de génération pleine ({self.max_queue_size} requêtes)")
+            job = GenerationJob(request_id, messages, params, stream, asyncio.get_running_loop(), session, deadline)
+            job.model_name = os.path.basename(getattr(self.model, "model_path", "") or "")
+            self._pending.append(job)
+
+        self._queue.put(job)
+        return job
+
+    # --- Thread de génération ---
+
+    def next_job(self, block: bool = True) -> Optional[GenerationJob]:
+        """Retire le prochain job de la file (None si vide ou arrêt)"""
+        while True:
+            try:
+                job = self._queue.get(block=block)
+            except queue.Empty:
+                return None
+            if job is None:
+                self._running = False
+                return None
+
+            with self._lock:
+                self._pending.remove(job)
+                self._active.append(job)
+            job.status = "running"
+            job.started_at = time.time()
+
+            # Client parti ou échéance dépassée pendant l'attente : le job n'occupe pas le modèle
+            if job.interrupt_reason or job.check_deadline():
+                self.finish_job(job, job.interrupt_reason)
+                continue
+            return job
+
+    def prepare_job(self, job: GenerationJob):
+        """Ajuste l'historique à la fenêtre de contexte et tokenise le prompt"""
+        max_tokens = job.params.get("max_tokens", 2048)
+        job.messages, job.prompt_tokens, effective_max_tokens, job.context_window = self.context.fit(
+            job.messages, max_tokens
+        )
+        job.prompt_token_count = len(job.prompt_tokens)
+        if effective_max_tokens != max_tokens:
+            job.params = dict(job.params, max_tokens=effective_max_tokens)
+
+    def finish_job(self, job: GenerationJob, finish_reason: str = "stop", error: Optional[Exception] = None):
+        """Clôture un job (succès ou erreur)"""
+        with self._lock:
+            if job in self._active:
+                self._active.remove(job)
+
+        if job.session is not None:
+            if error is not None or (job.interrupt_reason and not job.text):
+                session_manager.end_turn(job.session, None)
+            else:
+                n_tokens = job.session_state.n_tokens if job.session_state is not None else 0
+                session_manager.end_turn(job.session, job.text, job.session_state, n_tokens)
+            job.session_state = None
+
+        if error is not None:
+            self.failed_jobs += 1
+            logger.error(f"Erreur de génération [{job.request_id}]: {error}")
+            job.fail(error)
+        else:
+            self.completed_jobs += 1
+            if finish_reason == "cancelled":
+                self.cancelled_jobs += 1
+                self.tokens_saved += max(0, job.params.get("max_tokens", 2048) - job.completion_tokens)
+            job.complete(finish_reason)
+
+    def _run(self):
+        """Boucle principale du thread de génération"""
+        # Les threads de calcul llama.cpp créés par ce thread héritent de son affinité
+        cpu_affinity.pin_inference()
+        if self.scheduler:
+            self.scheduler.run(self)
+            return
+
+        while self._running:
+            job = self.next_job()
+            if job is None:
+                break
+            try:
+                self.prepare_job(job)
+                finish_reason = self._execute(job)
+                self.finish_job(job, finish_reason)
+            except Exception as e:
+                self.finish_job(job, error=e)
+
+    def _execute(self, job: GenerationJob) -> str:
+        """Génère une réponse sur la séquence unique du modèle"""
+        if job.session is not None:
+            self._restore_session(job)
+
+        # Tokens déjà dans le contexte courant, ou repris d'un état du cache de préfixes
+        current_prefix = _common_prefix_length(self.model.input_ids[:self.model.n_tokens], job.prompt_tokens)
+        prefix_cache.take_served_prefix()
+
+        finish_reason = None
+        response = self.model.create_completion(
+            prompt=job.prompt_tokens,
+            stream=True,
+            stopping_criteria=job.on_token,
+            **job.params
+        )
+        for chunk in response:
+            choice = chunk["choices"][0]
+            job.emit_text(choice.get("text", ""))
+            finish_reason = choice.get("finish_reason") or finish_reason
+
+        # llama-cpp ne charge l'état servi que s'il prolonge le contexte courant
+        served = prefix_cache.take_served_prefix()
+        if served > current_prefix:
+            prefix_cache.record_reuse(served)
+        cached = max(current_prefix, served)
+        job.prompt_tokens_cached = min(cached, max(0, len(job.prompt_tokens) - 1))
+
+        if job.session is not None:
+            # Instantané KV du tour : le prochain n'évaluera que le nouveau message
+            job.session_state = self.model.save_state()
+        if job.interrupt_reason:
+            return job.interrupt_reason
+        return finish_reason or "stop"
+
+    def _restore_session(self, job: GenerationJob):
+        """Recharge l'état KV de la session si le contexte courant en couvre moins"""
+        state = session_manager.load_state(job.session)
+        if state is None:
+            return
+        current = self.model.input_ids[:self.model.n_tokens]
+        if _common_prefix_length(current, job.prompt_tokens) < _common_prefix_length(
+            state.input_ids[:state.n_tokens], job.prompt_tokens
+        ):
+            self.model.load_state(state)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """État de la file d'attente de génération"""
+        with self._lock:
+            pending = [job.to_dict() for job in self._pending]
+            active = [job.to_dict() for job in self._active]
+
+        stats = {
+            "running": self.is_running,
+            "mode": "continuous_batching" if self.scheduler else "sequential",
+            "queue_depth": len(pending),
+            "max_queue_size": self.max_queue_size,
+            "active": active,
+            "queued": pending,
+            "completed_jobs": self.completed_jobs,
+            "failed_jobs": self.failed_jobs,
+            "cancelled_jobs": self.cancelled_jobs,
+            "tokens_saved_by_cancellation": self.tokens_saved,
+        }
+        if self.context:
+            stats["context_window"] = self.context.get_stats()
+        if self.scheduler:
+            stats["batching"] = self.scheduler.get_stats()
+        else:
+            stats["prefix_cache"] = prefix_cache.get_stats()
+            draft_model = getattr(self.model, "draft_model", None)
+            if draft_model is not None:
+                stats["speculative"] = draft_model.get_stats()
+        return stats
+
+
+# Instance globale
+generation_executor = GenerationExecutor(Config.GENERATION_CONFIG["max_queue_size"])
@@ -195,6 +195,8 @@ cd ../..
 print_status "ÉTAPE 6: Création de la structure du projet..."
 mkdir -p models
 mkdir -p logs
+mkdir -p kv_cache  # États KV débordés sur disque (ProtectSystem=strict : créé avant le démarrage)
+mkdir -p response_cache  # Second niveau disque du cache de réponses (si disk_enabled)
 mkdir -p static
 mkdir -p templates
 mkdir -p config
@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+"""
+Stockage disque des instantanés KV pour l'API Llama.cpp
+
+Les états llama.cpp des sessions inactives et des préfixes évincés de la RAM
+sont écrits dans des fichiers binaires relus par mmap à la demande. Le
+répertoire est borné en taille (LRU tenue en mémoire, reconstruite au
+démarrage depuis la date d'accès des fichiers) et survit à un redémarrage
+du serveur.
+
+Format d'un fichier .kv (little-endian) :
+    en-tête   magic, version, n_ctx, n_tokens, n_vocab, state_size, seed
+    tokens    int32[n_tokens]
+    logits    float32[n_vocab]   dernière ligne des scores (échantillonnage)
+    état      uint8[state_size]  llama_state_get_data()
+"""
+
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, List, Optional, Any, Tuple
+
+import numpy as np
+
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+_MAGIC = b"LKVS"
+_VERSION = 1
+_HEADER = struct.Struct("<4sIIIIQq")
+
+
+def prefix_key(tokens) -> str:
+    """Clé disque d'un préfixe de tokens"""
+    data = np.asarray(tokens, dtype=np.int32).tobytes()
+    return "prefix-" + hashlib.sha1(data).hexdigest()
+
+
+def _make_state(**fields):
+    """Construit un LlamaState (le champ seed n'existe pas dans les anciennes versions)"""
+    try:
+        from llama_cpp import LlamaState
+    except ImportError:
+        # Backend synthétique (fake_backend.py)
+        from fake_backend import FakeLlamaState as LlamaState
+
+    try:
+        return LlamaState(**fields)
+    except TypeError:
+        fields.pop("seed", None)
+        return LlamaState(**fields)
+
+
+class DiskStateStore:
+    """Répertoire d'instantanés KV borné en octets avec éviction LRU"""
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._sizes: "OrderedDict[str, int]" = OrderedDict()  # Du moins au plus récemment utilisé
+        self._total_bytes = 0  # Somme de _sizes, tenue à jour sous le verrou
+
+        # Statistiques
+        self.writes = 0
+        self.reads = 0
+        self.read_misses = 0
+        self.evictions = 0
+        self.bytes_written = 0
+        self.read_time = 0.0
+
+    def open(self):
+        """Crée le répertoire et indexe les fichiers existants"""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        with self._lock:
+            files = sorted(
+                ((path.stat(), path.stem) for path in self.directory.glob("*.kv")),
+                key=lambda item: item[0].st_mtime
+            )
+            self._sizes = OrderedDict((key, stat.st_size) for stat, key in files)
+            self._total_bytes = sum(self._sizes.values())
+            entries = len(self._sizes)
+        logger.info(f"💾 Stockage KV: {entries} instantané(s), {self.total_bytes / (1024**2):.1f}MB")
+
+    def partition(self, index: int, n_workers: int):
+        """Worker forké : sous-répertoire worker-<index> et part max_bytes / n_workers du budget
+
+        Chaque processus tient son propre index : partager le répertoire ferait
+        de max_bytes une limite par worker, et les workers écriraient les mêmes
+        fichiers temporaires.
+        """
+        # Le verrou hérité a pu être pris par un thread du parent au moment du fork
+        self._lock = threading.Lock()
+        self.directory = self.directory / f"worker-{index}"
+        self.max_bytes = self.max_bytes // n_workers
+        self.open()
+
+    @property
+    def total_bytes(self) -> int:
+        with self._lock:
+            return self._total_bytes
+
+    def _path(self, key: str) -> Path:
+        return self.directory / f"{key}.kv"
+
+    def __contains__(self, key: str) -> bool:
+        with self._lock:
+            return key in self._sizes
+
+    def keys(self, prefix: str = "") -> List[str]:
+        with self._lock:
+            return [key for key in self._sizes if key.startswith(prefix)]
+
+    def put(self, key: str, state) -> bool:
+        """Écrit un LlamaState sur disque (écriture atomique)"""
+        n_tokens = int(state.n_tokens)
+        tokens = np.ascontiguousarray(state.input_ids[:n_tokens], dtype=np.int32)
+        scores = getattr(state, "scores", None)
+        if scores is not None and len(scores):
+            last_logits = np.ascontiguousarray(scores[-1], dtype=np.float32)
+        else:
+            last_logits = np.zeros(0, dtype=np.float32)
+        llama_state = state.llama_state
+        state_size = int(state.llama_state_size)
+        header = _HEADER.pack(
+            _MAGIC, _VERSION, len(state.input_ids), n_tokens, len(last_logits),
+            state_size, int(getattr(state, "seed", 0) or 0)
+        )
+
+        size = len(header) + tokens.nbytes + last_logits.nbytes + state_size
+        if size > self.max_bytes:
+            return False
+
+        path = self._path(key)
+        tmp_path = path.with_suffix(".tmp")
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(header)
+                f.write(tokens.tobytes())
+                f.write(last_logits.tobytes())
+                f.write(memoryview(llama_state)[:state_size])
+            os.replace(tmp_path, path)
+        except OSError as e:
+            # Disque plein ou répertoire indisponible : l'état reste simplement hors disque
+            logger.warning(f"Écriture de l'instantané KV {key} impossible: {e}")
+            try:
+                tmp_path.unlink()
+            except OSError:
+                pass
+            return False
+
+        with self._lock:
+            self._total_bytes += size - self._sizes.get(key, 0)
+            self._sizes[key] = size
+            self._sizes.move_to_end(key)
+            self.writes += 1
+            self.bytes_written += size
+            self._evict(keep=key)
+        return True
+
+    def _read_header(self, mm) -> Tuple[int, int, int, int, int]:
+        magic, version, n_ctx, n_tokens, n_vocab, state_size, seed = _HEADER.unpack_from(mm, 0)
+        if magic != _MAGIC or version != _VERSION:
+            raise ValueError("Format d'instantané KV inconnu")
+        return n_ctx, n_tokens, n_vocab, state_size, seed
+
+    def read_tokens(self, key: str) -> Optional[List[int]]:
+        """Tokens couverts par un instantané (sans charger l'état)"""
+        try:
+            with open(self._path(key), "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                _, n_tokens, _, _, _ = self._read_header(mm)
+                return np.frombuffer(mm, dtype=np.int32, count=n_tokens, offset=_HEADER.size).tolist()
+        except (OSError, ValueError) as e:
+            logger.warning(f"Instantané KV illisible {key}: {e}")
+            return None
+
+    def get(self, key: str):
+        """Relit un LlamaState depuis le disque (None si absent)"""
+        with self._lock:
+            if key not in self._sizes:
+                self.read_misses += 1
+                return None
+            self._sizes.move_to_end(key)
+
+        start = time.time()
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                n_ctx, n_tokens, n_vocab, state_size, seed = self._read_header(mm)
+                offset = _HEADER.size
+                input_ids = np.zeros(n_ctx, dtype=np.intc)
+                input_ids[:n_tokens] = np.frombuffer(mm, dtype=np.int32, count=n_tokens, offset=offset)
+                offset += n_tokens * 4
+                scores = np.frombuffer(mm, dtype=np.float32, count=n_vocab, offset=offset).reshape(1, n_vocab).copy()
+                offset += n_vocab * 4
+                llama_state = mm[offset:offset + state_size]
+            os.utime(path)  # Ordre LRU retrouvé au prochain démarrage
+        except (OSError, ValueError) as e:
+            logger.warning(f"Instantané KV illisible {key}: {e}")
+            self.delete(key)
+            self.read_misses += 1
+            return None
+
+        self.reads += 1
+        self.read_time += time.time() - start
+        return _make_state(
+            input_ids=input_ids,
+            scores=scores,
+            n_tokens=n_tokens,
+            llama_state=llama_state,
+            llama_state_size=state_size,
+            seed=seed,
+        )
+
+    def delete(self, key: str):
+        with self._lock:
+            self._total_bytes -= self._sizes.pop(key, 0)
+        try:
+            self._path(key).unlink()
+        except FileNotFoundError:
+            pass
+
+    def _evict(self, keep: str):
+        """Supprime les instantanés les moins récemment utilisés au-delà du budget"""
+        while self._total_bytes > self.max_bytes:
+            key = next(iter(self._sizes))
+            if key == keep:  # keep vient d'être placé en fin : il ne reste plus rien d'autre
+                break
+            self._total_bytes -= self._sizes.pop(key)
+            try:
+                self._path(key).unlink()
+            except FileNotFoundError:
+                pass
+            self.evictions += 1
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Statistiques du stockage disque"""
+        with self._lock:
+            entries, total_bytes = len(self._sizes), self._total_bytes
+        return {
+            "enabled": Config.KV_STORE_CONFIG["enabled"],
+            "directory": str(self.directory),
+            "entries": entries,
+            "bytes": total_bytes,
+            "max_bytes": self.max_bytes,
+            "writes": self.writes,
+            "reads": self.reads,
+            "read_misses": self.read_misses,
+            "evictions": self.evictions,
+            "avg_read_time": round(self.read_time / self.reads, 4) if self.reads else 0,
+        }
+
+
+# Instance globale
+kv_store = DiskStateStore(Config.KV_STORE_CONFIG["directory"], Config.KV_STORE_CONFIG["max_bytes"])
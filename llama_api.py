@@ -9,29 +9,38 @@ from typing import Dict, List, Optional, Any, AsyncGenerator
 from contextlib import asynccontextmanager
 
 import uvicorn
-from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect, Depends, Request
+from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect, Depends, Request, Query
+from starlette.requests import HTTPConnection
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse, StreamingResponse
+from fastapi.responses import HTMLResponse, StreamingResponse, PlainTextResponse, JSONResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from pydantic import BaseModel, Field
-import psutil
 
 # Ajout du chemin vers llama.cpp
 sys.path.append('./llama.cpp')
 
 from config import Config
-from logs import performance_logger
-
-# Configuration du logging
-logging.basicConfig(
-    level=getattr(logging, Config.LOGGING_CONFIG["level"]),
-    format=Config.LOGGING_CONFIG["format"],
-    handlers=[
-        logging.FileHandler(Config.LOGGING_CONFIG["file"]),
-        logging.StreamHandler()
-    ]
-)
+from logs import performance_logger, log_pipeline
+from metrics import metrics
+from system_sampler import system_sampler
+from perf_store import perf_store
+from fake_backend import load_fake_model
+from autotune import apply_profile
+from cpu_affinity import cpu_affinity
+from generation import generation_executor, QueueFullError
+from chat_template import ChatTemplate, tokenization_cache
+from worker_pool import worker_pool, gpu_offload_active
+from prefix_cache import prefix_cache
+from sessions import session_manager, SessionNotFoundError, SessionBusyError
+from kv_store import kv_store
+from speculative import load_draft_model
+from response_cache import response_cache, is_deterministic, make_cache_key, CachedResponseJob
+from single_flight import single_flight
+from streaming import TokenStream, SSE_DONE
+from admission import admission_controller, AdmissionRejected
+
+# Logging : pipeline asynchrone de logs.py (fichiers JSON lines avec rotation, console)
 logger = logging.getLogger(__name__)
 
 # Modèles Pydantic
@@ -46,6 +55,26 @@ class ChatRequest(BaseModel):
     max_tokens: int = Field(default=2048, ge=1, le=4096, description="Nombre maximum de tokens")
     stream: bool = Field(default=True, description="Activer le streaming")
     system_prompt: Optional[str] = Field(default=None, description="Prompt système")
+    seed: Optional[int] = Field(default=None, description="Seed d'échantillonnage (réponse reproductible)")
+    latency_budget_ms: Optional[int] = Field(default=None, ge=1, description="Budget de latence de bout en bout (ms)")
+
+class SessionCreateRequest(BaseModel):
+    model: str = Field(default="mistral-7b-instruct", description="Modèle à utiliser")
+    system_prompt: Optional[str] = Field(default=None, description="Prompt système")
+
+class SessionMessageRequest(BaseModel):
+    content: str = Field(..., description="Nouveau message utilisateur")
+    temperature: float = Field(default=0.8, ge=0.0, le=2.0, description="Température de génération")
+    max_tokens: int = Field(default=2048, ge=1, le=4096, description="Nombre maximum de tokens")
+    stream: bool = Field(default=False, description="Activer le streaming")
+    latency_budget_ms: Optional[int] = Field(default=None, ge=1, description="Budget de latence de bout en bout (ms)")
+
+class TokenizeRequest(BaseModel):
+    messages: Optional[List[ChatMessage]] = Field(default=None, description="Messages à rendre avec le template de chat")
+    text: Optional[str] = Field(default=None, description="Texte brut (à défaut de messages)")
+    system_prompt: Optional[str] = Field(default=None, description="Prompt système")
+    max_tokens: int = Field(default=0, ge=0, le=4096, description="Tokens à réserver pour la réponse")
+    return_tokens: bool = Field(default=True, description="Inclure les ids de tokens")
 
 class ChatResponse(BaseModel):
     id: str
@@ -54,6 +83,8 @@ class ChatResponse(BaseModel):
     model: str
     choices: List[Dict[str, Any]]
     usage: Dict[str, int]
+    context_window: Optional[Dict[str, Any]] = None
+    timings: Optional[Dict[str, Any]] = None
 
 class HealthResponse(BaseModel):
     status: str
@@ -61,22 +92,73 @@ class HealthResponse(BaseModel):
     hardware_info: Dict[str, Any]
     memory_usage: Dict[str, Any]
     performance_stats: Dict[str, Any]
+    generation_queue: Dict[str, Any]
+    sessions: Dict[str, Any]
 
 # Variables globales
 llama_model = None
-conversation_history: Dict[str, List[ChatMessage]] = {}
+chat_template = None
+# n_ctx du contexte propre au Llama quand le batching continu porte les séquences
+BATCHING_LLAMA_N_CTX = 512
+tuning_profile = None
+# Exécuteur local, ou pool de workers forkés si API_CONFIG["workers"] > 1
+generator = generation_executor
+
+# Jauges lues au moment de la collecte
+metrics.gauge("llama_model_loaded", "Modèle chargé (1) ou non (0)", function=lambda: llama_model is not None)
+metrics.gauge("llama_requests_in_flight", "Générations admises non terminées",
+              function=lambda: admission_controller.in_flight)
+metrics.gauge("llama_estimated_queue_wait_seconds", "Attente estimée d'une nouvelle requête",
+              function=admission_controller.estimated_wait)
+metrics.gauge("llama_active_sessions", "Sessions de chat actives",
+              function=lambda: session_manager.get_stats()["active_sessions"])
+metrics.gauge("llama_cpu_percent", "Utilisation CPU (dernier relevé)",
+              function=lambda: system_sampler.latest()["cpu_percent"])
+metrics.gauge("llama_memory_percent", "Utilisation RAM (dernier relevé)",
+              function=lambda: system_sampler.latest()["memory_percent"])
+metrics.gauge("llama_process_rss_gigabytes", "Mémoire résidente du serveur et des workers",
+              function=lambda: system_sampler.latest()["process_rss_gb"])
+metrics.gauge("llama_load_average_1m", "Charge moyenne sur 1 minute",
+              function=lambda: system_sampler.latest()["load_1m"])
+
+async def session_cleanup_task():
+    """Supprime périodiquement les sessions inactives et écrit les états KV inactifs sur disque"""
+    interval = Config.MEMORY_CONFIG["cleanup_interval"]
+    if Config.KV_STORE_CONFIG["enabled"]:
+        interval = min(interval, Config.KV_STORE_CONFIG["session_spill_after"])
+    while True:
+        await asyncio.sleep(interval)
+        session_manager.cleanup()
+        if Config.KV_STORE_CONFIG["enabled"]:
+            await asyncio.to_thread(session_manager.spill_idle, Config.KV_STORE_CONFIG["session_spill_after"])
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Gestion du cycle de vie de l'application"""
-    global llama_model
+    global llama_model, chat_template, generator, tuning_profile
+    
+    # Réglage mesuré par autotune.py pour cette machine et ce modèle (sinon règles matérielles)
+    tuning_profile = apply_profile()
+    
+    # Cœurs de calcul et de service (avant le démarrage des threads de fond, qui héritent de l'affinité)
+    cpu_affinity.apply()
     
-    # Optimisation de la configuration
-    Config.optimize_for_hardware()
+    # Relevés système en tâche de fond (lus par /health et les logs)
+    system_sampler.start()
     
     # Log de la configuration
     performance_logger.log_configuration(Config.get_llama_args())
     
+    # Stockage disque des états KV (sessions et préfixes)
+    if Config.KV_STORE_CONFIG["enabled"]:
+        kv_store.open()
+        prefix_cache.attach_store(kv_store)
+        session_manager.attach_store(kv_store)
+    
+    # Second niveau disque du cache de réponses
+    if Config.RESPONSE_CACHE_CONFIG["enabled"] and Config.RESPONSE_CACHE_CONFIG["disk_enabled"]:
+        response_cache.open()
+    
     # Chargement du modèle
     try:
         logger.info("🚀 Chargement du modèle llama.cpp...")
@@ -87,6 +169,17 @@ async def lifespan(app: FastAPI):
         if llama_model:
             performance_logger.log_model_load(Config.LLAMA_CONFIG["model_path"], load_time)
             logger.info("✅ Modèle chargé avec succès")
+            chat_template = ChatTemplate(llama_model)
+            if Config.API_CONFIG["workers"] > 1:
+                if gpu_offload_active():
+                    logger.error(
+                        f"❌ workers={Config.API_CONFIG['workers']} ignoré : le déchargement GPU ne survit pas"
+                        " au fork, génération dans le processus principal"
+                    )
+                else:
+                    # Un seul chargement, puis fork des workers qui partagent les poids
+                    generator = worker_pool
+            generator.start(llama_model)
         else:
             logger.error("❌ Échec du chargement du modèle")
             
@@ -95,14 +188,41 @@ async def lifespan(app: FastAPI):
         performance_logger.log_error("system", e, "model_loading")
         llama_model = None
     
+    cleanup_task = asyncio.create_task(session_cleanup_task())
+    
     yield
     
     # Nettoyage
+    cleanup_task.cancel()
+    generator.stop()
+    system_sampler.stop()
+    perf_store.close()
+    if Config.KV_STORE_CONFIG["enabled"]:
+        session_manager.spill_idle(0, force=True)
     if llama_model:
         del llama_model
         logger.info("🧹 Modèle déchargé")
 
 def load_llama_model():
+    """Charge le modèle du backend configuré (BACKEND_CONFIG["type"])"""
+    backend = Config.BACKEND_CONFIG["type"]
+    loader = MODEL_BACKENDS.get(backend)
+    if loader is None:
+        logger.error(f"❌ Backend inconnu: {backend} ({', '.join(MODEL_BACKENDS)})")
+        return None
+    return loader()
+
+def load_fake_backend():
+    """Backend synthétique : débits simulés, texte déterministe, aucun modèle requis"""
+    config = Config.get_llama_args()
+    fake_config = Config.BACKEND_CONFIG["fake"]
+    logger.info(
+        f"🧪 Backend synthétique: prefill {fake_config['prompt_tokens_per_second']} tok/s,"
+        f" décodage {fake_config['decode_tokens_per_second']} tok/s"
+    )
+    return load_fake_model(config, fake_config)
+
+def load_llama_cpp_model():
     """Charge le modèle llama.cpp avec la configuration optimisée"""
     try:
         from llama_cpp import Llama
@@ -116,9 +236,18 @@ def load_llama_model():
         logger.info(f"📦 Chargement du modèle: {model_path}")
         logger.info(f"⚙️ Configuration: {config}")
         
+        # Modèle brouillon pour le décodage spéculatif (optionnel, vocabulaire vérifié avant chargement)
+        draft_model = load_draft_model(config)
+        
+        # Batching continu : l'ordonnanceur crée son propre contexte de n_ctx tokens ; celui du Llama ne
+        # sert qu'à la tokenisation et au repli séquentiel, un n_ctx minimal évite de doubler le cache KV
+        n_ctx = config["n_ctx"]
+        if Config.uses_continuous_batching():
+            n_ctx = min(n_ctx, BATCHING_LLAMA_N_CTX)
+        
         model = Llama(
             model_path=model_path,
-            n_ctx=config["n_ctx"],
+            n_ctx=n_ctx,
             n_batch=config["n_batch"],
             n_gpu_layers=config["n_gpu_layers"],
             n_threads=config["n_threads"],
@@ -168,6 +297,7 @@ def load_llama_model():
             mtest=config["mtest"],
             verbose_prompt=config["verbose_prompt"],
             m_eval=config["m_eval"],
+            draft_model=draft_model,
         )
         
         return model
@@ -179,6 +309,11 @@ def load_llama_model():
         logger.error(f"❌ Erreur lors du chargement du modèle: {e}")
         return None
 
+MODEL_BACKENDS = {
+    "llama_cpp": load_llama_cpp_model,
+    "fake": load_fake_backend,
+}
+
 # Création de l'application FastAPI
 app = FastAPI(
     title="Llama.cpp API",
@@ -201,17 +336,142 @@ app.mount("/static", StaticFiles(directory="static"), name="static")
 templates = Jinja2Templates(directory="templates")
 
 def get_hardware_info() -> Dict[str, Any]:
-    """Récupère les informations matérielles"""
+    """Récupère les informations matérielles (dernier relevé de l'échantillonneur)"""
+    snapshot = system_sampler.latest()
     return {
-        "cpu_count": psutil.cpu_count(),
-        "cpu_percent": psutil.cpu_percent(interval=1),
-        "memory_total": psutil.virtual_memory().total,
-        "memory_available": psutil.virtual_memory().available,
-        "memory_percent": psutil.virtual_memory().percent,
-        "disk_usage": psutil.disk_usage('/').percent,
+        "cpu_count": os.cpu_count(),
+        "cpu_percent": snapshot["cpu_percent"],
+        "memory_total_gb": snapshot["memory_total_gb"],
+        "memory_available_gb": snapshot["memory_available_gb"],
+        "memory_percent": snapshot["memory_percent"],
+        "process_rss_gb": snapshot["process_rss_gb"],
+        "disk_usage": snapshot["disk_percent"],
+        "load_average": [snapshot["load_1m"], snapshot["load_5m"], snapshot["load_15m"]],
+        "sampled_at": snapshot["timestamp"],
         "config": Config.get_hardware_info()
     }
 
+def get_memory_usage() -> Dict[str, Any]:
+    """Utilisation de la RAM (dernier relevé)"""
+    snapshot = system_sampler.latest()
+    return {
+        "ram_used_gb": snapshot["memory_used_gb"],
+        "ram_total_gb": snapshot["memory_total_gb"],
+        "ram_percent": snapshot["memory_percent"],
+        "process_rss_gb": snapshot["process_rss_gb"],
+    }
+
+def build_messages(messages: List[ChatMessage], system_prompt: Optional[str] = None) -> List[Dict[str, str]]:
+    """Convertit les messages Pydantic au format llama.cpp"""
+    result = [{"role": msg.role, "content": msg.content} for msg in messages]
+    
+    # Ajout du prompt système si fourni
+    if system_prompt:
+        result.insert(0, {"role": "system", "content": system_prompt})
+    
+    return result
+
+def client_id(connection: HTTPConnection) -> str:
+    """Identifiant du client pour le contrôle d'admission"""
+    return connection.client.host if connection.client else "unknown"
+
+def request_deadline(start_time: float, latency_budget_ms: Optional[int]) -> Optional[float]:
+    """Échéance absolue d'une requête à partir de son budget de latence"""
+    return start_time + latency_budget_ms / 1000 if latency_budget_ms else None
+
+def log_deadline_miss(job):
+    """Callback de fin de job : échéance atteinte en file ou en cours de génération"""
+    if job.finish_reason == "deadline":
+        performance_logger.log_deadline_miss(job.request_id, "truncated" if job.completion_tokens else "expired_in_queue")
+
+def submit_generation(request_id: str, messages: List[Dict[str, str]], params: Dict[str, Any], stream: bool,
+                      session=None, client: str = "unknown", deadline: Optional[float] = None):
+    """Soumet une génération après contrôle d'admission (400/429/503 avec Retry-After)"""
+    cost = 0
+    if Config.ADMISSION_CONFIG["enabled"]:
+        try:
+            cost = admission_controller.admit(client, messages, params["max_tokens"], deadline)
+        except AdmissionRejected as e:
+            if e.reason == "deadline":
+                performance_logger.log_deadline_miss(request_id, "rejected")
+            raise HTTPException(status_code=e.status_code, detail=str(e), headers=e.headers)
+    
+    try:
+        job = generator.submit(request_id, messages, params, stream=stream, session=session, deadline=deadline)
+    except Exception as e:
+        if Config.ADMISSION_CONFIG["enabled"]:
+            admission_controller.release(client, cost, params["max_tokens"])
+        if isinstance(e, QueueFullError):
+            raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
+        raise
+    
+    if Config.ADMISSION_CONFIG["enabled"]:
+        job.add_finish_callback(lambda job: admission_controller.release(client, cost, params["max_tokens"], job))
+    job.add_finish_callback(performance_logger.log_generation)
+    if deadline is not None:
+        job.add_finish_callback(log_deadline_miss)
+    return job
+
+def submit_chat(request_id: str, messages: List[Dict[str, str]], model: str, params: Dict[str, Any], stream: bool,
+                client: str = "unknown", deadline: Optional[float] = None):
+    """Soumet une génération, ou rejoue / partage celle d'une requête déterministe identique"""
+    request_key = make_cache_key(messages, model, params) if is_deterministic(params) else None
+    # Une requête à échéance ne partage pas de génération : son budget tronquerait celle des autres
+    coalesce = request_key is not None and deadline is None and Config.GENERATION_CONFIG["coalesce_identical"]
+    
+    if request_key is not None and Config.RESPONSE_CACHE_CONFIG["enabled"]:
+        cached = response_cache.get(request_key)
+        if cached is not None:
+            return CachedResponseJob(request_id, cached, stream)
+    
+    if coalesce:
+        follower = single_flight.join(request_key, request_id, stream)
+        if follower is not None:
+            return follower
+    
+    # Une génération partagée est toujours diffusée : des abonnés en streaming peuvent la rejoindre
+    job = submit_generation(request_id, messages, params, stream or coalesce, client=client, deadline=deadline)
+    if request_key is not None and Config.RESPONSE_CACHE_CONFIG["enabled"]:
+        job.add_done_callback(lambda response: response_cache.put(request_key, response))
+    if coalesce:
+        return single_flight.start(request_key, job, request_id, stream)
+    return job
+
+async def stream_job(job, request_id: str, start_time: float) -> AsyncGenerator[str, None]:
+    """Diffuse les chunks d'un job au format SSE (tokens regroupés par trame)"""
+    stream = TokenStream(job, "sse")
+    completed = False
+    
+    try:
+        async for frames in stream.batches():
+            yield "".join(frames)
+        completed = True
+        
+        yield SSE_DONE
+        
+        # Log de la fin de la requête
+        response = await job.wait()
+        response_time = time.time() - start_time
+        performance_logger.log_request_end(request_id, response_time, response["usage"]["completion_tokens"])
+        
+    except Exception as e:
+        performance_logger.log_error(request_id, e, "streaming")
+        logger.error(f"Erreur lors du streaming: {e}")
+        yield stream.encoder.encode_error(e)
+    
+    finally:
+        # Client déconnecté (ou trop lent) : génération interrompue au prochain token
+        if not completed:
+            job.cancel()
+
+def sse_response(job, request_id: str, start_time: float) -> StreamingResponse:
+    """Réponse text/event-stream d'un job"""
+    return StreamingResponse(
+        stream_job(job, request_id, start_time),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "Connection": "keep-alive", "X-Accel-Buffering": "no"}
+    )
+
 @app.get("/", response_class=HTMLResponse)
 async def root(request: Request):
     """Page d'accueil avec interface web"""
@@ -222,21 +482,47 @@ async def health_check():
     """Vérification de l'état de l'API"""
     # Récupération des stats de performance
     performance_stats = performance_logger.get_performance_stats()
+    performance_stats["prefix_cache"] = prefix_cache.get_stats()
+    performance_stats["kv_store"] = kv_store.get_stats()
+    performance_stats["response_cache"] = response_cache.get_stats()
+    performance_stats["single_flight"] = single_flight.get_stats()
+    performance_stats["admission"] = admission_controller.get_stats()
+    performance_stats["tokenizer_cache"] = tokenization_cache.get_stats()
+    performance_stats["log_pipeline"] = log_pipeline.get_stats()
+    performance_stats["system"] = system_sampler.get_stats()
+    performance_stats["perf_store"] = perf_store.get_stats()
     
     return HealthResponse(
         status="healthy" if llama_model else "unhealthy",
         model_loaded=llama_model is not None,
         hardware_info=get_hardware_info(),
-        memory_usage={
-            "ram_used_gb": round(psutil.virtual_memory().used / (1024**3), 2),
-            "ram_total_gb": round(psutil.virtual_memory().total / (1024**3), 2),
-            "ram_percent": psutil.virtual_memory().percent
-        },
-        performance_stats=performance_stats
+        memory_usage=get_memory_usage(),
+        performance_stats=performance_stats,
+        generation_queue=generator.get_stats(),
+        sessions=session_manager.get_stats()
     )
 
+@app.get("/livez")
+async def liveness():
+    """Sonde de vivacité : le processus répond (aucun appel système ni modèle)"""
+    return {"status": "ok"}
+
+@app.get("/readyz")
+async def readiness():
+    """Sonde de disponibilité : modèle chargé et file de génération ouverte"""
+    reasons = []
+    if llama_model is None:
+        reasons.append("model_not_loaded")
+    if not generator.is_running:
+        reasons.append("generator_not_running")
+    elif not generator.is_accepting:
+        reasons.append("generator_not_accepting")
+    if reasons:
+        return JSONResponse(status_code=503, content={"status": "not_ready", "reasons": reasons})
+    return {"status": "ready"}
+
 @app.post("/v1/chat/completions", response_model=ChatResponse)
-async def chat_completions(request: ChatRequest):
+async def chat_completions(request: ChatRequest, http_request: Request):
     """Endpoint principal pour les conversations"""
     if not llama_model:
         raise HTTPException(status_code=503, detail="Modèle non chargé")
@@ -250,24 +536,20 @@ async def chat_completions(request: ChatRequest):
     
     start_time = time.time()
     
+    messages = build_messages(request.messages, request.system_prompt)
+    params = {
+        "temperature": request.temperature,
+        "max_tokens": request.max_tokens,
+        "stop": Config.LLAMA_CONFIG["stop"]
+    }
+    if request.seed is not None:
+        params["seed"] = request.seed
+    job = submit_chat(request_id, messages, request.model, params, stream=False, client=client_id(http_request),
+                      deadline=request_deadline(start_time, request.latency_budget_ms))
+    
     try:
-        # Préparation des messages
-        messages = []
-        for msg in request.messages:
-            messages.append({"role": msg.role, "content": msg.content})
-        
-        # Ajout du prompt système si fourni
-        if request.system_prompt:
-            messages.insert(0, {"role": "system", "content": request.system_prompt})
-        
-        # Génération de la réponse
-        response = llama_model.create_chat_completion(
-            messages=messages,
-            temperature=request.temperature,
-            max_tokens=request.max_tokens,
-            stream=request.stream,
-            stop=Config.LLAMA_CONFIG["stop"]
-        )
+        # Génération de la réponse (thread de génération)
+        response = await job.wait()
         
         # Calcul du temps de réponse et des tokens
         response_time = time.time() - start_time
@@ -281,7 +563,9 @@ async def chat_completions(request: ChatRequest):
             created=int(time.time()),
             model=request.model,
             choices=response["choices"],
-            usage=response.get("usage", {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0})
+            usage=response.get("usage", {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}),
+            context_window=response.get("context_window"),
+            timings=response.get("timings")
         )
         
     except Exception as e:
@@ -291,7 +575,7 @@ async def chat_completions(request: ChatRequest):
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/v1/chat/completions/stream")
-async def chat_completions_stream(request: ChatRequest):
+async def chat_completions_stream(request: ChatRequest, http_request: Request):
     """Endpoint pour le streaming des réponses"""
     if not llama_model:
         raise HTTPException(status_code=503, detail="Modèle non chargé")
@@ -304,51 +588,119 @@ async def chat_completions_stream(request: ChatRequest):
     performance_logger.log_request_start(request_id, user_message, request.model)
     
     start_time = time.time()
-    tokens_generated = 0
     
-    async def generate_stream():
-        nonlocal tokens_generated
-        
-        try:
-            messages = []
-            for msg in request.messages:
-                messages.append({"role": msg.role, "content": msg.content})
-            
-            if request.system_prompt:
-                messages.insert(0, {"role": "system", "content": request.system_prompt})
-            
-            response = llama_model.create_chat_completion(
-                messages=messages,
-                temperature=request.temperature,
-                max_tokens=request.max_tokens,
-                stream=True,
-                stop=Config.LLAMA_CONFIG["stop"]
-            )
-            
-            for chunk in response:
-                # Comptage des tokens
-                if chunk.get("choices") and chunk["choices"][0].get("delta", {}).get("content"):
-                    tokens_generated += 1
-                
-                yield f"data: {json.dumps(chunk)}\n\n"
-            
-            yield "data: [DONE]\n\n"
-            
-            # Log de la fin de la requête
-            response_time = time.time() - start_time
-            performance_logger.log_request_end(request_id, response_time, tokens_generated)
-            
-        except Exception as e:
-            response_time = time.time() - start_time
-            performance_logger.log_error(request_id, e, "streaming")
-            logger.error(f"Erreur lors du streaming: {e}")
-            yield f"data: {json.dumps({'error': str(e)})}\n\n"
+    messages = build_messages(request.messages, request.system_prompt)
+    params = {
+        "temperature": request.temperature,
+        "max_tokens": request.max_tokens,
+        "stop": Config.LLAMA_CONFIG["stop"]
+    }
+    if request.seed is not None:
+        params["seed"] = request.seed
+    job = submit_chat(request_id, messages, request.model, params, stream=True, client=client_id(http_request),
+                      deadline=request_deadline(start_time, request.latency_budget_ms))
     
-    return StreamingResponse(
-        generate_stream(),
-        media_type="text/plain",
-        headers={"Cache-Control": "no-cache", "Connection": "keep-alive"}
-    )
+    return sse_response(job, request_id, start_time)
+
+@app.post("/v1/tokenize")
+async def tokenize(request: TokenizeRequest):
+    """Compte les tokens d'une conversation (template de chat inclus) ou d'un texte, sans générer"""
+    if not llama_model:
+        raise HTTPException(status_code=503, detail="Modèle non chargé")
+    if request.messages is None and request.text is None:
+        raise HTTPException(status_code=400, detail="messages ou text requis")
+    
+    if request.messages is not None:
+        messages = build_messages(request.messages, request.system_prompt)
+        tokens = await asyncio.to_thread(chat_template.tokenize, messages)
+    else:
+        tokens = await asyncio.to_thread(chat_template.tokenize_text, request.text)
+    
+    # Contexte d'une séquence (divisé entre les slots en batching continu)
+    n_ctx = Config.LLAMA_CONFIG["n_ctx"]
+    if Config.LLAMA_CONFIG["n_parallel"] > 1 and Config.GENERATION_CONFIG["batching"]:
+        n_ctx //= Config.LLAMA_CONFIG["n_parallel"]
+    
+    result = {
+        "count": len(tokens),
+        "n_ctx": n_ctx,
+        "available": max(0, n_ctx - len(tokens)),
+        "fits": len(tokens) + request.max_tokens <= n_ctx,
+    }
+    if request.return_tokens:
+        result["tokens"] = tokens
+    return result
+
+@app.post("/v1/sessions")
+async def create_session(request: SessionCreateRequest):
+    """Crée une session de chat conservée côté serveur"""
+    session = session_manager.create(request.system_prompt, request.model)
+    return session.to_dict()
+
+@app.get("/v1/sessions")
+async def list_sessions():
+    """Liste des sessions actives"""
+    return {"sessions": session_manager.list(), "stats": session_manager.get_stats()}
+
+@app.get("/v1/sessions/{session_id}")
+async def get_session(session_id: str):
+    """Détail d'une session (historique inclus)"""
+    try:
+        return session_manager.get(session_id).to_dict(include_messages=True)
+    except SessionNotFoundError:
+        raise HTTPException(status_code=404, detail="Session non trouvée")
+
+@app.delete("/v1/sessions/{session_id}")
+async def delete_session(session_id: str):
+    """Supprime une session et son état KV"""
+    try:
+        session_manager.delete(session_id)
+    except SessionNotFoundError:
+        raise HTTPException(status_code=404, detail="Session non trouvée")
+    return {"deleted": session_id}
+
+@app.post("/v1/sessions/{session_id}/messages")
+async def session_message(session_id: str, request: SessionMessageRequest, http_request: Request):
+    """Nouveau tour de conversation : seul le nouveau message est évalué"""
+    if not llama_model:
+        raise HTTPException(status_code=503, detail="Modèle non chargé")
+    
+    try:
+        session = session_manager.begin_turn(session_id, request.content)
+    except SessionNotFoundError:
+        raise HTTPException(status_code=404, detail="Session non trouvée")
+    except SessionBusyError:
+        raise HTTPException(status_code=409, detail="Un tour est déjà en cours pour cette session")
+    
+    request_id = str(uuid.uuid4())
+    performance_logger.log_request_start(request_id, request.content, session.model)
+    start_time = time.time()
+    
+    params = {
+        "temperature": request.temperature,
+        "max_tokens": request.max_tokens,
+        "stop": Config.LLAMA_CONFIG["stop"]
+    }
+    try:
+        job = submit_generation(request_id, list(session.messages), params, stream=request.stream, session=session,
+                                client=client_id(http_request),
+                                deadline=request_deadline(start_time, request.latency_budget_ms))
+    except HTTPException:
+        session_manager.end_turn(session, None)
+        raise
+    
+    if request.stream:
+        return sse_response(job, request_id, start_time)
+    
+    try:
+        response = await job.wait()
+    except Exception as e:
+        performance_logger.log_error(request_id, e, "session_message")
+        raise HTTPException(status_code=500, detail=str(e))
+    
+    performance_logger.log_request_end(request_id, time.time() - start_time, response["usage"]["completion_tokens"])
+    response["session_id"] = session_id
+    return response
 
 @app.websocket("/ws/chat")
 async def websocket_chat(websocket: WebSocket):
@@ -376,28 +728,44 @@ async def websocket_chat(websocket: WebSocket):
             performance_logger.log_request_start(request_id, user_message, "mistral-7b-instruct")
             
             start_time = time.time()
-            tokens_generated = 0
             
-            # Génération de la réponse
-            response = llama_model.create_chat_completion(
-                messages=messages,
-                temperature=temperature,
-                max_tokens=max_tokens,
-                stream=True,
-                stop=Config.LLAMA_CONFIG["stop"]
-            )
+            # Génération de la réponse (thread de génération)
+            params = {
+                "temperature": temperature,
+                "max_tokens": max_tokens,
+                "stop": Config.LLAMA_CONFIG["stop"]
+            }
+            if request_data.get("seed") is not None:
+                params["seed"] = request_data["seed"]
+            try:
+                job = submit_chat(request_id, messages, "mistral-7b-instruct", params, stream=True,
+                                  client=client_id(websocket),
+                                  deadline=request_deadline(start_time, request_data.get("latency_budget_ms")))
+            except HTTPException as e:
+                error = {"error": e.detail, "status": e.status_code}
+                if e.headers and "Retry-After" in e.headers:
+                    error["retry_after"] = int(e.headers["Retry-After"])
+                await websocket.send_text(json.dumps(error))
+                continue
             
-            # Envoi des chunks via WebSocket
-            for chunk in response:
-                if chunk.get("choices") and chunk["choices"][0].get("delta", {}).get("content"):
-                    tokens_generated += 1
-                await websocket.send_text(json.dumps(chunk))
+            # Envoi des chunks via WebSocket (tokens regroupés par message)
+            completed = False
+            try:
+                async for frames in TokenStream(job, "ws").batches():
+                    for frame in frames:
+                        await websocket.send_text(frame)
+                completed = True
+            finally:
+                # Connexion perdue en cours de réponse : génération interrompue au prochain token
+                if not completed:
+                    job.cancel()
             
             # Log de la fin de la requête
+            response = await job.wait()
             response_time = time.time() - start_time
-            performance_logger.log_request_end(request_id, response_time, tokens_generated)
+            performance_logger.log_request_end(request_id, response_time, response["usage"]["completion_tokens"])
             
-            await websocket.send_text(json.dumps({"done": True}))
+            await websocket.send_text(json.dumps({"done": True, "timings": response.get("timings")}))
             
     except WebSocketDisconnect:
         logger.info("WebSocket déconnecté")
@@ -432,19 +800,38 @@ async def debug_hardware():
     """Endpoint de debug pour vérifier les informations matérielles"""
     return {
         "hardware_info": get_hardware_info(),
-        "memory_usage": {
-            "ram_used_gb": round(psutil.virtual_memory().used / (1024**3), 2),
-            "ram_total_gb": round(psutil.virtual_memory().total / (1024**3), 2),
-            "ram_percent": psutil.virtual_memory().percent
-        },
+        "memory_usage": get_memory_usage(),
         "model_loaded": llama_model is not None,
-        "performance_stats": performance_logger.get_performance_stats()
+        "performance_stats": performance_logger.get_performance_stats(),
+        "generation_queue": generator.get_stats(),
+        "cpu_layout": cpu_affinity.get_stats(),
+        "tuning_profile": {
+            key: tuning_profile[key] for key in ("created", "host", "model", "settings", "kv_bytes_per_token")
+        } if tuning_profile else None
     }
 
+@app.get("/queue")
+async def get_generation_queue():
+    """État de la file d'attente de génération"""
+    return generator.get_stats()
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def prometheus_metrics():
+    """Métriques au format texte Prometheus"""
+    return PlainTextResponse(metrics.render_prometheus(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
 @app.get("/logs/performance")
-async def get_performance_logs():
-    """Récupère les logs de performance"""
-    return performance_logger.get_performance_stats()
+def get_performance_logs(hours: float = Query(24, gt=0)):
+    """Statistiques de performance des dernières heures (stockage colonnaire, sinon registre en mémoire)"""
+    # Fonction synchrone : la lecture des segments s'exécute dans le pool de threads
+    if not perf_store.enabled:
+        return performance_logger.get_performance_stats(hours)
+    stats = perf_store.analyze(hours)
+    live = performance_logger.get_performance_stats(min(hours, 24))
+    stats["errors"] = live["errors"]
+    stats["deadline_misses"] = live["deadline_misses"]
+    stats["inter_token_latency"] = live["inter_token_latency"]
+    return stats
 
 if __name__ == "__main__":
     config = Config.get_api_config()
@@ -453,6 +840,7 @@ if __name__ == "__main__":
         host=config["host"],
         port=config["port"],
         reload=config["debug"],
-        workers=config["workers"],
+        # Un seul processus uvicorn : "workers" fixe le nombre de workers d'inférence forkés
+        workers=1,
         log_level=Config.LOGGING_CONFIG["level"].lower()
     ) 
\ No newline at end of file
@@ -0,0 +1,347 @@
+#!/usr/bin/env python3
+"""
+Index incrémental des logs pour le diagnostic de performance
+
+Chaque fichier de log est suivi par son inode et la position déjà lue :
+une rotation (performance.log → performance.log.1) garde l'inode et donc la
+position, le nouveau fichier repart de zéro. Seules les lignes ajoutées
+depuis le passage précédent sont lues. Les mesures sont agrégées par heure
+(nombre, somme, min/max, buckets) dans un petit fichier JSON : n'importe
+quelle fenêtre se calcule en fusionnant les heures concernées, sans relire
+les logs.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import re
+from collections import deque
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Dict, List, Optional, Any, Iterable
+
+from config import Config
+from metrics import BucketCounts, TTFT_BUCKETS, QUEUE_WAIT_BUCKETS, THROUGHPUT_BUCKETS, TOKEN_COUNT_BUCKETS
+
+logger = logging.getLogger(__name__)
+
+_VERSION = 1
+
+# Bornes alignées sur la répartition rapide / normal / lent / très lent du diagnostic
+RESPONSE_TIME_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.0, 3.0, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0, 300.0)
+PERCENT_BUCKETS = (10, 20, 30, 40, 50, 60, 70, 80, 90, 95, 100)
+
+# Mesures agrégées par heure : nom -> (fichier, événement, champ, buckets, échelle)
+SERIES = {
+    "response_time": ("performance.log", "perf", "response_time", RESPONSE_TIME_BUCKETS, 1.0),
+    "tokens": ("performance.log", "perf", "tokens", TOKEN_COUNT_BUCKETS, 1.0),
+    "queue_wait": ("performance.log", "phases", "queue_wait_ms", QUEUE_WAIT_BUCKETS, 0.001),
+    "time_to_first_token": ("performance.log", "phases", "time_to_first_token_ms", TTFT_BUCKETS, 0.001),
+    "decode_tokens_per_second": ("performance.log", "phases", "decode_tokens_per_second", THROUGHPUT_BUCKETS, 1.0),
+    "cpu_percent": ("system.log", "system_status", "cpu_percent", PERCENT_BUCKETS, 1.0),
+    "memory_percent": ("system.log", "system_status", "memory_percent", PERCENT_BUCKETS, 1.0),
+}
+
+LOG_FILES = ("performance.log", "errors.log", "system.log")
+
+# Octets du début de fichier servant d'empreinte (inode réutilisé après suppression)
+_HEAD_BYTES = 64
+
+
+_HOUR_RE = re.compile(r"\d{4}-\d{2}-\d{2}[ T]\d{2}")
+
+
+def _hour(timestamp: str) -> Optional[str]:
+    """Clé horaire "YYYY-MM-DD HH" d'un horodatage JSON (ISO) ou texte"""
+    match = _HOUR_RE.match(timestamp)
+    return match.group(0).replace("T", " ") if match else None
+
+
+def _bucket_state(counts: BucketCounts) -> List[Any]:
+    return [counts.count, counts.sum, counts.min, counts.max, counts.buckets]
+
+
+def _bucket_from_state(bounds, state: List[Any]) -> BucketCounts:
+    counts = BucketCounts(bounds)
+    counts.count, counts.sum, counts.min, counts.max, buckets = state
+    counts.buckets = list(buckets)
+    return counts
+
+
+class HourlyRollup:
+    """Agrégats d'une heure : séries numériques et compteurs d'événements"""
+
+    __slots__ = ("series", "counters")
+
+    def __init__(self):
+        self.series: Dict[str, BucketCounts] = {}
+        self.counters: Dict[str, int] = {}
+
+    def observe(self, name: str, value: float):
+        counts = self.series.get(name)
+        if counts is None:
+            counts = self.series[name] = BucketCounts(SERIES[name][3])
+        counts.observe(value)
+
+    def count(self, name: str, amount: int = 1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def merge(self, other: "HourlyRollup"):
+        for name, counts in other.series.items():
+            mine = self.series.get(name)
+            if mine is None:
+                mine = self.series[name] = BucketCounts(SERIES[name][3])
+            mine.merge(counts)
+        for name, amount in other.counters.items():
+            self.count(name, amount)
+
+    def to_state(self) -> Dict[str, Any]:
+        return {
+            "series": {name: _bucket_state(counts) for name, counts in self.series.items()},
+            "counters": self.counters,
+        }
+
+    @classmethod
+    def from_state(cls, state: Dict[str, Any]) -> "HourlyRollup":
+        rollup = cls()
+        for name, values in state.get("series", {}).items():
+            if name in SERIES:
+                rollup.series[name] = _bucket_from_state(SERIES[name][3], values)
+        rollup.counters = dict(state.get("counters", {}))
+        return rollup
+
+
+class LogIndex:
+    """Lecture incrémentale des logs et agrégats horaires persistés"""
+
+    def __init__(self, logs_dir: str, index_path: str, retention_days: int = 90, recent_errors: int = 50):
+        self.logs_dir = Path(logs_dir)
+        self.index_path = Path(index_path)
+        self.retention_days = retention_days
+        self._cursors: Dict[str, Dict[str, Any]] = {}
+        self._hours: Dict[str, HourlyRollup] = {}
+        self._recent_errors: "deque[Dict[str, Any]]" = deque(maxlen=recent_errors)
+        self._loaded = False
+
+        # Statistiques du dernier passage
+        self.bytes_read = 0
+        self.lines_indexed = 0
+
+    # -- Persistance ---------------------------------------------------------
+
+    def load(self):
+        """Charge l'index (vide s'il est absent, illisible ou d'une autre version)"""
+        self._loaded = True
+        try:
+            state = json.loads(self.index_path.read_text())
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.warning(f"Index des logs illisible, reconstruction: {e}")
+            return
+        if state.get("version") != _VERSION:
+            return
+        self._cursors = state.get("cursors", {})
+        self._hours = {hour: HourlyRollup.from_state(s) for hour, s in state.get("hours", {}).items()}
+        self._recent_errors.extend(state.get("recent_errors", []))
+
+    def save(self):
+        """Écrit l'index de façon atomique"""
+        state = {
+            "version": _VERSION,
+            "cursors": self._cursors,
+            "hours": {hour: rollup.to_state() for hour, rollup in sorted(self._hours.items())},
+            "recent_errors": list(self._recent_errors),
+        }
+        self.index_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.index_path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(state, separators=(",", ":")))
+        os.replace(tmp_path, self.index_path)
+
+    def reset(self):
+        """Oublie positions et agrégats (réindexation complète au prochain passage)"""
+        self._cursors.clear()
+        self._hours.clear()
+        self._recent_errors.clear()
+        self._loaded = True
+
+    # -- Indexation ----------------------------------------------------------
+
+    def log_files(self, name: str) -> List[Path]:
+        """Fichier de log et ses rotations (name.N), du plus ancien au plus récent"""
+        rotated = [p for p in self.logs_dir.glob(f"{name}.*") if p.suffix[1:].isdigit()]
+        files = sorted(rotated, key=lambda p: int(p.suffix[1:]), reverse=True)
+        current = self.logs_dir / name
+        if current.exists():
+            files.append(current)
+        return files
+
+    def update(self) -> Dict[str, int]:
+        """Indexe les lignes ajoutées depuis le passage précédent et sauvegarde l'index"""
+        if not self._loaded:
+            self.load()
+        self.bytes_read = 0
+        self.lines_indexed = 0
+
+        seen = set()
+        for name in LOG_FILES:
+            for path in self.log_files(name):
+                try:
+                    key = self._index_file(name, path)
+                except OSError as e:
+                    logger.warning(f"Lecture impossible de {path}: {e}")
+                    continue
+                seen.add(key)
+
+        # Fichiers supprimés par la rotation : leurs positions ne servent plus
+        for key in [k for k in self._cursors if k not in seen]:
+            del self._cursors[key]
+        self._prune()
+        self.save()
+        return {"bytes_read": self.bytes_read, "lines_indexed": self.lines_indexed}
+
+    def _index_file(self, name: str, path: Path) -> str:
+        with open(path, "rb") as f:
+            stat = os.fstat(f.fileno())
+            key = f"{stat.st_dev}:{stat.st_ino}"
+            cursor = self._cursors.get(key)
+            offset = cursor["offset"] if cursor else 0
+            # Inode réutilisé ou fichier tronqué : relecture depuis le début
+            if cursor and (cursor["log"] != name or stat.st_size < offset or cursor["head"] != self._head(f, offset)):
+                offset = 0
+            if stat.st_size > offset:
+                f.seek(offset)
+                data = f.read(stat.st_size - offset)
+                # Seulement les lignes complètes : la dernière peut être en cours d'écriture
+                end = data.rfind(b"\n") + 1
+                if end:
+                    self._index_lines(name, data[:end].decode("utf-8", errors="replace").splitlines())
+                    offset += end
+                    self.bytes_read += end
+            self._cursors[key] = {"log": name, "offset": offset, "head": self._head(f, offset)}
+        return key
+
+    @staticmethod
+    def _head(f, offset: int) -> str:
+        """Empreinte du début déjà lu du fichier (inchangé tant que le fichier ne fait que grandir)"""
+        f.seek(0)
+        return hashlib.blake2b(f.read(min(_HEAD_BYTES, offset)), digest_size=8).hexdigest()
+
+    def _rollup(self, hour: str) -> HourlyRollup:
+        rollup = self._hours.get(hour)
+        if rollup is None:
+            rollup = self._hours[hour] = HourlyRollup()
+        return rollup
+
+    def _index_lines(self, name: str, lines: Iterable[str]):
+        for line in lines:
+            if line.startswith("{"):
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+            else:
+                entry = self._parse_text_line(name, line)
+                if entry is None:
+                    continue
+            hour = _hour(str(entry.get("ts", "")))
+            if hour is None:
+                continue
+            self.lines_indexed += 1
+            self._index_entry(name, hour, entry)
+
+    def _index_entry(self, name: str, hour: str, entry: Dict[str, Any]):
+        rollup = self._rollup(hour)
+        event = entry.get("event")
+        for series, (log, series_event, field, _, scale) in SERIES.items():
+            if log == name and series_event == event and entry.get(field) is not None:
+                rollup.observe(series, float(entry[field]) * scale)
+
+        if name == "performance.log" and event == "perf":
+            rollup.count("requests")
+        elif name == "system.log" and event == "system_status":
+            if entry.get("memory_percent", 0) > 90:
+                rollup.count("high_memory")
+            if entry.get("cpu_percent", 0) > 95:
+                rollup.count("high_cpu")
+        elif name == "errors.log" and entry.get("level") in ("ERROR", "CRITICAL"):
+            rollup.count("errors")
+            rollup.count(f"errors:{entry.get('context') or entry.get('logger') or 'unknown'}")
+            self._recent_errors.append({
+                "ts": entry["ts"],
+                "context": entry.get("context"),
+                "error_type": entry.get("error_type"),
+                "msg": entry.get("msg", "")[:500],
+            })
+
+    @staticmethod
+    def _parse_text_line(name: str, line: str) -> Optional[Dict[str, Any]]:
+        """Ancien format texte ("horodatage - logger - niveau - message")"""
+        timestamp = line.split(" - ")[0]
+        if name == "performance.log" and "PERF" in line and "ResponseTime:" in line and "Tokens:" in line:
+            try:
+                parts = line.split("ResponseTime:")[1].split(" - Tokens:")
+                return {"ts": timestamp, "event": "perf",
+                        "response_time": float(parts[0].rstrip("s")), "tokens": int(parts[1])}
+            except (IndexError, ValueError):
+                return None
+        if name == "errors.log" and " - ERROR - " in line:
+            return {"ts": timestamp, "level": "ERROR", "msg": line.strip()}
+        return None
+
+    def _prune(self):
+        cutoff = (datetime.now() - timedelta(days=self.retention_days)).strftime("%Y-%m-%d %H")
+        for hour in [h for h in self._hours if h < cutoff]:
+            del self._hours[hour]
+
+    # -- Requêtes ------------------------------------------------------------
+
+    def window(self, hours: Optional[float] = None) -> Dict[str, Any]:
+        """Agrégats fusionnés des dernières heures (tout l'index si hours est None)"""
+        if not self._loaded:
+            self.load()
+        selected = sorted(self._hours)
+        if hours is not None:
+            since = (datetime.now() - timedelta(hours=hours)).strftime("%Y-%m-%d %H")
+            selected = [h for h in selected if h >= since]
+
+        total = HourlyRollup()
+        for hour in selected:
+            total.merge(self._hours[hour])
+        return {
+            "hours": selected,
+            "series": total.series,
+            "counters": total.counters,
+            "requests_per_hour": {h: self._hours[h].counters.get("requests", 0) for h in selected
+                                  if self._hours[h].counters.get("requests")},
+        }
+
+    def recent_errors(self) -> List[Dict[str, Any]]:
+        return list(self._recent_errors)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """État de l'index"""
+        return {
+            "index_path": str(self.index_path),
+            "tracked_files": len(self._cursors),
+            "hours": len(self._hours),
+            "first_hour": min(self._hours) if self._hours else None,
+            "last_hour": max(self._hours) if self._hours else None,
+            "last_bytes_read": self.bytes_read,
+            "last_lines_indexed": self.lines_indexed,
+        }
+
+
+def bucket_share(counts: BucketCounts, upper: float) -> int:
+    """Observations des buckets dont la borne haute est ≤ upper"""
+    return sum(n for bound, n in zip(counts.bounds, counts.buckets) if bound <= upper)
+
+
+# Instance globale
+log_index = LogIndex(
+    logs_dir=Config.LOG_INDEX_CONFIG["logs_dir"],
+    index_path=Config.LOG_INDEX_CONFIG["path"],
+    retention_days=Config.LOG_INDEX_CONFIG["retention_days"],
+    recent_errors=Config.LOG_INDEX_CONFIG["recent_errors"],
+)
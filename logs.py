@@ -1,16 +1,213 @@
 #!/usr/bin/env python3
 """
 Système de logs avancé pour l'API Llama.cpp
+
+Les loggers ne font que déposer l'enregistrement dans une file bornée ; un
+thread de fond l'écrit en JSON lines (api.log, performance.log, errors.log,
+system.log) avec rotation par taille selon LOGGING_CONFIG. Les logs INFO
+émis à chaque requête sont échantillonnés ; les lignes PERF ne le sont pas.
 """
 
+import atexit
+import copy
+import itertools
+import json
 import logging
+import logging.handlers
+import queue
 import time
-import psutil
 import os
 from datetime import datetime
 from typing import Dict, Any, Optional
 from pathlib import Path
 
+from config import Config
+from system_sampler import system_sampler
+from perf_store import perf_store
+
+from metrics import (
+    metrics, LATENCY_BUCKETS, TTFT_BUCKETS, QUEUE_WAIT_BUCKETS, THROUGHPUT_BUCKETS, TOKEN_COUNT_BUCKETS,
+    INTER_TOKEN_BUCKETS
+)
+
+DEADLINE_STAGES = ("rejected", "expired_in_queue", "truncated")
+
+
+def _extra(event: str, sampled: bool = False, **fields) -> Dict[str, Any]:
+    """Champs structurés d'un enregistrement (sampled : log INFO soumis à l'échantillonnage)"""
+    return {"event": event, "sampled": sampled, "fields": fields}
+
+
+def _round_summary(summary: Dict[str, Any], digits: int = 3) -> Dict[str, Any]:
+    return {key: round(value, digits) if isinstance(value, float) else value for key, value in summary.items()}
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """Un objet JSON par ligne : horodatage, niveau, logger, message et champs structurés"""
+    
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "pid": record.process,
+            "msg": record.getMessage(),
+        }
+        event = getattr(record, "event", None)
+        if event:
+            entry["event"] = event
+        fields = getattr(record, "fields", None)
+        if fields:
+            entry.update(fields)
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class _SamplingFilter(logging.Filter):
+    """Ne garde qu'une fraction des logs INFO marqués "sampled" (volume par requête)"""
+    
+    def __init__(self, rate: float):
+        super().__init__()
+        self.every = max(1, round(1 / rate)) if rate > 0 else 0
+        self._seen = itertools.count()
+    
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > logging.INFO or not getattr(record, "sampled", False):
+            return True
+        return self.every > 0 and next(self._seen) % self.every == 0
+
+
+class _NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """Met l'enregistrement en file sans jamais attendre ; compte les pertes si la file est pleine"""
+    
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+    
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Seuls le message et la trace sont figés ici : le formatage a lieu dans le thread d'écriture
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            if record.exc_info[0] is not None:
+                record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+    
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class _NameFilter(logging.Filter):
+    """Aiguillage par logger : les loggers dédiés ont leur fichier, le reste va dans api.log"""
+    
+    def __init__(self, names, include: bool):
+        super().__init__()
+        self.names = frozenset(names)
+        self.include = include
+    
+    def filter(self, record: logging.LogRecord) -> bool:
+        return (record.name in self.names) == self.include
+
+
+class LogPipeline:
+    """Écriture des logs dans un thread de fond, fichiers JSON lines avec rotation par taille"""
+    
+    DEDICATED = ("performance", "errors", "system")
+    
+    def __init__(self, log_dir: str, main_file: str, level: str, console_format: str, max_bytes: int,
+                 backup_count: int, queue_size: int, sample_rate: float, json_lines: bool = True):
+        self.log_dir = Path(log_dir)
+        self.main_file = Path(main_file)
+        self.level = getattr(logging, level)
+        self.console_format = console_format
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.json_lines = json_lines
+        self.queue: queue.Queue = queue.Queue(queue_size)
+        self.handler = _NonBlockingQueueHandler(self.queue)
+        self.handler.addFilter(_SamplingFilter(sample_rate))
+        self.listener: Optional[logging.handlers.QueueListener] = None
+    
+    def start(self):
+        """Branche le logger racine sur la file et démarre le thread d'écriture"""
+        if self.listener is not None:
+            return
+        self.log_dir.mkdir(exist_ok=True)
+        self.main_file.parent.mkdir(parents=True, exist_ok=True)
+        root = logging.getLogger()
+        root.setLevel(self.level)
+        root.addHandler(self.handler)
+        self._start_listener(rotate=True)
+        # Worker forké : son propre thread d'écriture, la rotation reste au processus principal
+        os.register_at_fork(after_in_child=self._restart_in_child)
+        atexit.register(self.stop)
+    
+    def dedicated_logger(self, name: str, level: int) -> logging.Logger:
+        """Logger écrivant dans son propre fichier (logs/<name>.log), sans passer par api.log"""
+        logger = logging.getLogger(name)
+        logger.setLevel(level)
+        logger.propagate = False
+        if self.handler not in logger.handlers:
+            logger.addHandler(self.handler)
+        return logger
+    
+    def _file_handler(self, path: Path, rotate: bool) -> logging.Handler:
+        if rotate:
+            handler = logging.handlers.RotatingFileHandler(
+                path, maxBytes=self.max_bytes, backupCount=self.backup_count, encoding="utf-8"
+            )
+        else:
+            # Suit le renommage fait par la rotation du processus principal
+            handler = logging.handlers.WatchedFileHandler(path, encoding="utf-8")
+        handler.setFormatter(JsonLinesFormatter() if self.json_lines else logging.Formatter(self.console_format))
+        return handler
+    
+    def _start_listener(self, rotate: bool):
+        # Les erreurs vont aussi dans api.log et sur la console
+        main = self._file_handler(self.main_file, rotate)
+        main.addFilter(_NameFilter(("performance", "system"), include=False))
+        console = logging.StreamHandler()
+        console.setFormatter(logging.Formatter(self.console_format))
+        console.addFilter(_NameFilter(("performance", "system"), include=False))
+        handlers = [main, console]
+        for name in self.DEDICATED:
+            handler = self._file_handler(self.log_dir / f"{name}.log", rotate)
+            handler.addFilter(_NameFilter((name,), include=True))
+            handlers.append(handler)
+        self.listener = logging.handlers.QueueListener(self.queue, *handlers, respect_handler_level=True)
+        self.listener.start()
+    
+    def _restart_in_child(self):
+        if self.listener is None:
+            return
+        # Le thread d'écriture du parent n'existe pas dans l'enfant : file et thread neufs
+        self.queue = queue.Queue(self.queue.maxsize)
+        self.handler.queue = self.queue
+        self._start_listener(rotate=False)
+    
+    def stop(self):
+        """Vide la file et arrête le thread d'écriture"""
+        if self.listener is not None:
+            self.listener.stop()
+            for handler in self.listener.handlers:
+                handler.close()
+            self.listener = None
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """État de la file de logs"""
+        return {
+            "queued": self.queue.qsize(),
+            "queue_size": self.queue.maxsize,
+            "dropped": self.handler.dropped,
+        }
+
+
 class PerformanceLogger:
     """Logger spécialisé pour les performances"""
     
@@ -18,172 +215,212 @@ class PerformanceLogger:
         self.log_dir = Path(log_dir)
         self.log_dir.mkdir(exist_ok=True)
         
+        # Métriques en mémoire (statistiques JSON et /metrics sans relire les fichiers)
+        self.requests_started = metrics.counter("llama_requests_started_total", "Requêtes reçues")
+        self.request_duration = metrics.histogram(
+            "llama_request_duration_seconds", "Durée totale des requêtes", LATENCY_BUCKETS
+        )
+        self.completion_tokens = metrics.histogram(
+            "llama_completion_tokens", "Tokens générés par requête", TOKEN_COUNT_BUCKETS
+        )
+        self.queue_wait = metrics.histogram(
+            "llama_queue_wait_seconds", "Attente dans la file de génération", QUEUE_WAIT_BUCKETS
+        )
+        self.time_to_first_token = metrics.histogram(
+            "llama_time_to_first_token_seconds", "Délai entre la soumission et le premier token", TTFT_BUCKETS
+        )
+        self.prompt_throughput = metrics.histogram(
+            "llama_prompt_tokens_per_second", "Débit d'évaluation du prompt", THROUGHPUT_BUCKETS
+        )
+        self.decode_throughput = metrics.histogram(
+            "llama_decode_tokens_per_second", "Débit de génération", THROUGHPUT_BUCKETS
+        )
+        self.inter_token_latency = metrics.histogram(
+            "llama_inter_token_latency_seconds", "Écart entre deux tokens générés", INTER_TOKEN_BUCKETS
+        )
+        self.prompt_tokens = metrics.histogram(
+            "llama_prompt_tokens", "Tokens de prompt par requête", TOKEN_COUNT_BUCKETS
+        )
+        self.prompt_tokens_cached = metrics.counter(
+            "llama_prompt_tokens_cached_total", "Tokens de prompt repris du cache KV"
+        )
+        self.errors = metrics.counter("llama_errors_total", "Erreurs par contexte", ("context",))
+        self.deadline_misses = metrics.counter("llama_deadline_misses_total", "Échéances manquées", ("stage",))
+        self.model_load_time = metrics.gauge("llama_model_load_seconds", "Durée du dernier chargement du modèle")
+        
         # Configuration des logs
         self.setup_loggers()
         
     def setup_loggers(self):
-        """Configure les différents loggers"""
+        """Configure les différents loggers (un seul pipeline asynchrone pour tous les fichiers)"""
+        log_pipeline.start()
         
-        # Logger principal
+        # Logger principal (api.log via le logger racine)
         self.main_logger = logging.getLogger('llama_api')
         self.main_logger.setLevel(logging.INFO)
         
-        # Handler pour fichier principal
-        main_handler = logging.FileHandler(self.log_dir / 'api.log')
-        main_handler.setLevel(logging.INFO)
-        main_formatter = logging.Formatter(
-            '%(asctime)s - %(levelname)s - %(message)s'
-        )
-        main_handler.setFormatter(main_formatter)
-        self.main_logger.addHandler(main_handler)
-        
-        # Logger de performance
-        self.perf_logger = logging.getLogger('performance')
-        self.perf_logger.setLevel(logging.INFO)
-        
-        # Handler pour performances
-        perf_handler = logging.FileHandler(self.log_dir / 'performance.log')
-        perf_handler.setLevel(logging.INFO)
-        perf_formatter = logging.Formatter(
-            '%(asctime)s - %(message)s'
-        )
-        perf_handler.setFormatter(perf_formatter)
-        self.perf_logger.addHandler(perf_handler)
-        
-        # Logger d'erreurs
-        self.error_logger = logging.getLogger('errors')
-        self.error_logger.setLevel(logging.ERROR)
-        
-        # Handler pour erreurs
-        error_handler = logging.FileHandler(self.log_dir / 'errors.log')
-        error_handler.setLevel(logging.ERROR)
-        error_formatter = logging.Formatter(
-            '%(asctime)s - %(levelname)s - %(message)s\n%(exc_info)s\n'
-        )
-        error_handler.setFormatter(error_formatter)
-        self.error_logger.addHandler(error_handler)
-        
-        # Logger système
-        self.system_logger = logging.getLogger('system')
-        self.system_logger.setLevel(logging.INFO)
-        
-        # Handler pour système
-        system_handler = logging.FileHandler(self.log_dir / 'system.log')
-        system_handler.setLevel(logging.INFO)
-        system_formatter = logging.Formatter(
-            '%(asctime)s - %(message)s'
-        )
-        system_handler.setFormatter(system_formatter)
-        self.system_logger.addHandler(system_handler)
+        # Loggers dédiés : un fichier chacun, hors api.log
+        self.perf_logger = log_pipeline.dedicated_logger('performance', logging.INFO)
+        self.error_logger = log_pipeline.dedicated_logger('errors', logging.ERROR)
+        self.system_logger = log_pipeline.dedicated_logger('system', logging.INFO)
     
     def log_request_start(self, request_id: str, user_message: str, model: str):
         """Log le début d'une requête"""
-        self.main_logger.info(f"🚀 REQUEST_START [{request_id}] - Modèle: {model}")
-        self.main_logger.info(f"📝 Message utilisateur: {user_message[:100]}...")
+        self.requests_started.inc()
+        self.main_logger.info(
+            f"🚀 REQUEST_START [{request_id}] - Modèle: {model}",
+            extra=_extra("request_start", sampled=True, request_id=request_id, model=model,
+                         message_preview=user_message[:100]),
+        )
         
         # Log système avant génération
         self.log_system_status(request_id, "before_generation")
     
     def log_request_end(self, request_id: str, response_time: float, tokens_generated: int):
         """Log la fin d'une requête"""
-        self.main_logger.info(f"✅ REQUEST_END [{request_id}] - Temps: {response_time:.2f}s - Tokens: {tokens_generated}")
+        self.request_duration.observe(response_time)
+        self.completion_tokens.observe(tokens_generated)
+        self.main_logger.info(
+            f"✅ REQUEST_END [{request_id}] - Temps: {response_time:.2f}s - Tokens: {tokens_generated}",
+            extra=_extra("request_end", sampled=True, request_id=request_id),
+        )
         
-        # Log performance
-        self.perf_logger.info(f"PERF [{request_id}] - ResponseTime:{response_time:.3f}s - Tokens:{tokens_generated}")
+        # Log performance (jamais échantillonné : base des analyses hors ligne)
+        self.perf_logger.info(
+            f"PERF [{request_id}] - ResponseTime:{response_time:.3f}s - Tokens:{tokens_generated}",
+            extra=_extra("perf", request_id=request_id, response_time=round(response_time, 3),
+                         tokens=tokens_generated),
+        )
         
         # Log système après génération
         self.log_system_status(request_id, "after_generation")
     
     def log_system_status(self, request_id: str, stage: str):
-        """Log l'état du système"""
+        """Log l'état du système (dernier relevé de l'échantillonneur, sans appel bloquant)"""
         try:
-            cpu_percent = psutil.cpu_percent(interval=0.1)
-            memory = psutil.virtual_memory()
-            disk = psutil.disk_usage('/')
-            
+            snapshot = system_sampler.latest()
             status = {
                 "request_id": request_id,
                 "stage": stage,
-                "timestamp": datetime.now().isoformat(),
-                "cpu_percent": cpu_percent,
-                "memory_percent": memory.percent,
-                "memory_used_gb": round(memory.used / (1024**3), 2),
-                "memory_total_gb": round(memory.total / (1024**3), 2),
-                "disk_percent": disk.percent,
-                "disk_free_gb": round(disk.free / (1024**3), 2)
+                "sampled_at": datetime.fromtimestamp(snapshot["timestamp"]).isoformat(),
+                "cpu_percent": snapshot["cpu_percent"],
+                "memory_percent": snapshot["memory_percent"],
+                "memory_used_gb": snapshot["memory_used_gb"],
+                "memory_total_gb": snapshot["memory_total_gb"],
+                "process_rss_gb": snapshot["process_rss_gb"],
+                "disk_percent": snapshot["disk_percent"],
+                "disk_free_gb": snapshot["disk_free_gb"],
+                "load_1m": snapshot["load_1m"],
             }
             
-            self.system_logger.info(f"SYSTEM_STATUS - {status}")
+            # Non échantillonnée : compteurs high_cpu / high_memory de l'index des logs
+            self.system_logger.info(f"SYSTEM_STATUS - {stage}", extra=_extra("system_status", **status))
             
         except Exception as e:
             self.error_logger.error(f"Erreur lors du log système: {e}")
     
+    def log_generation(self, job):
+        """Enregistre les phases d'un job terminé : attente, prefill, premier token, décodage"""
+        perf_store.append_job(job)
+        if job.started_at is None:
+            return
+        self.queue_wait.observe(job.started_at - job.submitted_at)
+        self.prompt_tokens.observe(job.prompt_token_count)
+        self.prompt_tokens_cached.inc(job.prompt_tokens_cached)
+        
+        timings = job.timings()
+        if job.first_token_at is not None:
+            self.time_to_first_token.observe(job.first_token_at - job.submitted_at)
+            if timings["prompt_tokens_per_second"]:
+                self.prompt_throughput.observe(timings["prompt_tokens_per_second"])
+            if timings["decode_tokens_per_second"]:
+                self.decode_throughput.observe(timings["decode_tokens_per_second"])
+            self.inter_token_latency.merge(job.inter_token)
+        
+        self.perf_logger.info(
+            f"PHASES [{job.request_id}] - QueueWait:{timings['queue_wait_ms']:.1f}ms"
+            f" - PromptTokens:{job.prompt_token_count} - PromptCached:{job.prompt_tokens_cached}"
+            f" - PromptEval:{timings.get('prompt_tokens_per_second') or 0:.1f}tok/s"
+            f" - TTFT:{timings.get('time_to_first_token_ms', 0):.1f}ms"
+            f" - Decode:{timings.get('decode_tokens_per_second') or 0:.1f}tok/s"
+            f" - CompletionTokens:{job.completion_tokens}",
+            # Non échantillonnée : l'index des logs (log_index.py) en tire ses séries attente / TTFT / décodage
+            extra=_extra("phases", request_id=job.request_id, finish_reason=job.finish_reason, **timings),
+        )
+    
     def log_error(self, request_id: str, error: Exception, context: str = ""):
         """Log une erreur"""
+        self.errors.labels(context or "unknown").inc()
         self.error_logger.error(
             f"❌ ERROR [{request_id}] - {context} - {str(error)}",
-            exc_info=True
+            exc_info=True,
+            extra=_extra("error", request_id=request_id, context=context, error_type=type(error).__name__),
+        )
+    
+    def log_deadline_miss(self, request_id: str, stage: str):
+        """Log une échéance manquée (rejected, expired_in_queue, truncated)"""
+        self.deadline_misses.labels(stage).inc()
+        self.perf_logger.info(
+            f"DEADLINE_MISS [{request_id}] - Stage:{stage}",
+            extra=_extra("deadline_miss", request_id=request_id, stage=stage),
         )
     
     def log_model_load(self, model_path: str, load_time: float):
         """Log le chargement du modèle"""
+        self.model_load_time.set(load_time)
         self.main_logger.info(f"📦 MODEL_LOAD - {model_path} - Temps: {load_time:.2f}s")
-        self.perf_logger.info(f"MODEL_LOAD - LoadTime:{load_time:.3f}s - Path:{model_path}")
+        self.perf_logger.info(
+            f"MODEL_LOAD - LoadTime:{load_time:.3f}s - Path:{model_path}",
+            extra=_extra("model_load", load_time=round(load_time, 3), model_path=model_path),
+        )
     
     def log_configuration(self, config: Dict[str, Any]):
         """Log la configuration utilisée"""
-        self.main_logger.info(f"⚙️ CONFIG - {config}")
+        self.main_logger.info("⚙️ CONFIG", extra=_extra("configuration", config=config))
     
     def get_performance_stats(self, hours: int = 24) -> Dict[str, Any]:
-        """Récupère les statistiques de performance"""
-        try:
-            perf_file = self.log_dir / 'performance.log'
-            if not perf_file.exists():
-                return {"error": "Fichier de performance non trouvé"}
-            
-            stats = {
-                "total_requests": 0,
-                "avg_response_time": 0,
-                "total_tokens": 0,
-                "requests_per_hour": 0
-            }
-            
-            response_times = []
-            tokens_list = []
-            
-            with open(perf_file, 'r') as f:
-                for line in f:
-                    if 'PERF' in line:
-                        stats["total_requests"] += 1
-                        
-                        # Extraction des données
-                        if 'ResponseTime:' in line and 'Tokens:' in line:
-                            try:
-                                parts = line.split('ResponseTime:')[1].split(' - Tokens:')
-                                response_time = float(parts[0])
-                                tokens = int(parts[1])
-                                
-                                response_times.append(response_time)
-                                tokens_list.append(tokens)
-                                stats["total_tokens"] += tokens
-                            except:
-                                continue
-            
-            if response_times:
-                stats["avg_response_time"] = sum(response_times) / len(response_times)
-                stats["min_response_time"] = min(response_times)
-                stats["max_response_time"] = max(response_times)
-            
-            if tokens_list:
-                stats["avg_tokens_per_request"] = sum(tokens_list) / len(tokens_list)
-            
-            # Calcul des requêtes par heure
-            stats["requests_per_hour"] = stats["total_requests"] / hours
-            
-            return stats
-            
-        except Exception as e:
-            return {"error": f"Erreur lors du calcul des stats: {e}"}
+        """Statistiques de performance des dernières heures (registre en mémoire, depuis le démarrage)"""
+        duration = self.request_duration.window(hours)
+        tokens = self.completion_tokens.window(hours)
+        
+        stats = {
+            "window_hours": hours,
+            "total_requests": duration["count"],
+            "avg_response_time": duration.get("avg", 0),
+            "total_tokens": int(tokens["sum"]),
+            "requests_per_hour": duration["count"] / hours,
+        }
+        if duration["count"]:
+            stats["min_response_time"] = duration["min"]
+            stats["max_response_time"] = duration["max"]
+            stats["p50_response_time"] = round(duration["p50"], 3)
+            stats["p95_response_time"] = round(duration["p95"], 3)
+            stats["p99_response_time"] = round(duration["p99"], 3)
+            stats["avg_tokens_per_request"] = tokens["sum"] / tokens["count"]
+        
+        stats["queue_wait"] = _round_summary(self.queue_wait.window(hours))
+        stats["time_to_first_token"] = _round_summary(self.time_to_first_token.window(hours))
+        stats["prompt_tokens_per_second"] = _round_summary(self.prompt_throughput.window(hours), 1)
+        stats["decode_tokens_per_second"] = _round_summary(self.decode_throughput.window(hours), 1)
+        stats["inter_token_latency"] = _round_summary(self.inter_token_latency.window(hours), 4)
+        stats["prompt_tokens"] = _round_summary(self.prompt_tokens.window(hours), 1)
+        stats["errors"] = int(self.errors.total())
+        
+        misses = {stage: int(self.deadline_misses.labels(stage).value) for stage in DEADLINE_STAGES}
+        stats["deadline_misses"] = dict(misses, total=sum(misses.values()))
+        
+        return stats
 
-# Instance globale
+# Instances globales
+log_pipeline = LogPipeline(
+    log_dir="logs",
+    main_file=Config.LOGGING_CONFIG["file"],
+    level=Config.LOGGING_CONFIG["level"],
+    console_format=Config.LOGGING_CONFIG["format"],
+    max_bytes=Config.LOGGING_CONFIG["max_size"],
+    backup_count=Config.LOGGING_CONFIG["backup_count"],
+    queue_size=Config.LOGGING_CONFIG["queue_size"],
+    sample_rate=Config.LOGGING_CONFIG["sample_rate"],
+    json_lines=Config.LOGGING_CONFIG["json_lines"],
+)
 performance_logger = PerformanceLogger() 
\ No newline at end of file
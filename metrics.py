@@ -0,0 +1,358 @@
+#!/usr/bin/env python3
+"""
+Registre de métriques en mémoire pour l'API Llama.cpp
+
+Compteurs, jauges et histogrammes à buckets fixes, mis à jour en O(1) sous
+un verrou par métrique. Chaque histogramme garde en plus une fenêtre
+glissante de tranches d'une minute (24h par défaut) : les statistiques
+JSON sur les N dernières heures se calculent sans relire les logs, et
+/metrics expose le tout au format texte Prometheus.
+"""
+
+import bisect
+import math
+import threading
+import time
+from typing import Dict, List, Optional, Any, Callable, Sequence, Tuple
+
+# Buckets usuels
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0, 300.0)
+TTFT_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0)
+QUEUE_WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+THROUGHPUT_BUCKETS = (1, 2, 5, 10, 20, 30, 50, 75, 100, 200, 500, 1000, 2000, 5000)
+TOKEN_COUNT_BUCKETS = (1, 16, 64, 128, 256, 512, 1024, 2048, 4096, 8192)
+INTER_TOKEN_BUCKETS = (0.005, 0.01, 0.02, 0.03, 0.05, 0.075, 0.1, 0.15, 0.25, 0.5, 1.0)
+
+_SLOT_SECONDS = 60
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(labelnames: Sequence[str], labelvalues: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, labelvalues)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _quantile(bounds: Sequence[float], buckets: List[int], count: int, q: float, low: float, high: float) -> float:
+    """Quantile estimé par interpolation linéaire dans le bucket (borné par les extrêmes observés)"""
+    rank = q * count
+    cumulative = 0
+    for i, n in enumerate(buckets):
+        if n and cumulative + n >= rank:
+            lower = max(bounds[i - 1] if i else 0.0, low)
+            upper = min(bounds[i], high)
+            return lower + (upper - lower) * (rank - cumulative) / n
+        cumulative += n
+    return high
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    """Métrique nommée, éventuellement déclinée par étiquettes"""
+
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], "_Metric"] = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *labelvalues) -> "_Metric":
+        """Déclinaison de la métrique pour des valeurs d'étiquettes"""
+        key = tuple(str(v) for v in labelvalues)
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.get(key)
+                if child is None:
+                    child = self._children[key] = self._new_child()
+        return child
+
+    def _new_child(self) -> "_Metric":
+        raise NotImplementedError
+
+    def _series(self) -> List[Tuple[Tuple[str, ...], "_Metric"]]:
+        if self.labelnames:
+            return sorted(self._children.items())
+        return [((), self)]
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for labelvalues, metric in self._series():
+            lines.extend(metric._samples(self.name, self.labelnames, labelvalues))
+        return lines
+
+    def _samples(self, name: str, labelnames, labelvalues) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    """Compteur monotone"""
+
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self.value = 0.0
+
+    def _new_child(self) -> "Counter":
+        return Counter(self.name, self.documentation)
+
+    def inc(self, amount: float = 1.0):
+        with self._lock:
+            self.value += amount
+
+    def total(self) -> float:
+        """Somme sur toutes les déclinaisons"""
+        if self.labelnames:
+            return sum(child.value for child in self._children.values())
+        return self.value
+
+    def _samples(self, name: str, labelnames, labelvalues) -> List[str]:
+        return [f"{name}{_format_labels(labelnames, labelvalues)} {_format_value(self.value)}"]
+
+
+class Gauge(_Metric):
+    """Valeur instantanée, fixée ou lue à la collecte"""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 function: Optional[Callable[[], float]] = None):
+        super().__init__(name, documentation, labelnames)
+        self.value = 0.0
+        self.function = function
+
+    def _new_child(self) -> "Gauge":
+        return Gauge(self.name, self.documentation)
+
+    def set(self, value: float):
+        self.value = value
+
+    def inc(self, amount: float = 1.0):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount: float = 1.0):
+        self.inc(-amount)
+
+    def get(self) -> float:
+        if self.function is not None:
+            try:
+                return float(self.function())
+            except Exception:
+                return math.nan
+        return self.value
+
+    def _samples(self, name: str, labelnames, labelvalues) -> List[str]:
+        return [f"{name}{_format_labels(labelnames, labelvalues)} {_format_value(self.get())}"]
+
+
+class BucketCounts:
+    """Observations regroupées localement (une requête), fusionnées ensuite dans un Histogram"""
+
+    __slots__ = ("bounds", "buckets", "count", "sum", "min", "max")
+
+    def __init__(self, buckets: Sequence[float]):
+        self.bounds = tuple(sorted(buckets)) + (math.inf,)
+        self.buckets = [0] * len(self.bounds)
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def observe(self, value: float):
+        self.buckets[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def merge(self, other: "BucketCounts"):
+        """Ajoute les observations d'un autre regroupement (mêmes buckets)"""
+        for i, n in enumerate(other.buckets):
+            self.buckets[i] += n
+        self.count += other.count
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def summary(self, scale: float = 1.0, digits: int = 2) -> Dict[str, Any]:
+        """Moyenne, extrêmes et quantiles (valeurs multipliées par scale)"""
+        if not self.count:
+            return {"count": 0}
+        return {
+            "count": self.count,
+            "avg": round(self.sum / self.count * scale, digits),
+            "min": round(self.min * scale, digits),
+            "max": round(self.max * scale, digits),
+            "p50": round(_quantile(self.bounds, self.buckets, self.count, 0.50, self.min, self.max) * scale, digits),
+            "p95": round(_quantile(self.bounds, self.buckets, self.count, 0.95, self.min, self.max) * scale, digits),
+        }
+
+
+class _Slot:
+    """Tranche d'une minute de la fenêtre glissante d'un histogramme"""
+
+    __slots__ = ("minute", "count", "sum", "min", "max", "buckets")
+
+    def __init__(self, minute: int, n_buckets: int):
+        self.minute = minute
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+        self.buckets = [0] * n_buckets
+
+
+class Histogram(_Metric):
+    """Histogramme à buckets fixes avec fenêtre glissante par minute"""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, buckets: Sequence[float] = LATENCY_BUCKETS,
+                 labelnames: Sequence[str] = (), window_hours: int = 24):
+        super().__init__(name, documentation, labelnames)
+        self.bounds = tuple(sorted(buckets)) + (math.inf,)
+        self.window_hours = window_hours
+        self.counts = [0] * len(self.bounds)
+        self.sum = 0.0
+        self.count = 0
+        self._slots: List[Optional[_Slot]] = [None] * (window_hours * 3600 // _SLOT_SECONDS)
+
+    def _new_child(self) -> "Histogram":
+        return Histogram(self.name, self.documentation, self.bounds[:-1], window_hours=self.window_hours)
+
+    def observe(self, value: float, now: Optional[float] = None):
+        index = bisect.bisect_left(self.bounds, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+            slot = self._current_slot(now)
+            slot.count += 1
+            slot.sum += value
+            slot.min = min(slot.min, value)
+            slot.max = max(slot.max, value)
+            slot.buckets[index] += 1
+
+    def merge(self, local: BucketCounts, now: Optional[float] = None):
+        """Ajoute d'un coup des observations regroupées localement (mêmes buckets)"""
+        if not local.count:
+            return
+        with self._lock:
+            slot = self._current_slot(now)
+            for i, n in enumerate(local.buckets):
+                self.counts[i] += n
+                slot.buckets[i] += n
+            self.sum += local.sum
+            self.count += local.count
+            slot.count += local.count
+            slot.sum += local.sum
+            slot.min = min(slot.min, local.min)
+            slot.max = max(slot.max, local.max)
+
+    def _current_slot(self, now: Optional[float]) -> _Slot:
+        minute = int((now or time.time()) // _SLOT_SECONDS)
+        position = minute % len(self._slots)
+        slot = self._slots[position]
+        if slot is None or slot.minute != minute:
+            slot = self._slots[position] = _Slot(minute, len(self.bounds))
+        return slot
+
+    def window(self, hours: float = 24, now: Optional[float] = None) -> Dict[str, Any]:
+        """Résumé des observations des dernières heures (coût borné par la taille de la fenêtre)"""
+        current = int((now or time.time()) // _SLOT_SECONDS)
+        n_slots = min(len(self._slots), max(1, int(hours * 3600 // _SLOT_SECONDS)))
+        count, total, low, high = 0, 0.0, math.inf, -math.inf
+        buckets = [0] * len(self.bounds)
+        with self._lock:
+            for slot in self._slots:
+                if slot is None or not current - n_slots < slot.minute <= current:
+                    continue
+                count += slot.count
+                total += slot.sum
+                low = min(low, slot.min)
+                high = max(high, slot.max)
+                for i, n in enumerate(slot.buckets):
+                    buckets[i] += n
+
+        summary = {"count": count, "sum": total}
+        if count:
+            summary.update({
+                "avg": total / count,
+                "min": low,
+                "max": high,
+                "p50": _quantile(self.bounds, buckets, count, 0.50, low, high),
+                "p95": _quantile(self.bounds, buckets, count, 0.95, low, high),
+                "p99": _quantile(self.bounds, buckets, count, 0.99, low, high),
+            })
+        return summary
+
+    def _samples(self, name: str, labelnames, labelvalues) -> List[str]:
+        with self._lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+        lines = []
+        cumulative = 0
+        for bound, n in zip(self.bounds, counts):
+            cumulative += n
+            le = 'le="' + _format_value(bound) + '"'
+            lines.append(f"{name}_bucket{_format_labels(labelnames, labelvalues, le)} {cumulative}")
+        labels = _format_labels(labelnames, labelvalues)
+        lines.append(f"{name}_sum{labels} {_format_value(total)}")
+        lines.append(f"{name}_count{labels} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    """Ensemble des métriques du processus"""
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+              function: Optional[Callable[[], float]] = None) -> Gauge:
+        return self._register(Gauge(name, documentation, labelnames, function))
+
+    def histogram(self, name: str, documentation: str, buckets: Sequence[float] = LATENCY_BUCKETS,
+                  labelnames: Sequence[str] = ()) -> Histogram:
+        return self._register(Histogram(name, documentation, buckets, labelnames))
+
+    def render_prometheus(self) -> str:
+        """Exposition au format texte Prometheus (version 0.0.4)"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+# Instance globale
+metrics = MetricsRegistry()
@@ -9,12 +9,13 @@ import subprocess
 import psutil
 from typing import Dict, Any
 
+from autotune import load_profile
+
 class MistralOptimizer:
     """Optimiseur pour Mistral"""
     
     def __init__(self):
-        self.config_file = "config.py"
-        self.backup_file = "config_backup.py"
+        self.profile = load_profile()
         
     def analyze_system(self) -> Dict[str, Any]:
         """Analyse le système pour optimisations"""
@@ -28,7 +29,8 @@ class MistralOptimizer:
             "cpu_count": cpu_count,
             "memory_gb": round(memory_gb, 2),
             "gpu_info": gpu_info,
-            "recommendations": self.get_recommendations(cpu_count, memory_gb, gpu_info)
+            "recommendations": self.get_recommendations(cpu_count, memory_gb, gpu_info),
+            "profile": self.profile["settings"] if self.profile else None
         }
     
     def detect_gpu(self) -> Dict[str, Any]:
@@ -116,168 +118,23 @@ class MistralOptimizer:
             recommendations["threads"] = cpu_count
             recommendations["batch_size"] = max(128, recommendations["batch_size"] // 2)
         
-        return recommendations
-    
-    def create_optimized_config(self, recommendations: Dict[str, Any]):
-        """Crée une configuration optimisée"""
-        
-        # Sauvegarde de la config actuelle
-        if os.path.exists(self.config_file):
-            os.rename(self.config_file, self.backup_file)
-        
-        config_content = f'''#!/usr/bin/env python3
-"""
-Configuration optimisée pour Mistral
-Générée automatiquement par MistralOptimizer
-"""
-
-import os
-import psutil
-
-class Config:
-    """Configuration optimisée pour Mistral"""
-    
-    # Configuration matérielle
-    HARDWARE_CONFIG = {{
-        "cpu_count": {recommendations['threads']},
-        "memory_gb": {psutil.virtual_memory().total / (1024**3):.1f},
-        "gpu_layers": {recommendations['gpu_layers']},
-        "batch_size": {recommendations['batch_size']},
-        "context_size": {recommendations['context_size']}
-    }}
-    
-    # Configuration Llama.cpp optimisée
-    LLAMA_CONFIG = {{
-        "model_path": "models/mistral-{recommendations['model_size']}-instruct-v0.2.Q4_K_M.gguf",
-        "n_ctx": {recommendations['context_size']},
-        "n_batch": {recommendations['batch_size']},
-        "n_gpu_layers": {recommendations['gpu_layers']},
-        "n_threads": {recommendations['threads']},
-        "n_threads_batch": {recommendations['threads']},
-        "rope_freq_base": 10000.0,
-        "rope_freq_scale": 1.0,
-        "mul_mat_q": True,
-        "f16_kv": True,
-        "logits_all": False,
-        "vocab_only": False,
-        "use_mmap": True,
-        "use_mlock": False,
-        "embedding": False,
-        "lora_adapter": None,
-        "lora_base": None,
-        "n_keep": 0,
-        "n_discard": -1,
-        "n_predict": -1,
-        "n_parallel": 1,
-        "repeat_penalty": 1.1,
-        "repeat_last_n": 64,
-        "penalize_nl": True,
-        "temp": 0.8,
-        "top_k": 40,
-        "top_p": 0.9,
-        "tfs_z": 1.0,
-        "typical_p": 1.0,
-        "mirostat": 0,
-        "mirostat_tau": 5.0,
-        "mirostat_eta": 0.1,
-        "grammar": None,
-        "grammar_penalty": 1.0,
-        "antiprompt": [],
-        "logit_bias": None,
-        "stop": ["</s>", "[/INST]", "[INST]"],
-        "stream": True,
-        "seed": -1,
-        "ignore_eos": False,
-        "no_display_prompt": False,
-        "interactive": False,
-        "interactive_first": False,
-        "multiline_input": False,
-        "simple_io": False,
-        "color": False,
-        "mlock": False,
-        "no_mmap": False,
-        "mtest": False,
-        "verbose_prompt": False,
-        "m_eval": 0,
-    }}
-    
-    # Configuration API
-    API_CONFIG = {{
-        "host": "0.0.0.0",
-        "port": 8000,
-        "debug": False,
-        "workers": 1,
-        "max_requests": 100,
-        "timeout": 300
-    }}
-    
-    # Configuration de sécurité
-    SECURITY_CONFIG = {{
-        "cors_origins": ["*"],
-        "cors_methods": ["GET", "POST", "PUT", "DELETE"],
-        "cors_headers": ["*"],
-        "rate_limit": 100,
-        "rate_limit_window": 3600
-    }}
-    
-    # Configuration de logging
-    LOGGING_CONFIG = {{
-        "level": "INFO",
-        "format": "%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-        "file": "logs/llama_api.log",
-        "max_size": "10MB",
-        "backup_count": 5
-    }}
-    
-    # Optimisations mémoire
-    MEMORY_CONFIG = {{
-        "optimization_level": "{recommendations['memory_optimization']}",
-        "enable_mmap": True,
-        "enable_mlock": False,
-        "gpu_memory_fraction": 0.8,
-        "cpu_memory_fraction": 0.7
-    }}
-    
-    @classmethod
-    def optimize_for_hardware(cls):
-        """Optimise la configuration pour le matériel"""
-        # Ajustements automatiques basés sur le matériel
-        memory_gb = psutil.virtual_memory().total / (1024**3)
+        # Threads, batch et contexte mesurés par autotune.py priment sur les règles ci-dessus
+        if self.profile:
+            settings = self.profile["settings"]
+            recommendations["threads"] = settings["n_threads"]
+            recommendations["batch_size"] = settings["n_batch"]
+            recommendations["context_size"] = settings["n_ctx"]
+            recommendations["source"] = "profile"
+        else:
+            recommendations["source"] = "heuristic (python optimize_mistral.py --optimize pour mesurer)"
         
-        if memory_gb < 8:
-            # Mode économique
-            cls.LLAMA_CONFIG["n_batch"] = max(128, cls.LLAMA_CONFIG["n_batch"] // 2)
-            cls.LLAMA_CONFIG["n_ctx"] = min(2048, cls.LLAMA_CONFIG["n_ctx"])
-            cls.MEMORY_CONFIG["gpu_memory_fraction"] = 0.6
-        elif memory_gb >= 16:
-            # Mode performance
-            cls.LLAMA_CONFIG["n_batch"] = min(2048, cls.LLAMA_CONFIG["n_batch"] * 2)
-            cls.LLAMA_CONFIG["n_ctx"] = min(16384, cls.LLAMA_CONFIG["n_ctx"] * 2)
-            cls.MEMORY_CONFIG["gpu_memory_fraction"] = 0.9
-    
-    @classmethod
-    def get_llama_args(cls) -> dict:
-        """Retourne les arguments pour llama.cpp"""
-        return cls.LLAMA_CONFIG
-    
-    @classmethod
-    def get_api_config(cls) -> dict:
-        """Retourne la configuration API"""
-        return cls.API_CONFIG
+        return recommendations
     
-    @classmethod
-    def get_hardware_info(cls) -> dict:
-        """Retourne les informations matérielles"""
-        return cls.HARDWARE_CONFIG
-'''
+    def create_profile(self) -> Dict[str, Any]:
+        """Mesure threads, batch et contexte sur le modèle réel (profil chargé au démarrage du serveur)"""
+        from autotune import run_autotune
         
-        with open(self.config_file, 'w') as f:
-            f.write(config_content)
-        
-        print(f"✅ Configuration optimisée créée: {self.config_file}")
-        print(f"📋 Recommandations appliquées:")
-        for key, value in recommendations.items():
-            print(f"   • {key}: {value}")
+        return run_autotune()
     
     def download_optimized_model(self, model_size: str = "7B"):
         """Télécharge le modèle Mistral optimisé"""
@@ -339,7 +196,7 @@ echo "🚀 Optimisation Mistral pour votre système..."
 # Analyse du système
 python3 optimize_mistral.py --analyze
 
-# Création de la configuration optimisée
+# Mesure du réglage optimal (profil chargé au démarrage)
 python3 optimize_mistral.py --optimize
 
 # Téléchargement du modèle recommandé
@@ -361,7 +218,7 @@ def main():
     
     parser = argparse.ArgumentParser(description="Optimiseur Mistral")
     parser.add_argument("--analyze", action="store_true", help="Analyse le système")
-    parser.add_argument("--optimize", action="store_true", help="Crée une configuration optimisée")
+    parser.add_argument("--optimize", action="store_true", help="Mesure le réglage optimal (profil autotune)")
     parser.add_argument("--download", action="store_true", help="Télécharge le modèle recommandé")
     parser.add_argument("--all", action="store_true", help="Exécute toutes les optimisations")
     
@@ -375,9 +232,11 @@ def main():
         print(json.dumps(analysis, indent=2))
     
     if args.optimize or args.all:
-        print("⚙️ Création de la configuration optimisée...")
-        analysis = optimizer.analyze_system()
-        optimizer.create_optimized_config(analysis["recommendations"])
+        print("⚙️ Mesure du réglage optimal...")
+        try:
+            optimizer.profile = optimizer.create_profile()
+        except FileNotFoundError as e:
+            print(f"❌ {e} (--download d'abord)")
         optimizer.create_optimization_script()
     
     if args.download or args.all:
@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+"""
+Stockage colonnaire binaire des mesures de performance
+
+Chaque génération terminée ajoute un enregistrement de largeur fixe
+(horodatage, empreinte de l'identifiant de requête, attente, TTFT, durées
+des phases, tokens) à un segment journalier perf-AAAAMMJJ.bin. Un segment
+n'est qu'un en-tête suivi d'un tableau structuré NumPy : la lecture passe
+par numpy.memmap, et percentiles, histogrammes et débit par heure sont
+calculés en opérations vectorisées sur des millions de lignes.
+"""
+
+import hashlib
+import logging
+import math
+import os
+import struct
+import threading
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Dict, List, Optional, Any
+
+import numpy as np
+
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+_MAGIC = b"LPRF"
+_VERSION = 1
+# magic, version, taille d'un enregistrement
+_HEADER = struct.Struct("<4sHH8x")
+
+RECORD_DTYPE = np.dtype([
+    ("timestamp", "<f8"),          # Fin de la génération (epoch)
+    ("request_hash", "<u8"),       # Empreinte de l'identifiant de requête
+    ("queue_wait_ms", "<f4"),
+    ("ttft_ms", "<f4"),            # NaN sans premier token
+    ("prompt_eval_ms", "<f4"),     # NaN sans premier token
+    ("decode_ms", "<f4"),          # NaN sans premier token
+    ("total_ms", "<f4"),           # Soumission → fin
+    ("prompt_tokens", "<u4"),
+    ("prompt_tokens_cached", "<u4"),
+    ("completion_tokens", "<u4"),
+    ("finish_reason", "u1"),
+    ("_pad", "V7"),
+])
+
+FINISH_REASONS = ("stop", "length", "cancelled", "deadline", "error", "other")
+
+# Répartition rapide / normal / lent / très lent (secondes)
+DISTRIBUTION_EDGES = (0.0, 1.0, 3.0, 10.0, math.inf)
+DISTRIBUTION_LABELS = ("fast", "normal", "slow", "very_slow")
+
+
+def request_hash(request_id: str) -> int:
+    return int.from_bytes(hashlib.blake2b(request_id.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+def _ms(start: Optional[float], end: Optional[float]) -> float:
+    return (end - start) * 1000 if start is not None and end is not None else math.nan
+
+
+def _percentiles(values: np.ndarray, scale: float = 1.0, digits: int = 3) -> Dict[str, Any]:
+    """Nombre, moyenne, extrêmes et percentiles (valeurs NaN ignorées)"""
+    values = values[~np.isnan(values)]
+    if not values.size:
+        return {"count": 0}
+    p50, p95, p99 = np.percentile(values, (50, 95, 99)) * scale
+    return {
+        "count": int(values.size),
+        "avg": round(float(values.mean(dtype=np.float64)) * scale, digits),
+        "min": round(float(values.min()) * scale, digits),
+        "max": round(float(values.max()) * scale, digits),
+        "p50": round(float(p50), digits),
+        "p95": round(float(p95), digits),
+        "p99": round(float(p99), digits),
+    }
+
+
+class PerfStore:
+    """Segments journaliers d'enregistrements de performance en ajout seul"""
+
+    def __init__(self, directory: str, retention_days: int = 90, enabled: bool = True):
+        self.directory = Path(directory)
+        self.retention_days = retention_days
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._fd: Optional[int] = None
+        self._fd_day: Optional[str] = None
+        self._fd_pid: Optional[int] = None
+
+        # Statistiques
+        self.records_written = 0
+        self.write_errors = 0
+
+    # -- Écriture ------------------------------------------------------------
+
+    def _segment_path(self, day: str) -> Path:
+        return self.directory / f"perf-{day}.bin"
+
+    def _open_segment(self, day: str) -> int:
+        """Descripteur en ajout du segment du jour (en-tête écrit à la création)"""
+        if self._fd is not None and self._fd_day == day and self._fd_pid == os.getpid():
+            return self._fd
+        if self._fd is not None and self._fd_pid == os.getpid():
+            os.close(self._fd)
+            self._prune()
+        self.directory.mkdir(parents=True, exist_ok=True)
+        fd = os.open(self._segment_path(day), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        size = os.fstat(fd).st_size
+        if size == 0:
+            os.write(fd, _HEADER.pack(_MAGIC, _VERSION, RECORD_DTYPE.itemsize))
+        elif (size - _HEADER.size) % RECORD_DTYPE.itemsize:
+            # Enregistrement incomplet (arrêt brutal) : retiré pour garder l'alignement
+            os.ftruncate(fd, size - (size - _HEADER.size) % RECORD_DTYPE.itemsize)
+        self._fd, self._fd_day, self._fd_pid = fd, day, os.getpid()
+        return fd
+
+    def append_job(self, job):
+        """Enregistre un job terminé (un seul write d'une ligne de largeur fixe)"""
+        if not self.enabled:
+            return
+        finished_at = job.finished_at or time.time()
+        finish_reason = "error" if job.status == "error" else (job.finish_reason or "other")
+        record = np.zeros(1, dtype=RECORD_DTYPE)
+        record[0] = (
+            finished_at,
+            request_hash(job.request_id),
+            _ms(job.submitted_at, job.started_at),
+            _ms(job.submitted_at, job.first_token_at),
+            _ms(job.started_at, job.first_token_at),
+            _ms(job.first_token_at, job.last_token_at),
+            _ms(job.submitted_at, finished_at),
+            job.prompt_token_count,
+            job.prompt_tokens_cached,
+            job.completion_tokens,
+            FINISH_REASONS.index(finish_reason) if finish_reason in FINISH_REASONS else len(FINISH_REASONS) - 1,
+            b"",
+        )
+        day = datetime.fromtimestamp(finished_at).strftime("%Y%m%d")
+        try:
+            with self._lock:
+                os.write(self._open_segment(day), record.tobytes())
+                self.records_written += 1
+        except OSError as e:
+            self.write_errors += 1
+            logger.warning(f"Écriture impossible dans le stockage de performance: {e}")
+
+    def close(self):
+        with self._lock:
+            if self._fd is not None and self._fd_pid == os.getpid():
+                os.close(self._fd)
+            self._fd = None
+
+    def _prune(self):
+        cutoff = (datetime.now() - timedelta(days=self.retention_days)).strftime("%Y%m%d")
+        for path in self.directory.glob("perf-*.bin"):
+            if path.stem[5:] < cutoff:
+                path.unlink(missing_ok=True)
+
+    # -- Lecture -------------------------------------------------------------
+
+    def segments(self, since: Optional[float] = None) -> List[Path]:
+        """Segments pouvant contenir des enregistrements postérieurs à since"""
+        paths = sorted(self.directory.glob("perf-*.bin"))
+        if since is None:
+            return paths
+        first_day = datetime.fromtimestamp(since).strftime("%Y%m%d")
+        return [p for p in paths if p.stem[5:] >= first_day]
+
+    @staticmethod
+    def _map(path: Path) -> Optional[np.memmap]:
+        """Projection en mémoire d'un segment (enregistrement final incomplet ignoré)"""
+        size = path.stat().st_size
+        if size < _HEADER.size:
+            return None
+        with open(path, "rb") as f:
+            magic, version, itemsize = _HEADER.unpack(f.read(_HEADER.size))
+        if magic != _MAGIC or version != _VERSION or itemsize != RECORD_DTYPE.itemsize:
+            logger.warning(f"Segment de performance ignoré (format inconnu): {path}")
+            return None
+        n_records = (size - _HEADER.size) // RECORD_DTYPE.itemsize
+        if not n_records:
+            return None
+        return np.memmap(path, dtype=RECORD_DTYPE, mode="r", offset=_HEADER.size, shape=(n_records,))
+
+    def load(self, hours: Optional[float] = None) -> List[np.ndarray]:
+        """Enregistrements des dernières heures par segment (tous si hours est None), sans copie si possible"""
+        since = time.time() - hours * 3600 if hours is not None else None
+        parts = []
+        for path in self.segments(since):
+            records = self._map(path)
+            if records is None:
+                continue
+            if since is not None and records["timestamp"][0] < since:
+                records = records[records["timestamp"] >= since]
+            if records.size:
+                parts.append(records)
+        return parts
+
+    @staticmethod
+    def _column(parts: List[np.ndarray], name: str) -> np.ndarray:
+        """Une colonne contiguë sur tous les segments"""
+        if len(parts) == 1:
+            return np.ascontiguousarray(parts[0][name])
+        return np.concatenate([p[name] for p in parts])
+
+    def analyze(self, hours: Optional[float] = None) -> Dict[str, Any]:
+        """Percentiles, répartition et débit par heure sur la fenêtre demandée"""
+        started = time.perf_counter()
+        parts = self.load(hours)
+        n_records = sum(p.size for p in parts)
+        analysis: Dict[str, Any] = {"window_hours": hours, "total_requests": n_records}
+        if not n_records:
+            analysis["scan_ms"] = round((time.perf_counter() - started) * 1000, 2)
+            return analysis
+
+        total_s = self._column(parts, "total_ms") / np.float32(1000)
+        completion = self._column(parts, "completion_tokens")
+        decode_ms = self._column(parts, "decode_ms")
+        response = _percentiles(total_s)
+        total_tokens = int(completion.sum(dtype=np.int64))
+        total_seconds = float(total_s.sum(dtype=np.float64))
+
+        analysis.update({
+            "avg_response_time": response["avg"],
+            "min_response_time": response["min"],
+            "max_response_time": response["max"],
+            "p50_response_time": response["p50"],
+            "p95_response_time": response["p95"],
+            "p99_response_time": response["p99"],
+            "avg_tokens_per_request": round(total_tokens / n_records, 1),
+            "total_tokens": total_tokens,
+            "tokens_per_second": round(total_tokens / total_seconds, 1) if total_seconds > 0 else 0,
+        })
+
+        # Répartition des temps de réponse
+        bins = np.searchsorted(np.asarray(DISTRIBUTION_EDGES[1:-1], dtype=np.float32), total_s, side="right")
+        counts = np.bincount(bins, minlength=len(DISTRIBUTION_LABELS))
+        analysis["performance_distribution"] = dict(zip(DISTRIBUTION_LABELS, counts.tolist()))
+
+        # Phases
+        analysis["queue_wait"] = _percentiles(self._column(parts, "queue_wait_ms"), digits=1)
+        analysis["time_to_first_token"] = _percentiles(self._column(parts, "ttft_ms"), digits=1)
+        analysis["prompt_eval"] = _percentiles(self._column(parts, "prompt_eval_ms"), digits=1)
+        decoding = decode_ms > 0  # Faux pour NaN
+        decode_tokens_all = np.where(decoding, completion, 0)
+        decode_ms_all = np.where(decoding, decode_ms, np.float32(0))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            decode_rate = np.where(decoding, completion / (decode_ms / np.float32(1000)), np.float32(np.nan))
+        analysis["decode_tokens_per_second"] = _percentiles(decode_rate.astype(np.float32), digits=1)
+        prompt_total = int(self._column(parts, "prompt_tokens").sum(dtype=np.int64))
+        cached_total = int(self._column(parts, "prompt_tokens_cached").sum(dtype=np.int64))
+        analysis["prompt_tokens"] = {
+            "total": prompt_total,
+            "cached": cached_total,
+            "cached_ratio": round(cached_total / prompt_total, 3) if prompt_total else 0.0,
+        }
+
+        # Raisons de fin
+        reasons = np.bincount(self._column(parts, "finish_reason"), minlength=len(FINISH_REASONS))
+        analysis["finish_reasons"] = {r: int(n) for r, n in zip(FINISH_REASONS, reasons) if n}
+
+        # Requêtes, tokens et débit de décodage par heure (heures relatives à la première)
+        hour_index = (self._column(parts, "timestamp") // 3600).astype(np.int64)
+        first_hour = int(hour_index.min())
+        hour_index -= first_hour
+        requests = np.bincount(hour_index)
+        tokens = np.bincount(hour_index, weights=completion)
+        decode_tokens = np.bincount(hour_index, weights=decode_tokens_all)
+        decode_seconds = np.bincount(hour_index, weights=decode_ms_all) / 1000
+
+        analysis["requests_per_hour"] = {}
+        analysis["throughput_per_hour"] = {}
+        for offset in np.flatnonzero(requests).tolist():
+            label = datetime.fromtimestamp((first_hour + offset) * 3600).strftime("%Y-%m-%d %H")
+            analysis["requests_per_hour"][label] = int(requests[offset])
+            analysis["throughput_per_hour"][label] = {
+                "requests": int(requests[offset]),
+                "completion_tokens": int(tokens[offset]),
+                "decode_tokens_per_second": (
+                    round(float(decode_tokens[offset] / decode_seconds[offset]), 1) if decode_seconds[offset] > 0 else None
+                ),
+            }
+
+        analysis["scan_ms"] = round((time.perf_counter() - started) * 1000, 2)
+        return analysis
+
+    def get_stats(self) -> Dict[str, Any]:
+        """État du stockage"""
+        segments = self.segments() if self.directory.exists() else []
+        return {
+            "enabled": self.enabled,
+            "segments": len(segments),
+            "bytes": sum(p.stat().st_size for p in segments),
+            "records_written": self.records_written,
+            "write_errors": self.write_errors,
+        }
+
+
+# Instance globale
+perf_store = PerfStore(
+    directory=Config.PERF_STORE_CONFIG["directory"],
+    retention_days=Config.PERF_STORE_CONFIG["retention_days"],
+    enabled=Config.PERF_STORE_CONFIG["enabled"],
+)
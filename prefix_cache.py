@@ -0,0 +1,370 @@
+#!/usr/bin/env python3
+"""
+Cache de préfixes KV pour l'API Llama.cpp
+
+Arbre radix sur les ids de tokens : chaque nœud porté par un préfixe peut
+contenir un instantané d'état llama.cpp (LlamaState). Une nouvelle requête
+reprend depuis l'état qui partage le plus long préfixe avec son prompt, ce
+qui évite de réévaluer le prompt système, le template et l'historique.
+
+S'utilise via Llama.set_cache() : llama-cpp-python interroge le cache avant
+l'évaluation du prompt et y enregistre l'état en fin de génération. Avec un
+stockage disque (kv_store.py), les états évincés de la RAM y sont écrits et
+rechargés à la demande ; le nœud reste dans l'arbre avec sa clé disque.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Any, Sequence, Tuple
+
+from config import Config
+
+
+class _RadixNode:
+    """Nœud de l'arbre radix (arête compressée)"""
+
+    __slots__ = ("edge", "parent", "children", "depth", "state", "size", "last_access", "disk_key")
+
+    def __init__(self, edge: Tuple[int, ...], parent: Optional["_RadixNode"], depth: int):
+        self.edge = edge
+        self.parent = parent
+        self.children: Dict[int, "_RadixNode"] = {}
+        self.depth = depth  # Nombre de tokens depuis la racine
+        self.state = None
+        self.size = 0
+        self.last_access = 0.0
+        self.disk_key: Optional[str] = None
+
+    @property
+    def has_entry(self) -> bool:
+        return self.state is not None or self.disk_key is not None
+
+
+def _state_size(state) -> int:
+    """Taille mémoire d'un LlamaState (état llama.cpp + tableaux numpy)"""
+    size = int(getattr(state, "llama_state_size", 0))
+    for name in ("input_ids", "scores"):
+        array = getattr(state, name, None)
+        size += int(getattr(array, "nbytes", 0))
+    return size
+
+
+def _state_tokens(key: Sequence[int], state) -> Tuple[int, ...]:
+    """Tokens réellement évalués dans l'état (la clé peut inclure le dernier token non évalué)"""
+    input_ids = getattr(state, "input_ids", None)
+    n_tokens = getattr(state, "n_tokens", None)
+    if input_ids is not None and n_tokens is not None:
+        return tuple(int(t) for t in input_ids[:n_tokens])
+    return tuple(key)
+
+
+class RadixPrefixCache:
+    """Cache d'états KV indexé par préfixe de tokens, borné en octets (LRU)"""
+
+    def __init__(self, capacity_bytes: int = 1024 ** 3):
+        self.capacity_bytes = capacity_bytes
+        self._root = _RadixNode((), None, 0)
+        self._lru: "OrderedDict[int, _RadixNode]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.RLock()
+        self.store = None
+        # États évincés en cours d'écriture disque (clé -> état), encore servis depuis la RAM
+        self._spilling: Dict[str, Any] = {}
+
+        # Statistiques
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.tokens_reused = 0
+        self.last_served_prefix = 0  # Préfixe du dernier état servi, compté une fois chargé (record_reuse)
+        self.disk_hits = 0
+        self.spilled = 0
+
+    def attach_store(self, store):
+        """Active l'écriture sur disque des états évincés et réindexe ceux déjà présents"""
+        from kv_store import prefix_key
+
+        self.store = store
+        restored = 0
+        for key in store.keys("prefix-"):
+            tokens = store.read_tokens(key)
+            if not tokens or prefix_key(tokens) != key:
+                continue
+            with self._lock:
+                node = self._insert_node(tuple(tokens))
+                if not node.has_entry:
+                    node.disk_key = key
+                    restored += 1
+        return restored
+
+    # --- Interface BaseLlamaCache (llama-cpp-python) ---
+
+    @property
+    def cache_size(self) -> int:
+        return self._bytes
+
+    def __getitem__(self, key: Sequence[int]):
+        tokens = tuple(key)
+        pending: List[Tuple[_RadixNode, str, Any]] = []
+        try:
+            with self._lock:
+                while True:
+                    node, prefix_len = self._find_longest_prefix(tokens)
+                    if node is None:
+                        self.misses += 1
+                        raise KeyError("Aucun préfixe en cache")
+                    state = node.state
+                    if state is None:
+                        state = self._load_from_disk(node, pending)
+                        if state is None:
+                            continue
+                    self.hits += 1
+                    self.last_served_prefix = prefix_len
+                    if node.state is not None:
+                        self._touch(node)
+                    return state
+        finally:
+            self._write_spilled(pending)
+
+    def take_served_prefix(self) -> int:
+        """Longueur du préfixe du dernier état servi (remise à zéro)"""
+        served, self.last_served_prefix = self.last_served_prefix, 0
+        return served
+
+    def record_reuse(self, n_tokens: int):
+        """Compte les tokens repris d'un état que llama-cpp a effectivement chargé"""
+        self.tokens_reused += n_tokens
+
+    def _load_from_disk(self, node: _RadixNode, pending: List[Tuple[_RadixNode, str, Any]]) -> Optional[Any]:
+        """Recharge l'état d'un nœud écrit sur disque (gardé en RAM s'il tient dans le budget)"""
+        state = self._spilling.get(node.disk_key)
+        if state is None and self.store:
+            state = self.store.get(node.disk_key)
+        if state is None:
+            node.disk_key = None
+            self._prune(node)
+            return None
+        self.disk_hits += 1
+        size = _state_size(state)
+        if size > self.capacity_bytes:
+            # Plus grand que le budget RAM : servi depuis le disque sans y être gardé
+            return state
+        node.state = state
+        node.size = size
+        self._bytes += size
+        self._touch(node)
+        pending.extend(self._evict(keep=node))
+        return state
+
+    def __contains__(self, key: Sequence[int]) -> bool:
+        with self._lock:
+            node = self._find_exact(tuple(key))
+            return node is not None and node.has_entry
+
+    def __setitem__(self, key: Sequence[int], state):
+        self.insert(_state_tokens(key, state), state)
+
+    # --- Arbre radix ---
+
+    def insert(self, tokens: Tuple[int, ...], state):
+        """Enregistre l'état associé à une séquence de tokens"""
+        size = _state_size(state)
+        if not tokens or size > self.capacity_bytes:
+            return
+
+        with self._lock:
+            node = self._insert_node(tokens)
+            if node.state is not None:
+                self._bytes -= node.size
+            node.state = state
+            node.size = size
+            self._bytes += size
+            self._touch(node)
+            pending = self._evict()
+        self._write_spilled(pending)
+
+    def _insert_node(self, tokens: Tuple[int, ...]) -> _RadixNode:
+        """Nœud correspondant exactement à la séquence (créé si besoin)"""
+        node = self._root
+        i = 0
+        while i < len(tokens):
+            child = node.children.get(tokens[i])
+            if child is None:
+                leaf = _RadixNode(tokens[i:], node, len(tokens))
+                node.children[tokens[i]] = leaf
+                return leaf
+
+            common = self._edge_match(child.edge, tokens, i)
+            if common < len(child.edge):
+                child = self._split(child, common)
+            node = child
+            i += common
+        return node
+
+    def _find_exact(self, tokens: Tuple[int, ...]) -> Optional[_RadixNode]:
+        node = self._root
+        i = 0
+        while i < len(tokens):
+            child = node.children.get(tokens[i])
+            if child is None:
+                return None
+            common = self._edge_match(child.edge, tokens, i)
+            if common < len(child.edge):
+                return None
+            node = child
+            i += common
+        return node
+
+    def _find_longest_prefix(self, tokens: Tuple[int, ...]) -> Tuple[Optional[_RadixNode], int]:
+        """État partageant le plus long préfixe avec la séquence (nœud, longueur commune)"""
+        best: Optional[_RadixNode] = None
+        best_len = 0
+        node = self._root
+        i = 0
+
+        while i < len(tokens):
+            child = node.children.get(tokens[i])
+            if child is None:
+                break
+            common = self._edge_match(child.edge, tokens, i)
+            i += common
+            if common < len(child.edge):
+                # Divergence au milieu d'une arête : tout état du sous-arbre partage i tokens
+                node = child
+                break
+            node = child
+            if node.has_entry:
+                best, best_len = node, node.depth
+
+        # Un état plus profond que le point de divergence partage aussi i tokens
+        if i > best_len:
+            candidate = self._any_state(node)
+            if candidate is not None:
+                best, best_len = candidate, i
+
+        return best, best_len
+
+    def _any_state(self, node: _RadixNode) -> Optional[_RadixNode]:
+        """État le plus récemment utilisé du sous-arbre"""
+        found: Optional[_RadixNode] = None
+        stack = [node]
+        while stack:
+            current = stack.pop()
+            if current.has_entry and (found is None or current.last_access > found.last_access):
+                found = current
+            stack.extend(current.children.values())
+        return found
+
+    @staticmethod
+    def _edge_match(edge: Tuple[int, ...], tokens: Tuple[int, ...], start: int) -> int:
+        n = 0
+        limit = min(len(edge), len(tokens) - start)
+        while n < limit and edge[n] == tokens[start + n]:
+            n += 1
+        return n
+
+    def _split(self, node: _RadixNode, at: int) -> _RadixNode:
+        """Coupe l'arête d'un nœud ; retourne le nouveau nœud intermédiaire"""
+        parent = node.parent
+        middle = _RadixNode(node.edge[:at], parent, node.depth - len(node.edge) + at)
+        parent.children[middle.edge[0]] = middle
+        node.edge = node.edge[at:]
+        node.parent = middle
+        middle.children[node.edge[0]] = node
+        return middle
+
+    def _touch(self, node: _RadixNode):
+        node.last_access = time.time()
+        self._lru[id(node)] = node
+        self._lru.move_to_end(id(node))
+
+    def _evict(self, keep: Optional[_RadixNode] = None) -> List[Tuple[_RadixNode, str, Any]]:
+        """Évince les états les moins récemment utilisés au-delà du budget (sous verrou)
+
+        Retourne les états à écrire sur disque : l'écriture (_write_spilled) se fait
+        après la libération du verrou, pour ne pas bloquer get_stats ni les lectures.
+        """
+        pending: List[Tuple[_RadixNode, str, Any]] = []
+        kept = False
+        while self._bytes > self.capacity_bytes and self._lru:
+            _, node = self._lru.popitem(last=False)
+            if node is keep:
+                # État qui vient d'être rechargé pour la requête en cours
+                kept = True
+                continue
+            if self.store is not None and node.disk_key is None:
+                from kv_store import prefix_key
+
+                # Le nœud garde sa clé disque pendant l'écriture ; l'état reste lisible via _spilling
+                key = prefix_key(node.state.input_ids[:node.state.n_tokens])
+                node.disk_key = key
+                self._spilling[key] = node.state
+                pending.append((node, key, node.state))
+            self._drop_state(node)
+            self.evictions += 1
+        if kept:
+            self._lru[id(keep)] = keep
+        return pending
+
+    def _write_spilled(self, pending: List[Tuple[_RadixNode, str, Any]]):
+        """Écrit sur disque les états évincés (hors verrou)"""
+        for node, key, state in pending:
+            written = self.store.put(key, state)
+            with self._lock:
+                self._spilling.pop(key, None)
+                if written:
+                    self.spilled += 1
+                elif node.disk_key == key and node.state is None:
+                    node.disk_key = None
+                    self._prune(node)
+
+    def _drop_state(self, node: _RadixNode):
+        self._bytes -= node.size
+        node.state = None
+        node.size = 0
+        self._prune(node)
+
+    def _prune(self, node: _RadixNode):
+        """Supprime les nœuds vides et recompresse les arêtes"""
+        while node is not self._root and not node.has_entry:
+            parent = node.parent
+            if not node.children:
+                del parent.children[node.edge[0]]
+            elif len(node.children) == 1:
+                (child,) = node.children.values()
+                child.edge = node.edge + child.edge
+                child.parent = parent
+                parent.children[child.edge[0]] = child
+            else:
+                return
+            node = parent
+
+    def clear(self):
+        """Vide le cache"""
+        with self._lock:
+            self._root = _RadixNode((), None, 0)
+            self._lru.clear()
+            self._bytes = 0
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Statistiques du cache de préfixes (sans verrou : lues depuis /health, valeurs indicatives)"""
+        lookups = self.hits + self.misses
+        return {
+            "enabled": Config.PREFIX_CACHE_CONFIG["enabled"],
+            "entries": len(self._lru),
+            "bytes": self._bytes,
+            "capacity_bytes": self.capacity_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            "evictions": self.evictions,
+            "tokens_reused": self.tokens_reused,
+            "disk_hits": self.disk_hits,
+            "spilled_to_disk": self.spilled,
+            "spilling": len(self._spilling),
+        }
+
+
+# Instance globale
+prefix_cache = RadixPrefixCache(Config.PREFIX_CACHE_CONFIG["max_bytes"])
@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+"""
+Cache de réponses déterministes pour l'API Llama.cpp
+
+Les requêtes à température 0 ou avec un seed fixé produisent toujours la même
+réponse : elle est conservée sous une clé canonique (messages, prompt système,
+modèle, max_tokens, stop, paramètres d'échantillonnage) dans un LRU en RAM avec
+durée de validité, et optionnellement dans un second niveau sur disque. Une
+réponse en cache est rejouée sous forme de job, identique pour le JSON, le SSE
+et le WebSocket.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, List, Optional, Any, AsyncIterator, Tuple
+
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+
+def is_deterministic(params: Dict[str, Any]) -> bool:
+    """Requête reproductible : échantillonnage glouton ou seed fixé"""
+    seed = params.get("seed")
+    return params.get("temperature", 0.8) <= 0.0 or (seed is not None and seed >= 0)
+
+
+def make_cache_key(messages: List[Dict[str, str]], model: str, params: Dict[str, Any]) -> str:
+    """Empreinte canonique d'une requête (le prompt système fait partie des messages)"""
+    payload = {
+        "model_path": Config.LLAMA_CONFIG["model_path"],
+        "model": model,
+        "messages": [{"role": m["role"], "content": m["content"]} for m in messages],
+        "params": params,
+    }
+    canonical = json.dumps(payload, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class CachedResponseJob:
+    """Rejoue une réponse en cache avec l'interface d'un GenerationJob"""
+
+    def __init__(self, request_id: str, response: Dict[str, Any], stream: bool):
+        self.request_id = request_id
+        self.stream = stream
+        self.completion_id = f"chatcmpl-{uuid.uuid4()}"
+        self.created = int(time.time())
+        # Pas de phases de génération pour une réponse rejouée
+        self.response = dict(response, id=self.completion_id, created=self.created, timings=None)
+        self.finish_reason = response["choices"][0]["finish_reason"]
+
+    def _make_chunk(self, delta: Dict[str, str], finish_reason: Optional[str] = None) -> Dict[str, Any]:
+        return {
+            "id": self.completion_id,
+            "object": "chat.completion.chunk",
+            "created": self.created,
+            "model": self.response.get("model", ""),
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+        }
+
+    async def __aiter__(self) -> AsyncIterator[Dict[str, Any]]:
+        content = self.response["choices"][0]["message"]["content"]
+        yield self._make_chunk({"role": "assistant"})
+        if content:
+            yield self._make_chunk({"content": content})
+        chunk = self._make_chunk({}, self.finish_reason)
+        chunk["context_window"] = self.response.get("context_window")
+        chunk["timings"] = None
+        yield chunk
+
+    async def wait(self) -> Dict[str, Any]:
+        return self.response
+
+    def cancel(self, reason: str = "cancelled"):
+        """Rien à interrompre : la réponse est déjà calculée"""
+
+
+class ResponseCache:
+    """LRU en RAM avec TTL, doublé d'un niveau disque optionnel"""
+
+    # Réponses interrompues (annulation, échéance...) jamais mises en cache
+    CACHEABLE_FINISH_REASONS = ("stop", "length")
+
+    def __init__(self, max_entries: int, ttl: float, directory: Optional[str] = None, disk_max_entries: int = 0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.directory = Path(directory) if directory else None
+        self.disk_max_entries = disk_max_entries
+        self._entries: "OrderedDict[str, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+        self._disk_index: "OrderedDict[str, float]" = OrderedDict()
+        self._lock = threading.Lock()
+
+        # Statistiques
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.expired = 0
+
+    def open(self):
+        """Indexe le niveau disque et supprime les entrées expirées"""
+        if self.directory is None:
+            return
+        self.directory.mkdir(parents=True, exist_ok=True)
+        now = time.time()
+        for path in sorted(self.directory.glob("*.json"), key=lambda p: p.stat().st_mtime):
+            stored_at = path.stat().st_mtime
+            if now - stored_at > self.ttl:
+                path.unlink(missing_ok=True)
+                continue
+            self._disk_index[path.stem] = stored_at
+        logger.info(f"🗃️ Cache de réponses disque: {len(self._disk_index)} entrée(s)")
+
+    def _path(self, key: str) -> Path:
+        return self.directory / f"{key}.json"
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """Réponse en cache encore valide (None sinon)"""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                stored_at, response = entry
+                if now - stored_at <= self.ttl:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return response
+                del self._entries[key]
+                self.expired += 1
+
+        response = self._read_disk(key, now)
+        with self._lock:
+            if response is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self._remember(key, self._disk_index.get(key, now), response)
+        return response
+
+    def _read_disk(self, key: str, now: float) -> Optional[Dict[str, Any]]:
+        if self.directory is None or key not in self._disk_index:
+            return None
+        if now - self._disk_index[key] > self.ttl:
+            self._delete_disk(key)
+            self.expired += 1
+            return None
+        try:
+            return json.loads(self._path(key).read_text())
+        except (OSError, ValueError):
+            self._delete_disk(key)
+            return None
+
+    def put(self, key: str, response: Dict[str, Any]):
+        """Enregistre une réponse complète"""
+        if response["choices"][0].get("finish_reason") not in self.CACHEABLE_FINISH_REASONS:
+            return
+        now = time.time()
+        with self._lock:
+            self._remember(key, now, response)
+            self.stores += 1
+        if self.directory is not None:
+            self._write_disk(key, response, now)
+
+    def _remember(self, key: str, stored_at: float, response: Dict[str, Any]):
+        self._entries[key] = (stored_at, response)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _write_disk(self, key: str, response: Dict[str, Any], stored_at: float):
+        path = self._path(key)
+        tmp_path = path.with_suffix(".tmp")
+        try:
+            tmp_path.write_text(json.dumps(response, ensure_ascii=False))
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"Écriture du cache de réponses impossible: {e}")
+            return
+        with self._lock:
+            self._disk_index[key] = stored_at
+            self._disk_index.move_to_end(key)
+            while len(self._disk_index) > self.disk_max_entries:
+                oldest, _ = self._disk_index.popitem(last=False)
+                self._path(oldest).unlink(missing_ok=True)
+
+    def _delete_disk(self, key: str):
+        with self._lock:
+            self._disk_index.pop(key, None)
+        self._path(key).unlink(missing_ok=True)
+
+    def clear(self):
+        """Vide les deux niveaux"""
+        with self._lock:
+            self._entries.clear()
+            keys = list(self._disk_index)
+        for key in keys:
+            self._delete_disk(key)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Statistiques du cache de réponses"""
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                "enabled": Config.RESPONSE_CACHE_CONFIG["enabled"],
+                "entries": len(self._entries),
+                "disk_entries": len(self._disk_index),
+                "max_entries": self.max_entries,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": round((self.hits + self.disk_hits) / lookups, 3) if lookups else 0.0,
+                "stores": self.stores,
+                "expired": self.expired,
+            }
+
+
+# Instance globale
+response_cache = ResponseCache(
+    max_entries=Config.RESPONSE_CACHE_CONFIG["max_entries"],
+    ttl=Config.RESPONSE_CACHE_CONFIG["ttl"],
+    directory=Config.RESPONSE_CACHE_CONFIG["directory"] if Config.RESPONSE_CACHE_CONFIG["disk_enabled"] else None,
+    disk_max_entries=Config.RESPONSE_CACHE_CONFIG["disk_max_entries"],
+)
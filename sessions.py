@@ -0,0 +1,330 @@
+#!/usr/bin/env python3
+"""
+Sessions de chat côté serveur pour l'API Llama.cpp
+
+Une session conserve l'historique de la conversation et l'instantané KV
+llama.cpp de son dernier tour : le client n'envoie que le nouveau message,
+et seul celui-ci est évalué avant la génération.
+
+Les instantanés des sessions inactives sont déplacés vers le stockage disque
+(kv_store.py) avec l'historique, puis rechargés au tour suivant, y compris
+après un redémarrage du serveur.
+"""
+
+import json
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Any
+
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+
+class SessionNotFoundError(KeyError):
+    """Session inconnue ou expirée"""
+
+
+class SessionBusyError(Exception):
+    """Un tour est déjà en cours pour cette session"""
+
+
+class ChatSession:
+    """Conversation conservée côté serveur"""
+
+    def __init__(self, session_id: str, system_prompt: Optional[str] = None, model: str = "mistral-7b-instruct"):
+        self.session_id = session_id
+        self.model = model
+        self.messages: List[Dict[str, str]] = []
+        if system_prompt:
+            self.messages.append({"role": "system", "content": system_prompt})
+
+        self.created_at = time.time()
+        self.last_used = self.created_at
+        self.turns = 0
+        self.busy = False
+
+        # Instantané KV du dernier tour (LlamaState) et nombre de tokens couverts
+        self.state = None
+        self.state_on_disk = False
+        self.n_tokens = 0
+        # Copie locale d'un worker forké : état KV seulement, l'historique reste au processus principal
+        self.shadow = False
+
+    @property
+    def store_key(self) -> str:
+        return f"session-{self.session_id}"
+
+    @property
+    def state_bytes(self) -> int:
+        if self.state is None:
+            return 0
+        return int(getattr(self.state, "llama_state_size", 0))
+
+    def to_dict(self, include_messages: bool = False) -> Dict[str, Any]:
+        """Résumé de la session"""
+        info: Dict[str, Any] = {
+            "session_id": self.session_id,
+            "model": self.model,
+            "created_at": self.created_at,
+            "last_used": self.last_used,
+            "turns": self.turns,
+            "message_count": len(self.messages),
+            "n_tokens": self.n_tokens,
+            "kv_state_cached": self.state is not None,
+            "kv_state_on_disk": self.state_on_disk,
+            "kv_state_bytes": self.state_bytes,
+            "busy": self.busy,
+        }
+        if include_messages:
+            info["messages"] = list(self.messages)
+        return info
+
+
+class SessionManager:
+    """Registre des sessions avec éviction selon SESSION_CONFIG"""
+
+    def __init__(self, max_sessions: int, max_tokens_per_session: int, idle_timeout: float):
+        self.max_sessions = max_sessions
+        self.max_tokens_per_session = max_tokens_per_session
+        self.idle_timeout = idle_timeout
+        self._sessions: "OrderedDict[str, ChatSession]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.store = None
+        self._remove_listeners: List[Callable[[str], None]] = []
+        self.evicted_sessions = 0
+        self.trimmed_turns = 0
+        self.spilled_sessions = 0
+        self.restored_states = 0
+
+    def attach_store(self, store) -> int:
+        """Active le stockage disque et recharge les sessions persistées"""
+        self.store = store
+        loaded = 0
+        for path in sorted(store.directory.glob("session-*.json"), key=lambda p: p.stat().st_mtime):
+            try:
+                data = json.loads(path.read_text())
+            except (OSError, ValueError) as e:
+                logger.warning(f"Session illisible {path.name}: {e}")
+                continue
+            session = ChatSession(data["session_id"], model=data.get("model", "mistral-7b-instruct"))
+            session.messages = data["messages"]
+            session.created_at = data.get("created_at", session.created_at)
+            session.turns = data.get("turns", 0)
+            session.n_tokens = data.get("n_tokens", 0)
+            session.state_on_disk = session.store_key in store
+            with self._lock:
+                self._sessions[session.session_id] = session
+            loaded += 1
+        # Sessions relues de la plus ancienne à la plus récente : les plus anciennes sont évincées
+        with self._lock:
+            evicted_before = self.evicted_sessions
+            self._enforce_limit()
+            loaded -= self.evicted_sessions - evicted_before
+        if loaded:
+            logger.info(f"💾 {loaded} session(s) restaurée(s) depuis le disque")
+        return loaded
+
+    def add_remove_listener(self, callback: Callable[[str], None]):
+        """Appelé avec l'identifiant de chaque session supprimée ou évincée"""
+        self._remove_listeners.append(callback)
+
+    def _metadata_path(self, session: ChatSession) -> Path:
+        return self.store.directory / f"{session.store_key}.json"
+
+    def create(self, system_prompt: Optional[str] = None, model: str = "mistral-7b-instruct") -> ChatSession:
+        """Crée une session (évince la moins récemment utilisée si nécessaire)"""
+        session = ChatSession(str(uuid.uuid4()), system_prompt, model)
+        with self._lock:
+            self._sessions[session.session_id] = session
+            self._enforce_limit()
+        return session
+
+    def _enforce_limit(self):
+        """Évince les sessions les moins récemment utilisées au-delà de max_sessions (sous verrou)"""
+        while len(self._sessions) > self.max_sessions:
+            victim = next((s for s in self._sessions.values() if not s.busy), None)
+            if victim is None:
+                break
+            self._remove(victim.session_id)
+            self.evicted_sessions += 1
+
+    def get(self, session_id: str) -> ChatSession:
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                raise SessionNotFoundError(session_id)
+            self._sessions.move_to_end(session_id)
+            return session
+
+    def shadow(self, session_id: str) -> ChatSession:
+        """Session locale d'un worker forké : seul l'état KV y est suivi (worker_pool.py)"""
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                session = ChatSession(session_id)
+                session.shadow = True
+                self._sessions[session_id] = session
+            return session
+
+    def delete(self, session_id: str):
+        with self._lock:
+            if session_id not in self._sessions:
+                raise SessionNotFoundError(session_id)
+            self._remove(session_id)
+
+    def _remove(self, session_id: str):
+        session = self._sessions.pop(session_id)
+        session.state = None
+        if self.store is not None:
+            self.store.delete(session.store_key)
+            try:
+                self._metadata_path(session).unlink()
+            except FileNotFoundError:
+                pass
+        for callback in self._remove_listeners:
+            callback(session_id)
+
+    def begin_turn(self, session_id: str, content: str) -> ChatSession:
+        """Ajoute le message utilisateur et réserve la session pour ce tour"""
+        session = self.get(session_id)
+        with self._lock:
+            if session.busy:
+                raise SessionBusyError(session_id)
+            session.busy = True
+            session.last_used = time.time()
+            session.messages.append({"role": "user", "content": content})
+        return session
+
+    def end_turn(self, session: ChatSession, reply: Optional[str], state=None, n_tokens: int = 0):
+        """Enregistre la réponse et l'état KV (appelé depuis le thread de génération)"""
+        with self._lock:
+            session.busy = False
+            session.last_used = time.time()
+            if reply is None:
+                # Échec : on retire le message utilisateur du tour avorté
+                if session.messages and session.messages[-1]["role"] == "user":
+                    session.messages.pop()
+                return
+
+            if not session.shadow:
+                session.messages.append({"role": "assistant", "content": reply})
+            session.turns += 1
+            session.state = state
+            session.n_tokens = n_tokens
+            stale_on_disk = session.state_on_disk
+            session.state_on_disk = False
+
+            if n_tokens > self.max_tokens_per_session:
+                self._trim(session)
+
+        if stale_on_disk and self.store is not None:
+            self.store.delete(session.store_key)
+
+    def load_state(self, session: ChatSession):
+        """État KV de la session, relu depuis le disque si nécessaire (thread de génération)"""
+        if session.state is None and session.state_on_disk and self.store is not None:
+            state = self.store.get(session.store_key)
+            with self._lock:
+                session.state_on_disk = False
+                if state is not None:
+                    session.state = state
+                    self.restored_states += 1
+        return session.state
+
+    def spill_idle(self, idle_seconds: float, force: bool = False) -> int:
+        """Écrit sur disque l'état KV et l'historique des sessions inactives"""
+        if self.store is None:
+            return 0
+
+        now = time.time()
+        with self._lock:
+            candidates = [
+                (s, s.state) for s in self._sessions.values()
+                if not s.busy and (force or (s.state is not None and now - s.last_used > idle_seconds))
+            ]
+
+        spilled = 0
+        for session, state in candidates:
+            self._write_metadata(session)
+            if state is None or not self.store.put(session.store_key, state):
+                continue
+            with self._lock:
+                if session.state is state and not session.busy:
+                    session.state = None
+                    session.state_on_disk = True
+                    spilled += 1
+        self.spilled_sessions += spilled
+        return spilled
+
+    def _write_metadata(self, session: ChatSession):
+        data = {
+            "session_id": session.session_id,
+            "model": session.model,
+            "created_at": session.created_at,
+            "turns": session.turns,
+            "n_tokens": session.n_tokens,
+            "messages": list(session.messages),
+        }
+        self._metadata_path(session).write_text(json.dumps(data, ensure_ascii=False))
+
+    def _trim(self, session: ChatSession):
+        """Retire les tours les plus anciens (le prompt système reste épinglé)"""
+        start = 1 if session.messages and session.messages[0]["role"] == "system" else 0
+        # Estimation proportionnelle : on retire des tours jusqu'à repasser sous la moitié du budget
+        total_chars = sum(len(m["content"]) for m in session.messages[start:]) or 1
+        target_chars = total_chars * (self.max_tokens_per_session / 2) / session.n_tokens
+        while len(session.messages) - start > 2 and total_chars > target_chars:
+            removed = session.messages[start:start + 2]
+            del session.messages[start:start + 2]
+            total_chars -= sum(len(m["content"]) for m in removed)
+            self.trimmed_turns += 1
+
+        # L'historique ne correspond plus au cache KV : prochain tour réévalué entièrement
+        session.state = None
+        session.n_tokens = 0
+
+    def cleanup(self) -> int:
+        """Supprime les sessions inactives depuis plus de idle_timeout"""
+        now = time.time()
+        with self._lock:
+            expired = [
+                sid for sid, s in self._sessions.items()
+                if not s.busy and now - s.last_used > self.idle_timeout
+            ]
+            for sid in expired:
+                self._remove(sid)
+            self.evicted_sessions += len(expired)
+        if expired:
+            logger.info(f"🧹 {len(expired)} session(s) inactive(s) supprimée(s)")
+        return len(expired)
+
+    def list(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            return [s.to_dict() for s in self._sessions.values()]
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Statistiques des sessions"""
+        with self._lock:
+            return {
+                "active_sessions": len(self._sessions),
+                "max_sessions": self.max_sessions,
+                "kv_state_bytes": sum(s.state_bytes for s in self._sessions.values()),
+                "kv_states_on_disk": sum(1 for s in self._sessions.values() if s.state_on_disk),
+                "evicted_sessions": self.evicted_sessions,
+                "trimmed_turns": self.trimmed_turns,
+                "spilled_sessions": self.spilled_sessions,
+                "restored_states": self.restored_states,
+            }
+
+
+# Instance globale
+session_manager = SessionManager(
+    max_sessions=Config.SESSION_CONFIG["max_sessions"],
+    max_tokens_per_session=Config.MEMORY_CONFIG["max_tokens_per_conversation"],
+    idle_timeout=Config.SESSION_CONFIG["idle_timeout"],
+)
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+Coalescence des requêtes déterministes identiques en cours pour l'API Llama.cpp
+
+Une requête déterministe (même clé que le cache de réponses) identique à une
+génération déjà en cours ne repart pas dans la file : elle s'abonne au flux
+existant. Chaque abonné reçoit la même suite de chunks ; un abonné tardif
+rejoue d'abord les chunks déjà produits puis suit le flux en direct.
+"""
+
+import asyncio
+import logging
+from typing import Dict, List, Optional, Any, AsyncIterator
+
+logger = logging.getLogger(__name__)
+
+
+class _Flight:
+    """Génération partagée entre plusieurs requêtes identiques"""
+
+    def __init__(self, key: str, job, on_done):
+        self.key = key
+        self.job = job
+        self.chunks: List[Dict[str, Any]] = []
+        self.result: Optional[Dict[str, Any]] = None
+        self.error: Optional[Exception] = None
+        self.done = False
+        self.subscribers = 0
+        self.changed = asyncio.Event()
+        self._on_done = on_done
+        self._task = asyncio.get_running_loop().create_task(self._pump())
+
+    async def _pump(self):
+        """Consomme le job et publie chaque chunk aux abonnés"""
+        try:
+            async for chunk in self.job:
+                self.chunks.append(chunk)
+                self._notify()
+            self.result = await self.job.wait()
+        except Exception as e:
+            self.error = e
+        finally:
+            self.done = True
+            self._notify()
+            self._on_done(self)
+
+    def _notify(self):
+        # Un nouvel événement par publication : chaque abonné attend celui qu'il a capturé
+        event, self.changed = self.changed, asyncio.Event()
+        event.set()
+
+
+class FlightSubscriber:
+    """Abonné à une génération partagée (interface d'un GenerationJob)"""
+
+    def __init__(self, flight: _Flight, request_id: str, stream: bool):
+        self.flight = flight
+        self.request_id = request_id
+        self.stream = stream
+        self._cancelled = False
+        flight.subscribers += 1
+
+    def cancel(self, reason: str = "cancelled"):
+        """Désabonnement ; la génération n'est interrompue qu'au départ du dernier abonné"""
+        if self._cancelled:
+            return
+        self._cancelled = True
+        flight = self.flight
+        flight.subscribers -= 1
+        if flight.subscribers <= 0 and not flight.done:
+            flight.job.cancel(reason)
+
+    async def __aiter__(self) -> AsyncIterator[Dict[str, Any]]:
+        """Rejoue les chunks déjà produits puis suit le flux en direct"""
+        flight = self.flight
+        position = 0
+        while True:
+            event = flight.changed
+            while position < len(flight.chunks):
+                yield flight.chunks[position]
+                position += 1
+            if flight.done:
+                break
+            await event.wait()
+        if flight.error is not None:
+            raise flight.error
+
+    async def wait(self) -> Dict[str, Any]:
+        """Attend la réponse complète de la génération partagée"""
+        flight = self.flight
+        while not flight.done:
+            await flight.changed.wait()
+        if flight.error is not None:
+            raise flight.error
+        return flight.result
+
+
+class SingleFlight:
+    """Registre des générations déterministes en cours, par clé de requête"""
+
+    def __init__(self):
+        self._flights: Dict[str, _Flight] = {}
+
+        # Statistiques
+        self.leaders = 0
+        self.coalesced = 0
+
+    def join(self, key: str, request_id: str, stream: bool) -> Optional[FlightSubscriber]:
+        """Abonne la requête à une génération identique en cours (None s'il n'y en a pas)"""
+        flight = self._flights.get(key)
+        if flight is None or flight.done or flight.subscribers <= 0:
+            return None
+        self.coalesced += 1
+        logger.debug(f"🔗 Requête {request_id} rattachée à une génération en cours")
+        return FlightSubscriber(flight, request_id, stream)
+
+    def start(self, key: str, job, request_id: str, stream: bool) -> FlightSubscriber:
+        """Publie un job (soumis en streaming) comme génération partagée"""
+        flight = _Flight(key, job, self._finish)
+        self._flights[key] = flight
+        self.leaders += 1
+        return FlightSubscriber(flight, request_id, stream)
+
+    def _finish(self, flight: _Flight):
+        if self._flights.get(flight.key) is flight:
+            del self._flights[flight.key]
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Statistiques de coalescence"""
+        return {
+            "in_flight": len(self._flights),
+            "subscribers": sum(f.subscribers for f in self._flights.values()),
+            "leaders": self.leaders,
+            "coalesced_requests": self.coalesced,
+        }
+
+
+# Instance globale
+single_flight = SingleFlight()
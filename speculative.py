@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+"""
+Décodage spéculatif avec un petit modèle brouillon pour l'API Llama.cpp
+
+Un petit GGUF du répertoire models/ (même vocabulaire que le modèle principal)
+propose k tokens de façon gloutonne ; llama-cpp-python les vérifie en une seule
+évaluation batchée du modèle principal (paramètre draft_model de Llama) et ne
+garde que ceux que le modèle principal aurait lui-même échantillonnés. La sortie
+est donc identique au décodage classique, en particulier à température 0.
+
+L'objet expose l'interface LlamaDraftModel (appel avec les input_ids, retour
+des tokens proposés) et mesure le taux d'acceptation et l'accélération.
+"""
+
+import logging
+import os
+import threading
+import time
+from typing import Dict, Optional, Any
+
+import numpy as np
+
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+
+def _common_prefix_length(a, b) -> int:
+    """Longueur du préfixe commun de deux séquences de tokens"""
+    n = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        n += 1
+    return n
+
+
+class SpeculativeDraftModel:
+    """Modèle brouillon gardant son propre contexte KV aligné sur la séquence principale"""
+
+    def __init__(self, draft, num_draft_tokens: int = 5):
+        self.draft = draft
+        self.num_draft_tokens = num_draft_tokens
+        self.eos_token = draft.token_eos()
+        self._lock = threading.Lock()
+
+        # Dernière proposition, pour mesurer l'acceptation à l'appel suivant
+        self._last_input_len = 0
+        self._last_proposal: Optional[np.ndarray] = None
+        self._last_return: Optional[float] = None
+
+        # Statistiques
+        self.steps = 0
+        self.proposed_tokens = 0
+        self.accepted_tokens = 0
+        self.generated_tokens = 0
+        self.draft_time = 0.0
+        self.verify_time = 0.0
+        self.verify_steps = 0
+
+    def __call__(self, input_ids: np.ndarray, **kwargs) -> np.ndarray:
+        start = time.time()
+        with self._lock:
+            self._record_verification(input_ids, start)
+            proposal = self._propose(input_ids)
+
+            self.steps += 1
+            self.proposed_tokens += len(proposal)
+            self._last_input_len = len(input_ids)
+            self._last_proposal = proposal
+            self._last_return = time.time()
+            self.draft_time += self._last_return - start
+        return proposal
+
+    def _record_verification(self, input_ids: np.ndarray, now: float):
+        """Compte les tokens proposés que le modèle principal a gardés"""
+        proposal = self._last_proposal
+        if proposal is None or len(input_ids) <= self._last_input_len:
+            return
+        produced = input_ids[self._last_input_len:]
+        accepted = _common_prefix_length(proposal, produced)
+        self.accepted_tokens += accepted
+        self.generated_tokens += len(produced)
+        self.verify_time += now - self._last_return
+        self.verify_steps += 1
+        self._last_proposal = None
+
+    def _propose(self, input_ids: np.ndarray) -> np.ndarray:
+        """Réaligne le contexte du brouillon puis génère k tokens gloutons"""
+        draft = self.draft
+        if len(input_ids) + self.num_draft_tokens >= draft.n_ctx():
+            return np.zeros(0, dtype=np.intc)
+
+        # Seuls les tokens absents du cache KV du brouillon sont évalués
+        prefix = _common_prefix_length(draft.input_ids[:draft.n_tokens], input_ids)
+        prefix = min(prefix, len(input_ids) - 1)  # Il faut les logits du dernier token
+        draft.n_tokens = prefix
+        draft.eval(input_ids[prefix:].tolist())
+
+        tokens = []
+        while True:
+            token = int(np.argmax(draft.scores[draft.n_tokens - 1]))
+            if token == self.eos_token:
+                break
+            tokens.append(token)
+            if len(tokens) >= self.num_draft_tokens:
+                break
+            draft.eval([token])
+        return np.array(tokens, dtype=np.intc)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Taux d'acceptation et accélération estimée"""
+        verify_steps = self.verify_steps
+        tokens_per_step = self.generated_tokens / verify_steps if verify_steps else 0.0
+        avg_draft = self.draft_time / self.steps if self.steps else 0.0
+        avg_verify = self.verify_time / verify_steps if verify_steps else 0.0
+
+        # Une étape de vérification coûte à peu près un token de décodage classique
+        speedup = tokens_per_step * avg_verify / (avg_verify + avg_draft) if avg_verify else 0.0
+        return {
+            "enabled": True,
+            "draft_model": os.path.basename(getattr(self.draft, "model_path", "") or ""),
+            "num_draft_tokens": self.num_draft_tokens,
+            "steps": self.steps,
+            "proposed_tokens": self.proposed_tokens,
+            "accepted_tokens": self.accepted_tokens,
+            "acceptance_rate": round(self.accepted_tokens / self.proposed_tokens, 3) if self.proposed_tokens else 0.0,
+            "tokens_per_step": round(tokens_per_step, 2),
+            "avg_draft_time": round(avg_draft, 4),
+            "avg_verify_time": round(avg_verify, 4),
+            "estimated_speedup": round(speedup, 2),
+        }
+
+
+def _vocab_size(model_path: str) -> int:
+    """Taille du vocabulaire d'un GGUF, lue sans charger les poids (vocab_only)"""
+    import llama_cpp
+
+    params = llama_cpp.llama_model_default_params()
+    params.vocab_only = True
+    load = getattr(llama_cpp, "llama_model_load_from_file", None) or llama_cpp.llama_load_model_from_file
+    model = load(model_path.encode("utf-8"), params)
+    if not model:
+        raise RuntimeError(f"Vocabulaire illisible: {model_path}")
+    try:
+        if hasattr(llama_cpp, "llama_vocab_n_tokens"):
+            return llama_cpp.llama_vocab_n_tokens(llama_cpp.llama_model_get_vocab(model))
+        return llama_cpp.llama_n_vocab(model)
+    finally:
+        free = getattr(llama_cpp, "llama_model_free", None) or llama_cpp.llama_free_model
+        free(model)
+
+
+def load_draft_model(config: Dict[str, Any]) -> Optional[SpeculativeDraftModel]:
+    """Charge le modèle brouillon configuré (None si désactivé ou indisponible)"""
+    spec_config = Config.SPECULATIVE_CONFIG
+    if not spec_config["enabled"]:
+        return None
+
+    draft_path = spec_config["draft_model_path"]
+    if not os.path.exists(draft_path):
+        logger.warning(f"⚠️ Modèle brouillon non trouvé, décodage spéculatif désactivé: {draft_path}")
+        return None
+
+    # Vérifié avant tout chargement : un brouillon passé au Llama principal force logits_all,
+    # ce qui alourdit chaque save_state (cache de préfixes, sessions, disque)
+    try:
+        draft_vocab, main_vocab = _vocab_size(draft_path), _vocab_size(config["model_path"])
+    except Exception as e:
+        logger.warning(f"⚠️ Vocabulaires non vérifiables, décodage spéculatif désactivé: {e}")
+        return None
+    if draft_vocab != main_vocab:
+        logger.warning(
+            f"⚠️ Vocabulaire du modèle brouillon incompatible ({draft_vocab} vs {main_vocab}),"
+            f" décodage spéculatif désactivé"
+        )
+        return None
+
+    from llama_cpp import Llama
+
+    logger.info(f"📦 Chargement du modèle brouillon: {draft_path}")
+    draft = Llama(
+        model_path=draft_path,
+        n_ctx=config["n_ctx"],
+        n_batch=config["n_batch"],
+        n_gpu_layers=config["n_gpu_layers"],
+        n_threads=config["n_threads"],
+        n_threads_batch=config["n_threads_batch"],
+        use_mmap=config["use_mmap"],
+        verbose=False,
+    )
+    return SpeculativeDraftModel(draft, spec_config["num_draft_tokens"])
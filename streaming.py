@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""
+Pipeline de streaming pour l'API Llama.cpp (SSE et WebSocket)
+
+Les chunks d'un job sont drainés au fil de l'eau dans un tampon par connexion
+où les deltas de texte consécutifs sont fusionnés ; une trame est émise par
+fenêtre de temps (ou dès que le seuil d'octets est atteint) au lieu d'une par
+token. Les trames de contenu sont produites par un encodeur pré-gabarité : seul
+le texte est sérialisé, le reste du JSON est calculé une fois par flux.
+
+Le tampon est borné : un client qui ne lit plus assez vite pour suivre la
+génération est déconnecté au lieu d'accumuler de la mémoire.
+"""
+
+import asyncio
+import json
+from json.encoder import encode_basestring_ascii
+from typing import Dict, List, Optional, Any, AsyncIterator, Union
+
+from config import Config
+
+SSE_DONE = "data: [DONE]\n\n"
+
+
+class SlowConsumerError(Exception):
+    """Le client ne lit pas le flux assez vite"""
+
+
+class ChunkEncoder:
+    """Sérialise les chunks chat.completion.chunk en trames SSE ou WebSocket"""
+
+    def __init__(self, transport: str = "sse"):
+        self.prefix, self.suffix = ("data: ", "\n\n") if transport == "sse" else ("", "")
+        self._content_head: Optional[str] = None
+        self._content_tail = '},"finish_reason":null}]}' + self.suffix
+
+    def encode(self, chunk: Dict[str, Any]) -> str:
+        """Trame d'un chunk quelconque"""
+        return self.prefix + json.dumps(chunk) + self.suffix
+
+    def encode_text(self, chunk: Dict[str, Any], text: str) -> str:
+        """Trame d'un delta de contenu ; les champs fixes du flux sont gabarités au premier appel"""
+        if self._content_head is None:
+            head = json.dumps({
+                "id": chunk["id"],
+                "object": chunk["object"],
+                "created": chunk["created"],
+                "model": chunk["model"],
+            })
+            self._content_head = self.prefix + head[:-1] + ',"choices":[{"index":0,"delta":{"content":'
+        return self._content_head + encode_basestring_ascii(text) + self._content_tail
+
+    def encode_error(self, error: Union[str, Exception]) -> str:
+        return self.prefix + json.dumps({"error": str(error)}) + self.suffix
+
+
+class _TextRun:
+    """Deltas de contenu consécutifs en attente d'émission"""
+
+    __slots__ = ("chunk", "parts")
+
+    def __init__(self, chunk: Dict[str, Any], text: str):
+        self.chunk = chunk
+        self.parts = [text]
+
+
+class TokenStream:
+    """Tampon de coalescence entre un job et une connexion"""
+
+    def __init__(self, job, transport: str = "sse", window: Optional[float] = None,
+                 max_bytes: Optional[int] = None, max_pending_bytes: Optional[int] = None):
+        config = Config.STREAMING_CONFIG
+        self.job = job
+        self.encoder = ChunkEncoder(transport)
+        self.window = config["coalesce_window_ms"] / 1000 if window is None else window
+        self.max_bytes = config["coalesce_max_bytes"] if max_bytes is None else max_bytes
+        self.max_pending_bytes = config["max_pending_bytes"] if max_pending_bytes is None else max_pending_bytes
+
+        self._pending: List[Union[_TextRun, Dict[str, Any]]] = []
+        self._pending_bytes = 0
+        self._wake = asyncio.Event()
+        self._closed = False
+        self._overflow = False
+        self._error: Optional[Exception] = None
+        self.frames_sent = 0
+        self._text_sent = False
+
+    async def _pump(self):
+        """Draine le job dans le tampon (tourne à la vitesse de la génération)"""
+        try:
+            async for chunk in self.job:
+                self._push(chunk)
+        except Exception as e:
+            self._error = e
+        finally:
+            self._closed = True
+            self._wake.set()
+
+    def _push(self, chunk: Dict[str, Any]):
+        choice = chunk["choices"][0]
+        delta = choice.get("delta", {})
+        text = delta.get("content")
+        if text and len(delta) == 1 and choice.get("finish_reason") is None:
+            last = self._pending[-1] if self._pending else None
+            if isinstance(last, _TextRun):
+                last.parts.append(text)
+            else:
+                self._pending.append(_TextRun(chunk, text))
+            self._pending_bytes += len(text.encode("utf-8"))
+            if self._pending_bytes > self.max_pending_bytes:
+                self._overflow = True
+        else:
+            self._pending.append(chunk)
+        self._wake.set()
+
+    def _encode_pending(self) -> List[str]:
+        items, self._pending, self._pending_bytes = self._pending, [], 0
+        frames = []
+        for item in items:
+            if isinstance(item, _TextRun):
+                frames.append(self.encoder.encode_text(item.chunk, "".join(item.parts)))
+                self._text_sent = True
+            else:
+                frames.append(self.encoder.encode(item))
+        self.frames_sent += len(frames)
+        return frames
+
+    async def batches(self) -> AsyncIterator[List[str]]:
+        """Trames coalescées, par lot à écrire d'un coup ; relève l'erreur du job ou SlowConsumerError"""
+        pump = asyncio.get_running_loop().create_task(self._pump())
+        try:
+            while True:
+                await self._wake.wait()
+                self._wake.clear()
+                # Le premier texte part sans attendre (temps jusqu'au premier token)
+                if self._text_sent and self.window > 0 and not self._closed and self._pending_bytes < self.max_bytes:
+                    await asyncio.sleep(self.window)
+                if self._overflow:
+                    raise SlowConsumerError("Client trop lent, flux interrompu")
+                if self._pending:
+                    yield self._encode_pending()
+                if self._closed and not self._pending:
+                    break
+            if self._error is not None:
+                raise self._error
+        finally:
+            pump.cancel()
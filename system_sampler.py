@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+Échantillonnage de l'état du système pour l'API Llama.cpp
+
+Un thread de fond relève CPU, RAM, RSS (processus et workers forkés),
+disque et charge à intervalle fixe dans un tampon circulaire. Les endpoints
+de santé et les logs lisent le dernier relevé au lieu d'appeler psutil
+(cpu_percent bloquant) sur le chemin des requêtes.
+"""
+
+import logging
+import os
+import threading
+import time
+from collections import deque
+from typing import Dict, List, Optional, Any
+
+import psutil
+
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+
+class SystemSampler:
+    """Relevés périodiques de l'état du système dans un tampon circulaire"""
+
+    def __init__(self, interval: float = 1.0, history: int = 600, disk_path: str = "/"):
+        self.interval = interval
+        self.disk_path = disk_path
+        self._history: "deque[Dict[str, Any]]" = deque(maxlen=history)
+        self._latest: Optional[Dict[str, Any]] = None
+        self._process = psutil.Process()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        """Démarre le thread d'échantillonnage"""
+        if self.is_running:
+            return
+        self._stop.clear()
+        # Référence pour cpu_percent(None), qui mesure depuis l'appel précédent
+        psutil.cpu_percent(interval=None)
+        self._thread = threading.Thread(target=self._run, name="system-sampler", daemon=True)
+        self._thread.start()
+        logger.info(f"📡 Échantillonnage système toutes les {self.interval:g}s")
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.interval + 1)
+            self._thread = None
+
+    @property
+    def is_running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                snapshot = self.sample()
+            except Exception as e:
+                logger.warning(f"Relevé système impossible: {e}")
+                continue
+            self._history.append(snapshot)
+            self._latest = snapshot
+
+    def _rss(self) -> int:
+        """Mémoire résidente du processus et de ses workers forkés"""
+        rss = self._process.memory_info().rss
+        for child in self._process.children(recursive=True):
+            try:
+                rss += child.memory_info().rss
+            except psutil.Error:
+                continue
+        return rss
+
+    def sample(self) -> Dict[str, Any]:
+        """Un relevé (non bloquant : le CPU est mesuré depuis le relevé précédent)"""
+        memory = psutil.virtual_memory()
+        disk = psutil.disk_usage(self.disk_path)
+        load_1, load_5, load_15 = os.getloadavg()
+        return {
+            "timestamp": time.time(),
+            "cpu_percent": psutil.cpu_percent(interval=None),
+            "memory_percent": memory.percent,
+            "memory_used_gb": round(memory.used / (1024**3), 2),
+            "memory_available_gb": round(memory.available / (1024**3), 2),
+            "memory_total_gb": round(memory.total / (1024**3), 2),
+            "process_rss_gb": round(self._rss() / (1024**3), 3),
+            "disk_percent": disk.percent,
+            "disk_free_gb": round(disk.free / (1024**3), 2),
+            "load_1m": load_1,
+            "load_5m": load_5,
+            "load_15m": load_15,
+        }
+
+    def latest(self) -> Dict[str, Any]:
+        """Dernier relevé (un relevé immédiat si le thread n'en a pas encore produit)"""
+        snapshot = self._latest
+        if snapshot is None:
+            snapshot = self._latest = self.sample()
+        return snapshot
+
+    @property
+    def age(self) -> Optional[float]:
+        """Ancienneté du dernier relevé en secondes"""
+        return time.time() - self._latest["timestamp"] if self._latest else None
+
+    def history(self, seconds: Optional[float] = None) -> List[Dict[str, Any]]:
+        """Relevés du tampon, éventuellement limités aux dernières secondes"""
+        snapshots = list(self._history)
+        if seconds is None:
+            return snapshots
+        since = time.time() - seconds
+        return [s for s in snapshots if s["timestamp"] >= since]
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Dernier relevé et moyennes sur le tampon"""
+        snapshots = self.history()
+        stats = {
+            "running": self.is_running,
+            "interval": self.interval,
+            "samples": len(snapshots),
+            "latest": self.latest(),
+        }
+        if snapshots:
+            stats["avg_cpu_percent"] = round(sum(s["cpu_percent"] for s in snapshots) / len(snapshots), 1)
+            stats["max_cpu_percent"] = max(s["cpu_percent"] for s in snapshots)
+            stats["max_memory_percent"] = max(s["memory_percent"] for s in snapshots)
+        return stats
+
+
+# Instance globale
+system_sampler = SystemSampler(
+    interval=Config.SYSTEM_SAMPLER_CONFIG["interval"],
+    history=Config.SYSTEM_SAMPLER_CONFIG["history"],
+)
@@ -0,0 +1,416 @@
+#!/usr/bin/env python3
+"""
+Pool de workers d'inférence forkés pour l'API Llama.cpp
+
+Le modèle GGUF est chargé une seule fois dans le processus principal (mmap),
+puis N workers sont créés par fork() : ils partagent les pages des poids en
+copy-on-write et chacun fait tourner son propre exécuteur de génération
+(generation.py) avec son contexte et son cache KV. Le processus principal
+garde la boucle d'événements FastAPI et route chaque requête vers le worker
+le moins chargé ; les tours d'une même session restent sur le même worker
+pour réutiliser son état KV.
+
+Activé lorsque API_CONFIG["workers"] > 1 (uvicorn tourne alors avec un seul
+processus). Les états KV des sessions vivent dans les workers et ne sont pas
+écrits sur disque par la tâche de nettoyage du processus principal. Chaque
+worker écrit ses instantanés KV dans kv_cache/worker-<index>, avec une part
+égale de KV_STORE_CONFIG["max_bytes"].
+
+Réservé au CPU : si des couches sont déchargées sur GPU (n_gpu_layers != 0
+et llama.cpp compilé avec CUDA/Metal/Vulkan), le contexte du périphérique
+ne survit pas au fork et le serveur garde l'exécuteur unique en processus.
+"""
+
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+import threading
+from typing import Dict, List, Optional, Any
+
+from config import Config
+from cpu_affinity import cpu_affinity
+from generation import GenerationExecutor, GenerationJob, QueueFullError
+from kv_store import kv_store
+from sessions import session_manager, SessionNotFoundError
+
+logger = logging.getLogger(__name__)
+
+
+def gpu_offload_active() -> bool:
+    """Couches déchargées sur GPU : le contexte CUDA/Metal du parent ne survit pas à fork()"""
+    if Config.BACKEND_CONFIG["type"] != "llama_cpp" or Config.get_llama_args()["n_gpu_layers"] == 0:
+        return False
+    try:
+        import llama_cpp
+    except ImportError:
+        return False
+    try:
+        return bool(llama_cpp.llama_supports_gpu_offload())
+    except AttributeError:
+        # Version sans cette fonction : n_gpu_layers fait foi
+        return True
+
+
+class _WorkerHandle:
+    """Worker forké vu depuis le processus principal"""
+
+    def __init__(self, index: int, process, conn):
+        self.index = index
+        self.process = process
+        self.conn = conn
+        self.jobs: Dict[str, GenerationJob] = {}
+        self.completed_jobs = 0
+        self.failed_jobs = 0
+        self.cancelled_jobs = 0
+        self.tokens_saved = 0
+        self._send_lock = threading.Lock()
+        self.reader: Optional[threading.Thread] = None
+
+    @property
+    def alive(self) -> bool:
+        return self.process.is_alive()
+
+    @property
+    def load(self) -> int:
+        return len(self.jobs)
+
+    def send(self, message: tuple):
+        with self._send_lock:
+            self.conn.send(message)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "index": self.index,
+            "pid": self.process.pid,
+            "alive": self.alive,
+            "in_flight": self.load,
+            "completed_jobs": self.completed_jobs,
+            "failed_jobs": self.failed_jobs,
+            "cancelled_jobs": self.cancelled_jobs,
+        }
+
+
+class InferenceWorkerPool:
+    """Workers d'inférence forkés après le chargement du modèle"""
+
+    def __init__(self, n_workers: int, max_queue_size: int = 64):
+        self.n_workers = n_workers
+        self.max_queue_size = max_queue_size
+        self.model = None
+        self._workers: List[_WorkerHandle] = []
+        self._session_workers: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._running = False
+
+    def start(self, model):
+        """Forke les workers ; le modèle déjà chargé est hérité sans copie"""
+        if gpu_offload_active():
+            raise RuntimeError("Workers forkés incompatibles avec le déchargement GPU (n_gpu_layers != 0)")
+        self.model = model
+        config = Config.get_llama_args()
+        if not config["use_mmap"]:
+            logger.warning("⚠️ use_mmap désactivé : les poids ne sont partagés qu'en copy-on-write")
+
+        # Les threads de calcul sont répartis entre les workers
+        n_threads = max(1, config["n_threads"] // self.n_workers)
+        n_threads_batch = max(1, config["n_threads_batch"] // self.n_workers)
+
+        # Tous les forks avant de démarrer les threads de lecture du processus principal
+        context = multiprocessing.get_context("fork")
+        for index in range(self.n_workers):
+            parent_conn, child_conn = context.Pipe()
+            inherited = [worker.conn for worker in self._workers]
+            process = context.Process(
+                target=_worker_main,
+                args=(index, self.n_workers, model, child_conn, inherited, n_threads, n_threads_batch),
+                name=f"llama-worker-{index}",
+                daemon=True,
+            )
+            process.start()
+            child_conn.close()
+            self._workers.append(_WorkerHandle(index, process, parent_conn))
+
+        for worker in self._workers:
+            worker.reader = threading.Thread(
+                target=self._read_loop, args=(worker,), name=f"llama-worker-{worker.index}-reader", daemon=True
+            )
+            worker.reader.start()
+
+        session_manager.add_remove_listener(self._on_session_removed)
+        self._running = True
+        logger.info(f"🍴 {self.n_workers} workers d'inférence forkés ({n_threads} threads chacun)")
+
+    def stop(self, timeout: float = 5.0):
+        """Arrête les workers"""
+        if not self._workers:
+            return
+        self._running = False
+        for worker in self._workers:
+            try:
+                worker.send(("stop",))
+            except OSError:
+                pass
+        for worker in self._workers:
+            worker.process.join(timeout)
+            if worker.process.is_alive():
+                worker.process.terminate()
+                worker.process.join(timeout)
+            worker.conn.close()
+            if worker.reader:
+                worker.reader.join(timeout)
+        self._workers = []
+        self._session_workers.clear()
+        self.model = None
+        logger.info("🍴 Workers d'inférence arrêtés")
+
+    @property
+    def is_running(self) -> bool:
+        return self._running and any(worker.alive for worker in self._workers)
+
+    @property
+    def is_accepting(self) -> bool:
+        return self._running
+
+    def submit(self, request_id: str, messages: List[Dict[str, str]], params: Dict[str, Any],
+               stream: bool = True, session=None, deadline: Optional[float] = None) -> GenerationJob:
+        """Soumet un job au worker le moins chargé (même interface que GenerationExecutor)"""
+        if not self.is_running:
+            raise RuntimeError("Pool de workers d'inférence non démarré")
+
+        job = GenerationJob(request_id, messages, params, stream, asyncio.get_running_loop(), session, deadline)
+        job.model_name = os.path.basename(getattr(self.model, "model_path", "") or "")
+        session_id = session.session_id if session is not None else None
+
+        with self._lock:
+            worker = self._route(session_id)
+            if worker.load >= self.max_queue_size:
+                raise QueueFullError(f"File de génération pleine ({self.max_queue_size} requêtes par worker)")
+            worker.jobs[request_id] = job
+        job.cancel_callback = lambda: self._send_cancel(worker, request_id, job.interrupt_reason)
+
+        try:
+            worker.send(("submit", request_id, messages, params, stream, session_id, deadline))
+        except OSError as e:
+            with self._lock:
+                worker.jobs.pop(request_id, None)
+            raise RuntimeError(f"Worker {worker.index} indisponible: {e}")
+        return job
+
+    def _route(self, session_id: Optional[str]) -> _WorkerHandle:
+        """Worker affecté à la session, sinon le moins chargé"""
+        alive = [worker for worker in self._workers if worker.alive]
+        if not alive:
+            raise RuntimeError("Aucun worker d'inférence disponible")
+
+        if session_id is not None:
+            index = self._session_workers.get(session_id)
+            if index is not None and self._workers[index].alive:
+                return self._workers[index]
+
+        worker = min(alive, key=lambda w: w.load)
+        if session_id is not None:
+            self._session_workers[session_id] = worker.index
+        return worker
+
+    def _send_cancel(self, worker: _WorkerHandle, request_id: str, reason: str):
+        """Relaie l'interruption d'un job au worker qui l'exécute"""
+        try:
+            worker.send(("cancel", request_id, reason))
+        except OSError:
+            pass
+
+    def _on_session_removed(self, session_id: str):
+        """Libère l'état KV de la session dans son worker"""
+        index = self._session_workers.pop(session_id, None)
+        if index is None or index >= len(self._workers):
+            return
+        try:
+            self._workers[index].send(("drop_session", session_id))
+        except OSError:
+            pass
+
+    # --- Threads de lecture (processus principal) ---
+
+    def _read_loop(self, worker: _WorkerHandle):
+        """Relaie les messages d'un worker vers les jobs correspondants"""
+        while True:
+            try:
+                message = worker.conn.recv()
+            except (EOFError, OSError):
+                break
+            self._dispatch(worker, message)
+
+        # Worker terminé : les jobs en cours échouent
+        with self._lock:
+            orphans = list(worker.jobs.values())
+            worker.jobs.clear()
+        for job in orphans:
+            if job.session is not None:
+                session_manager.end_turn(job.session, None)
+            job.fail(RuntimeError(f"Worker d'inférence {worker.index} arrêté"))
+        if self._running:
+            logger.error(f"❌ Worker d'inférence {worker.index} arrêté (pid {worker.process.pid})")
+
+    def _dispatch(self, worker: _WorkerHandle, message: tuple):
+        kind, request_id = message[0], message[1]
+        if kind == "chunk":
+            job = worker.jobs.get(request_id)
+            if job is not None:
+                job.forward_chunk(message[2], message[3])
+            return
+
+        with self._lock:
+            job = worker.jobs.pop(request_id, None)
+        if job is None:
+            return
+
+        if kind == "done":
+            _, _, response, started_at, session_tokens, phases = message
+            if job.session is not None:
+                session_manager.end_turn(job.session, response["choices"][0]["message"]["content"],
+                                         None, session_tokens)
+            worker.completed_jobs += 1
+            if response["choices"][0]["finish_reason"] == "cancelled":
+                worker.cancelled_jobs += 1
+                worker.tokens_saved += max(0, job.params.get("max_tokens", 2048)
+                                           - response["usage"]["completion_tokens"])
+            job.complete_remote(response, started_at, phases)
+        else:
+            if job.session is not None:
+                session_manager.end_turn(job.session, None)
+            worker.failed_jobs += 1
+            logger.error(f"Erreur de génération [{request_id}] (worker {worker.index}): {message[2]}")
+            job.fail(RuntimeError(message[2]))
+
+    def get_stats(self) -> Dict[str, Any]:
+        """État des workers et des jobs en cours"""
+        with self._lock:
+            jobs = [job for worker in self._workers for job in worker.jobs.values()]
+            workers = [worker.to_dict() for worker in self._workers]
+        queued = [job.to_dict() for job in jobs if job.started_at is None]
+        active = [job.to_dict() for job in jobs if job.started_at is not None]
+
+        return {
+            "running": self.is_running,
+            "mode": "preforked_workers",
+            "queue_depth": len(queued),
+            "max_queue_size": self.max_queue_size,
+            "active": active,
+            "queued": queued,
+            "completed_jobs": sum(w["completed_jobs"] for w in workers),
+            "failed_jobs": sum(w["failed_jobs"] for w in workers),
+            "cancelled_jobs": sum(w["cancelled_jobs"] for w in workers),
+            "tokens_saved_by_cancellation": sum(worker.tokens_saved for worker in self._workers),
+            "workers": workers,
+        }
+
+
+# --- Processus worker ---
+
+def _set_threads(model, n_threads: int, n_threads_batch: int):
+    """Réduit le nombre de threads du contexte hérité"""
+    Config.LLAMA_CONFIG["n_threads"] = n_threads
+    Config.LLAMA_CONFIG["n_threads_batch"] = n_threads_batch
+    if getattr(model, "ctx", None) is None:
+        # Backend synthétique : pas de contexte llama.cpp
+        return
+    try:
+        import llama_cpp
+
+        llama_cpp.llama_set_n_threads(model.ctx, n_threads, n_threads_batch)
+    except Exception as e:
+        logger.warning(f"⚠️ Impossible d'ajuster les threads du worker: {e}")
+
+
+def _worker_main(index: int, n_workers: int, model, conn, inherited, n_threads: int, n_threads_batch: int):
+    """Point d'entrée d'un worker forké"""
+    # L'arrêt est piloté par le processus principal (les handlers uvicorn hérités sont inopérants ici)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    for other in inherited:
+        other.close()
+
+    _set_threads(model, n_threads, n_threads_batch)
+    # Part des cœurs de calcul propre à ce worker, héritée par les threads créés ensuite
+    cpu_affinity.pin_worker(index, n_workers)
+    if Config.KV_STORE_CONFIG["enabled"]:
+        # Instantanés KV du worker dans kv_cache/worker-<index> ; ceux du répertoire commun deviennent des échecs
+        kv_store.partition(index, n_workers)
+
+    # Boucle asyncio neuve dans un thread neuf : celle héritée du parent n'est pas utilisable
+    thread = threading.Thread(target=asyncio.run, args=(_serve(index, model, conn),), name="llama-worker-loop")
+    thread.start()
+    thread.join()
+
+
+async def _serve(index: int, model, conn):
+    """Reçoit les jobs du processus principal et les confie à l'exécuteur local"""
+    loop = asyncio.get_running_loop()
+    executor = GenerationExecutor(Config.GENERATION_CONFIG["max_queue_size"])
+    executor.start(model)
+    stopped = loop.create_future()
+    tasks = set()
+    jobs: Dict[str, GenerationJob] = {}
+
+    def handle(message: tuple):
+        kind = message[0]
+        if kind == "submit":
+            task = loop.create_task(_run_job(executor, conn, jobs, *message[1:]))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        elif kind == "cancel":
+            job = jobs.get(message[1])
+            if job is not None:
+                job.cancel(message[2])
+        elif kind == "drop_session":
+            try:
+                session_manager.delete(message[1])
+            except SessionNotFoundError:
+                pass
+        elif kind == "stop" and not stopped.done():
+            stopped.set_result(None)
+
+    def read():
+        while True:
+            try:
+                message = conn.recv()
+            except (EOFError, OSError):
+                message = ("stop",)
+            loop.call_soon_threadsafe(handle, message)
+            if message[0] == "stop":
+                return
+
+    threading.Thread(target=read, name="llama-worker-reader", daemon=True).start()
+    logger.info(f"🍴 Worker d'inférence {index} prêt (pid {os.getpid()})")
+
+    await stopped
+    for task in tasks:
+        task.cancel()
+    executor.stop()
+
+
+async def _run_job(executor: GenerationExecutor, conn, jobs: Dict[str, GenerationJob], request_id: str,
+                   messages: List[Dict[str, str]], params: Dict[str, Any], stream: bool, session_id: Optional[str],
+                   deadline: Optional[float]):
+    """Exécute un job et renvoie chunks et réponse au processus principal"""
+    session = session_manager.shadow(session_id) if session_id else None
+    try:
+        job = jobs[request_id] = executor.submit(request_id, messages, params, stream=stream, session=session,
+                                                 deadline=deadline)
+        async for chunk in job:
+            conn.send(("chunk", request_id, chunk, job.started_at))
+        response = await job.wait()
+        conn.send(("done", request_id, response, job.started_at, session.n_tokens if session else 0,
+                   job.phase_state()))
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        conn.send(("error", request_id, str(e)))
+    finally:
+        jobs.pop(request_id, None)
+
+
+# Instance globale
+worker_pool = InferenceWorkerPool(Config.API_CONFIG["workers"], Config.GENERATION_CONFIG["max_queue_size"])